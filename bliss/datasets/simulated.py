@@ -1,7 +1,12 @@
+import queue
+import threading
+import time
 import warnings
+from contextlib import nullcontext
+
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import IterableDataset, Dataset, DataLoader
+from torch.utils.data import IterableDataset, Dataset, DataLoader, get_worker_info
 from bliss.models.decoder import ImageDecoder
 
 # prevent pytorch_lightning warning for num_workers = 0 in dataloaders with IterableDataset
@@ -12,31 +17,146 @@ warnings.filterwarnings(
 
 class SimulatedDataset(pl.LightningDataModule, IterableDataset):
     def __init__(
-        self, decoder_kwargs, n_batches=10, batch_size=32, generate_device="cpu", testing_file=None
+        self,
+        decoder_kwargs,
+        n_batches=10,
+        batch_size=32,
+        generate_device="cpu",
+        testing_file=None,
+        prefetch_batches=0,
+        num_workers=0,
     ):
         super().__init__()
 
         self.n_batches = n_batches
         self.batch_size = batch_size
-        self.image_decoder = ImageDecoder(**decoder_kwargs).to(generate_device)
-        self.image_decoder.requires_grad_(False)  # freeze decoder weights.
         self.testing_file = testing_file
 
+        # with num_workers > 0, each (persistent) DataLoader worker simulates its share of the
+        # batches with its copy of the cpu decoder and its own random number generator
+        # (see `worker_init_fn`).
+        assert num_workers >= 0
+        self.num_workers = num_workers
+        self.generator = None
+        if self.num_workers > 0 and torch.device(generate_device).type != "cpu":
+            warnings.warn(
+                f"generate_device={generate_device} is ignored with num_workers > 0, "
+                "batches are simulated on cpu by the DataLoader workers."
+            )
+            generate_device = "cpu"
+
+        self.generate_device = torch.device(generate_device)
+        self.image_decoder = ImageDecoder(**decoder_kwargs).to(self.generate_device)
+        self.image_decoder.requires_grad_(False)  # freeze decoder weights.
+
+        # if prefetch_batches > 0, batches are simulated by a background thread (on a separate
+        # CUDA stream if generating on gpu) that stays up to `prefetch_batches` batches ahead.
+        assert prefetch_batches >= 0
+        self.prefetch_batches = prefetch_batches
+        # seconds spent waiting for the most recent batch, None with num_workers > 0 since the
+        # batches are simulated (and timed) in the workers.
+        self.data_wait_time = None if self.num_workers > 0 else 0.0
+
         # check sleep training will work.
         n_tiles_per_image = self.image_decoder.n_tiles_per_image
         total_ptiles = n_tiles_per_image * self.batch_size
         assert total_ptiles > 1, "Need at least 2 tiles over all batches."
 
     def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # split the batches across workers (batches are already prefetched by DataLoader).
+            n_batches = self.n_batches // worker_info.num_workers
+            n_batches += worker_info.id < self.n_batches % worker_info.num_workers
+            return self.batch_generator(n_batches)
+        if self.prefetch_batches > 0:
+            return self.prefetch_batch_generator()
         return self.batch_generator()
 
-    def batch_generator(self):
-        for _ in range(self.n_batches):
-            yield self.get_batch()
-
-    def get_batch(self):
+    @staticmethod
+    def worker_init_fn(worker_id):  # pylint: disable=unused-argument
+        # the workers use their copy of the cpu decoder, and seed their generator with
+        # `worker_info.seed`, which DataLoader derives from a base seed (drawn from the global RNG
+        # of the main process when the workers start) and the worker id. The workers persist
+        # across epochs, so this only runs once per worker.
+        worker_info = get_worker_info()
+        dataset = worker_info.dataset
+        dataset.generator = torch.Generator()
+        dataset.generator.manual_seed(worker_info.seed)
+
+    def batch_generator(self, n_batches=None):
+        n_batches = self.n_batches if n_batches is None else n_batches
+        for _ in range(n_batches):
+            t0 = time.perf_counter()
+            batch = self.get_batch(self.generator)
+            self.data_wait_time = time.perf_counter() - t0
+            yield batch
+
+    def prefetch_batch_generator(self):
+        # batch i is simulated with its own generator seeded with `base_seed + i`, so the batches
+        # do not depend on the timing of the threads (only the base seed uses the global RNG).
+        base_seed = int(torch.randint(2 ** 62, (1,)))
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        end_of_data = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            use_cuda = self.generate_device.type == "cuda"
+            stream = torch.cuda.Stream(self.generate_device) if use_cuda else None
+            try:
+                for i in range(self.n_batches):
+                    if stop.is_set():
+                        return
+                    generator = torch.Generator(self.generate_device)
+                    generator.manual_seed(base_seed + i)
+                    event = None
+                    with torch.cuda.stream(stream) if use_cuda else nullcontext():
+                        batch = self.get_batch(generator)
+                        if use_cuda:
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    put((batch, event))
+                put(end_of_data)
+            except Exception as e:  # pylint: disable=broad-except
+                put(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                item = batches.get()
+                self.data_wait_time = time.perf_counter() - t0
+                if item is end_of_data:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                batch, event = item
+                if event is not None:
+                    # wait for the batch to be ready and let the caching allocator know that its
+                    # memory is now used by the current stream.
+                    current_stream = torch.cuda.current_stream(self.generate_device)
+                    current_stream.wait_event(event)
+                    for v in batch.values():
+                        if v.is_cuda:
+                            v.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+    def get_batch(self, generator=None):
         with torch.no_grad():
-            batch = self.image_decoder.sample_prior(batch_size=self.batch_size)
+            batch = self.image_decoder.sample_prior(batch_size=self.batch_size, generator=generator)
             images, _ = self.image_decoder.render_images(
                 batch["n_sources"],
                 batch["locs"],
@@ -44,6 +164,9 @@ class SimulatedDataset(pl.LightningDataModule, IterableDataset):
                 batch["galaxy_params"],
                 batch["fluxes"],
                 add_noise=True,
+                galaxy_indices=batch.pop("galaxy_indices", None),
+                render_var=False,
+                generator=generator,
             )
             background = self.image_decoder.get_background(images.shape[-1])
             batch.update(
@@ -56,14 +179,25 @@ class SimulatedDataset(pl.LightningDataModule, IterableDataset):
 
         return batch
 
+    def _get_dataloader(self):
+        if self.num_workers == 0:
+            return DataLoader(self, batch_size=None)
+        return DataLoader(
+            self,
+            batch_size=None,
+            num_workers=self.num_workers,
+            worker_init_fn=self.worker_init_fn,
+            persistent_workers=True,
+        )
+
     def train_dataloader(self):
-        return DataLoader(self, batch_size=None, num_workers=0)
+        return self._get_dataloader()
 
     def val_dataloader(self):
-        return DataLoader(self, batch_size=None, num_workers=0)
+        return self._get_dataloader()
 
     def test_dataloader(self):
-        dl = DataLoader(self, batch_size=None, num_workers=0)
+        dl = self._get_dataloader()
 
         if self.testing_file:
             test_dataset = BlissDataset(self.testing_file)
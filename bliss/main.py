@@ -11,6 +11,12 @@ def main(cfg):
         from bliss.generate import generate as task
     elif cfg.mode == "predict":
         from bliss.predict import predict as task
+    elif cfg.mode == "export":
+        from bliss.predict import export as task
+    elif cfg.mode == "quantize":
+        from bliss.quantize import quantize as task
+    elif cfg.mode == "predict_survey":
+        from bliss.predict import predict_survey as task
     else:
         raise KeyError
     task(cfg)
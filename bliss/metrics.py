@@ -1,5 +1,13 @@
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import torch
+from torch import distributed as dist
 from scipy import optimize as sp_optim
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
 from einops import reduce, rearrange
 
 
@@ -90,78 +98,118 @@ def get_tpr_ppv(true_locs, true_mag, est_locs, est_mag, slack=1.0):
     return tpr_bool.mean(), ppv_bool.mean()
 
 
-def eval_error_on_batch(true_params, est_params, slen):
+def get_matches_on_batch(true_locs, est_locs, true_n_sources, est_n_sources):
+    # match the true and estimated sources of each image in a batch with the Hungarian algorithm
+    # on the l1 error of their locations (see `inner_join_locs`).
 
-    # check batch sizes are equal
-    assert len(true_params["n_sources"]) == len(est_params["n_sources"])
+    # true_locs shape = (batch_size x max_true x 2), est_locs shape = (batch_size x max_est x 2),
+    # with the sources of each image pushed to the front.
 
-    batch_size = len(true_params["n_sources"])
-    n_bands = true_params["fluxes"].shape[-1]
+    # returns the indices (batch, true source, estimated source) of all matches.
+    locs_err = rearrange(true_locs, "b i xy -> b i 1 xy") - rearrange(
+        est_locs, "b j xy -> b 1 j xy"
+    )
+    locs_err = reduce(locs_err.abs(), "b i j xy -> b i j", "sum")
 
-    tpr_vec = torch.zeros(batch_size)
-    ppv_vec = torch.zeros(batch_size)
+    # the only transfer to the host.
+    locs_err = locs_err.detach().cpu().numpy()
+    true_n_sources = true_n_sources.cpu().numpy()
+    est_n_sources = est_n_sources.cpu().numpy()
 
-    locs_mae_vec = []
-    fluxes_mae_vec = []
-    galaxy_params_mae_vec = []
+    batch_indx, true_indx, est_indx = [], [], []
+    for i, (ntrue, nest) in enumerate(zip(true_n_sources, est_n_sources)):
+        if (nest > 0) and (ntrue > 0):
+            row_indx, col_indx = sp_optim.linear_sum_assignment(locs_err[i, :ntrue, :nest])
+            batch_indx.append(np.full(len(row_indx), i))
+            true_indx.append(row_indx)
+            est_indx.append(col_indx)
 
-    # accuracy of counting number of sources
-    count_bool = true_params["n_sources"].eq(est_params["n_sources"])
+    device = true_locs.device
+    if not batch_indx:
+        empty = torch.zeros(0, dtype=torch.long, device=device)
+        return empty, empty, empty
+    indices = (np.concatenate(indx) for indx in (batch_indx, true_indx, est_indx))
+    return tuple(torch.from_numpy(indx).to(device) for indx in indices)
 
-    # accuracy of galaxy counts
-    est_n_gal = reduce(est_params["galaxy_bool"], "b n 1 -> b", "sum")
 
-    true_n_gal = reduce(true_params["galaxy_bool"], "b n 1 -> b", "sum")
+def get_tpr_ppv_on_batch(true_locs, true_mag, est_locs, est_mag, true_on, est_on, slack=1.0):
+    # same as `get_tpr_ppv` for all images in a batch at once, where true_on and est_on
+    # (shape = batch_size x max_sources) indicate which sources are on.
 
-    galaxy_counts_bool = est_n_gal.eq(true_n_gal)
+    # l-infty error in location, tensor of batch x true x est error
+    locs_error = torch.abs(est_locs.unsqueeze(1) - true_locs.unsqueeze(2)).max(-1)[0]
 
-    for i in range(batch_size):
+    # worst error in either band
+    mag_error = torch.abs(est_mag.unsqueeze(1) - true_mag.unsqueeze(2)).max(-1)[0]
 
-        # get number of sources
-        ntrue = int(true_params["n_sources"][i])
-        nest = int(est_params["n_sources"][i])
+    is_match = (locs_error < slack) & (mag_error < slack)
+    is_match &= true_on.unsqueeze(2) & est_on.unsqueeze(1)
+    n_true, n_est = true_on.sum(1), est_on.sum(1)
+    tpr = torch.any(is_match, dim=2).sum(1) / n_true.clamp(min=1)
+    ppv = torch.any(is_match, dim=1).sum(1) / n_est.clamp(min=1)
 
-        if (nest > 0) and (ntrue > 0):
+    # images without true or estimated sources are not evaluated.
+    is_evaluated = (n_true > 0) & (n_est > 0)
+    return tpr * is_evaluated, ppv * is_evaluated
 
-            # prepare locs and get them in units of pixels.
-            true_locs = true_params["locs"][i, 0:ntrue].view(ntrue, 2) * slen
-            est_locs = est_params["locs"][i, 0:nest].view(nest, 2) * slen
 
-            # prepare fluxes
-            true_fluxes = true_params["fluxes"][i, 0:ntrue].view(ntrue, n_bands)
-            est_fluxes = est_params["fluxes"][i, 0:nest].view(nest, n_bands)
+def eval_error_on_batch(true_params, est_params, slen):
 
-            # prepare galaxy params.
-            true_galaxy_params = true_params["galaxy_params"][i, 0:ntrue].view(ntrue, -1)
-            est_galaxy_params = est_params["galaxy_params"][i, 0:nest].view(nest, -1)
+    # check batch sizes are equal
+    assert len(true_params["n_sources"]) == len(est_params["n_sources"])
 
-            # convert fluxes to magnitude (off by a constant, but
-            # doesn't matter since we are looking at the diff)
-            true_mag = torch.log10(true_fluxes) * 2.5
-            est_mag = torch.log10(est_fluxes) * 2.5
+    true_n_sources = true_params["n_sources"].long()
+    est_n_sources = est_params["n_sources"].long()
 
-            # get TPR and PPV
-            tpr_i, ppv_i = get_tpr_ppv(true_locs, true_mag, est_locs, est_mag)
+    # accuracy of counting number of sources
+    count_bool = true_n_sources.eq(est_n_sources)
 
-            tpr_vec[i] = tpr_i
-            ppv_vec[i] = ppv_i
+    # accuracy of galaxy counts
+    est_n_gal = reduce(est_params["galaxy_bool"], "b n 1 -> b", "sum")
 
-            # get l1 error in locations and fluxes
-            locs_mae_i, fluxes_mae_i = get_l1_error(true_locs, true_mag, est_locs, est_mag)
+    true_n_gal = reduce(true_params["galaxy_bool"], "b n 1 -> b", "sum")
 
-            # get l1 error in galaxy_params
-            _, galaxy_params_mae_i = get_l1_error(
-                true_locs, true_galaxy_params, est_locs, est_galaxy_params
-            )
+    galaxy_counts_bool = est_n_gal.eq(true_n_gal)
+
+    # get locs in units of pixels.
+    true_locs = true_params["locs"] * slen
+    est_locs = est_params["locs"] * slen
+
+    # which of the (padded) sources are on.
+    device = true_locs.device
+    true_on = torch.arange(true_locs.shape[1], device=device) < true_n_sources.unsqueeze(1)
+    est_on = torch.arange(est_locs.shape[1], device=device) < est_n_sources.unsqueeze(1)
+
+    # convert fluxes to magnitude (off by a constant, but
+    # doesn't matter since we are looking at the diff)
+    true_fluxes = torch.where(
+        true_on.unsqueeze(2), true_params["fluxes"], torch.ones(1, device=device)
+    )
+    est_fluxes = torch.where(
+        est_on.unsqueeze(2), est_params["fluxes"], torch.ones(1, device=device)
+    )
+    true_mag = torch.log10(true_fluxes) * 2.5
+    est_mag = torch.log10(est_fluxes) * 2.5
+
+    # get TPR and PPV
+    tpr_vec, ppv_vec = get_tpr_ppv_on_batch(true_locs, true_mag, est_locs, est_mag, true_on, est_on)
 
-            for k, _ in enumerate(locs_mae_i):
-                locs_mae_vec.append(locs_mae_i[k].item())
-                fluxes_mae_vec.append(fluxes_mae_i[k].item())
-                galaxy_params_mae_vec.append(galaxy_params_mae_i[k].item())
+    # a single matching per image, shared by all params.
+    batch_indx, true_indx, est_indx = get_matches_on_batch(
+        true_locs, est_locs, true_n_sources, est_n_sources
+    )
 
-    locs_mae_vec = torch.tensor(locs_mae_vec)
-    fluxes_mae_vec = torch.tensor(fluxes_mae_vec)
-    galaxy_params_mae_vec = torch.tensor(galaxy_params_mae_vec)
+    def get_matched_error(true_param, est_param):
+        # absolute error of each matched source (flattened over the last dimension).
+        error = true_param[batch_indx, true_indx] - est_param[batch_indx, est_indx]
+        return error.abs().flatten()
+
+    # l1 error in locations, fluxes (for all bands) and galaxy params
+    locs_mae_vec = (true_locs[batch_indx, true_indx] - est_locs[batch_indx, est_indx]).abs().sum(1)
+    fluxes_mae_vec = get_matched_error(true_mag, est_mag)
+    galaxy_params_mae_vec = get_matched_error(
+        true_params["galaxy_params"], est_params["galaxy_params"]
+    )
 
     return {
         "locs_mae_vec": locs_mae_vec,
@@ -172,3 +220,235 @@ def eval_error_on_batch(true_params, est_params, slen):
         "tpr_vec": tpr_vec,
         "ppv_vec": ppv_vec,
     }
+
+
+def _solve_assignments(problems):
+    # solve each assignment problem (true_indx, est_indx, cost) and return the indices of the
+    # matched pairs, except those that had to use a pair out of the radius (cost = np.inf).
+    true_matches, est_matches = [], []
+    for true_indx, est_indx, cost in problems:
+        is_gated = np.isfinite(cost)
+        big_cost = 1.0 + cost[is_gated].sum()
+        row_indx, col_indx = sp_optim.linear_sum_assignment(np.where(is_gated, cost, big_cost))
+        keep = is_gated[row_indx, col_indx]
+        true_matches.append(true_indx[row_indx[keep]])
+        est_matches.append(est_indx[col_indx[keep]])
+    return np.concatenate(true_matches), np.concatenate(est_matches)
+
+
+def _match_locs(true_locs, est_locs, radius, n_workers):
+    # match the (non-empty) catalogs of `match_catalogs`, sorted by true source.
+    n_true, n_est = len(true_locs), len(est_locs)
+
+    # candidate pairs (edges), and the connected components of their graph.
+    pairs = cKDTree(true_locs).sparse_distance_matrix(
+        cKDTree(est_locs), radius, p=np.inf, output_type="ndarray"
+    )
+    true_edges, est_edges = pairs["i"].astype(int), pairs["j"].astype(int)
+    edges_cost = np.abs(true_locs[true_edges] - est_locs[est_edges]).sum(1)
+    graph = sparse.coo_matrix(
+        (np.ones(len(pairs)), (true_edges, n_true + est_edges)), shape=(n_true + n_est,) * 2
+    )
+    _, labels = csgraph.connected_components(graph, directed=False)
+    edges_label = labels[true_edges]
+    n_labels = labels.max() + 1
+    n_true_per_label = np.bincount(labels[:n_true], minlength=n_labels)
+    n_est_per_label = np.bincount(labels[n_true:], minlength=n_labels)
+
+    # components with a single pair need no assignment.
+    is_single = (n_true_per_label == 1) & (n_est_per_label == 1)
+    true_matches = [true_edges[is_single[edges_label]]]
+    est_matches = [est_edges[is_single[edges_label]]]
+
+    # the other components, with their dense (gated) cost matrices.
+    problems = []
+    order = np.argsort(edges_label, kind="stable")
+    edges_label, true_edges, est_edges = edges_label[order], true_edges[order], est_edges[order]
+    edges_cost = edges_cost[order]
+    bounds = np.flatnonzero(np.diff(edges_label)) + 1
+    for edges in np.split(np.arange(len(edges_label)), bounds):
+        if len(edges) == 0 or is_single[edges_label[edges[0]]]:
+            continue
+        true_indx, true_pos = np.unique(true_edges[edges], return_inverse=True)
+        est_indx, est_pos = np.unique(est_edges[edges], return_inverse=True)
+        cost = np.full((len(true_indx), len(est_indx)), np.inf)
+        cost[true_pos, est_pos] = edges_cost[edges]
+        problems.append((true_indx, est_indx, cost))
+
+    if problems and n_workers > 0:
+        chunks = [problems[i::n_workers] for i in range(n_workers) if problems[i::n_workers]]
+        with ProcessPoolExecutor(len(chunks), mp_context=mp.get_context("spawn")) as executor:
+            for true_indx, est_indx in executor.map(_solve_assignments, chunks):
+                true_matches.append(true_indx)
+                est_matches.append(est_indx)
+    elif problems:
+        true_indx, est_indx = _solve_assignments(problems)
+        true_matches.append(true_indx)
+        est_matches.append(est_indx)
+
+    # sort matches by true source.
+    true_indx, est_indx = np.concatenate(true_matches), np.concatenate(est_matches)
+    order = np.argsort(true_indx)
+    return true_indx[order], est_indx[order]
+
+
+def match_catalogs(
+    true_locs, est_locs, true_mag=None, est_mag=None, radius=1.0, slack=1.0, n_workers=0
+):
+    """Match a large catalog of estimated sources to a true catalog (e.g. of a whole field).
+
+    Only pairs of sources closer than `radius` (l-infinity distance, in the units of the locs)
+    can be matched. The candidate pairs are found with a KD-tree, and the matching splits
+    into one independent problem per connected component of the graph of candidate pairs.
+    Single pairs are matched directly, and the other components are solved with the
+    Hungarian algorithm on the l1 error of the locations (see `inner_join_locs`), in a pool of
+    `n_workers` processes (or serially if 0).
+
+    Args:
+        true_locs, est_locs: Arrays of locations of shape (number of sources) x 2.
+        true_mag, est_mag: Optional arrays of magnitudes of shape (number of sources) x n_bands.
+            A match counts as a true positive only if its magnitude error is below `slack`
+            in every band.
+
+    Returns:
+        A dictionary with the indices of the matched sources (`true_indx`, `est_indx`),
+        their errors (`locs_mae_vec`, `fluxes_mae_vec` if magnitudes are given), and the `tpr`
+        and `ppv` of the estimated catalog.
+    """
+    true_locs, est_locs = (torch.as_tensor(locs).cpu().numpy() for locs in (true_locs, est_locs))
+    assert true_locs.shape[1] == 2 and est_locs.shape[1] == 2
+    n_true, n_est = len(true_locs), len(est_locs)
+
+    if n_true == 0 or n_est == 0:
+        true_indx = est_indx = np.zeros(0, dtype=int)
+    else:
+        true_indx, est_indx = _match_locs(true_locs, est_locs, radius, n_workers)
+    true_indx, est_indx = torch.from_numpy(true_indx), torch.from_numpy(est_indx)
+
+    true_locs, est_locs = torch.from_numpy(true_locs), torch.from_numpy(est_locs)
+    results = {
+        "true_indx": true_indx,
+        "est_indx": est_indx,
+        "locs_mae_vec": (true_locs[true_indx] - est_locs[est_indx]).abs().sum(1),
+    }
+
+    is_true_positive = torch.ones(len(true_indx), dtype=torch.bool)
+    if true_mag is not None and est_mag is not None:
+        true_mag, est_mag = torch.as_tensor(true_mag).cpu(), torch.as_tensor(est_mag).cpu()
+        mag_error = (true_mag[true_indx] - est_mag[est_indx]).abs()
+        is_true_positive = mag_error.max(-1)[0] < slack
+        results["fluxes_mae_vec"] = mag_error.flatten()
+
+    n_true_positives = is_true_positive.sum().float()
+    results["tpr"] = n_true_positives / max(n_true, 1)
+    results["ppv"] = n_true_positives / max(n_est, 1)
+    return results
+
+
+def _get_bottom_k(keys, values, k):
+    # keep the k values with the smallest keys.
+    if len(keys) <= k:
+        return keys, values
+    indx = torch.topk(keys, k, largest=False)[1]
+    return keys[indx], values[indx]
+
+
+def _all_gather_padded(tensor, size, fill_value):
+    # gather 1D tensors with at most `size` elements from all processes.
+    padded = torch.full((size,), fill_value, dtype=tensor.dtype, device=tensor.device)
+    padded[: len(tensor)] = tensor
+    gathered = [torch.empty_like(padded) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, padded)
+    return torch.cat(gathered)
+
+
+class MetricsAccumulator:
+    """Streaming accumulator of metrics over an epoch (e.g. of validation).
+
+    The values of each metric in `names` (e.g. one per image or per matched source) are
+    accumulated on their device into a sum and a count, and for the metrics in `median_names`
+    into a uniform sample of at most `reservoir_size` values (those with the smallest random
+    keys, drawn from a generator seeded with `seed`, so that samples can be merged). `compute`
+    reduces them into means (and medians) once, across all processes if torch.distributed is
+    initialized. The names are fixed so that every process reduces the same metrics, even if
+    some of them were not updated on every process.
+    """
+
+    def __init__(self, names, median_names=(), reservoir_size=1024, seed=0):
+        self.names = tuple(sorted(names))
+        self.median_names = set(median_names)
+        assert self.median_names <= set(self.names)
+        self.reservoir_size = reservoir_size
+        self.seed = seed
+        self.generators = {}
+        self.sums = {}
+        self.counts = {}
+        self.reservoirs = {}
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+        self.reservoirs = {}
+
+    def _get_generator(self, device):
+        # one generator per device, seeded differently in each process.
+        if device not in self.generators:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed + rank)
+        return self.generators[device]
+
+    def update(self, metrics):
+        for name, values in metrics.items():
+            assert name in self.names, f"Unknown metric {name}."
+            values = values.detach().flatten().double()
+            if name not in self.sums:
+                self.sums[name] = torch.zeros((), dtype=torch.double, device=values.device)
+                self.counts[name] = torch.zeros((), dtype=torch.double, device=values.device)
+            self.sums[name] += values.sum()
+            self.counts[name] += len(values)
+
+            if name in self.median_names:
+                generator = self._get_generator(values.device)
+                keys = torch.rand(
+                    len(values), dtype=torch.double, device=values.device, generator=generator
+                )
+                if name in self.reservoirs:
+                    old_keys, old_values = self.reservoirs[name]
+                    keys, values = torch.cat((old_keys, keys)), torch.cat((old_values, values))
+                self.reservoirs[name] = _get_bottom_k(keys, values, self.reservoir_size)
+
+    def compute(self, device=None):
+        """Means (and medians) of the metrics with values in any process.
+
+        Metrics without values are reduced as zeros on `device` (by default the device of
+        the other metrics, or cpu), and left out of the results.
+        """
+        if device is None:
+            device = next((v.device for v in self.sums.values()), torch.device("cpu"))
+        is_distributed = dist.is_available() and dist.is_initialized()
+        zero = torch.zeros((), dtype=torch.double, device=device)
+        empty = torch.zeros(0, dtype=torch.double, device=device)
+        results = {}
+        for name in self.names:
+            stats = torch.stack((self.sums.get(name, zero), self.counts.get(name, zero)))
+            if is_distributed:
+                stats = stats.to(device)
+                dist.all_reduce(stats)
+
+            if name in self.median_names:
+                keys, values = self.reservoirs.get(name, (empty, empty))
+                if is_distributed:
+                    keys = _all_gather_padded(keys.to(device), self.reservoir_size, float("inf"))
+                    values = _all_gather_padded(
+                        values.to(device), self.reservoir_size, float("nan")
+                    )
+                    keys, values = _get_bottom_k(keys, values, self.reservoir_size)
+                    values = values[torch.isfinite(keys)]
+
+            if stats[1] == 0:
+                continue
+            results[name] = (stats[0] / stats[1]).float()
+            if name in self.median_names:
+                results[f"{name}_median"] = values.median().float()
+        return results
@@ -6,12 +6,11 @@ from astropy.io import fits
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.distributions import Poisson
 import pytorch_lightning as pl
 from einops import rearrange, reduce
 
 from .encoder import get_is_on_from_n_sources, get_mgrid
-from . import galaxy_net
+from . import galaxy_net, render
 
 
 class ImageDecoder(pl.LightningModule):
@@ -40,6 +39,11 @@ class ImageDecoder(pl.LightningModule):
         loc_min=0.0,
         loc_max=1.0,
         sdss_bands=(2,),
+        render_chunk_size=None,
+        render_mode="dense",
+        shift_engine="grid_sample",
+        galaxy_stamp_bank=False,
+        galaxy_stamp_bank_file=None,
     ):
         super().__init__()
         ## Set class attributes
@@ -101,7 +105,17 @@ class ImageDecoder(pl.LightningModule):
         self.background_values = background_values
 
         ## Submodule for managing tiles (no learned parameters)
-        self.tiler = Tiler(tile_slen, ptile_slen)
+        # render_chunk_size caps the number of sources rendered at once (peak memory).
+        self.render_chunk_size = render_chunk_size
+        # shift_engine is the method used to place sources at sub-pixel locations.
+        self.shift_engine = shift_engine
+        self.tiler = Tiler(tile_slen, ptile_slen, self.render_chunk_size, self.shift_engine)
+
+        ## Rendering mode
+        # 'dense' renders every (ptile, source) slot, 'sparse' only renders the slots that are on.
+        # 'global' skips ptiles and renders each source that is on directly on the full image.
+        assert render_mode in {"dense", "sparse", "global"}, "render_mode not supported."
+        self.render_mode = render_mode
 
         ## Submodule for rendering stars on a tile
         self.star_tile_decoder = StarTileDecoder(
@@ -118,32 +132,40 @@ class ImageDecoder(pl.LightningModule):
                 self.gal_slen,
                 self.n_galaxy_params,
                 self.autoencoder_ckpt,
+                self.render_chunk_size,
+                self.shift_engine,
             )
             # load dataset of encoded simulated galaxies.
             self.register_buffer("latents", torch.load(latents_file))
+
+            # optionally decode every latent once, so galaxies can be rendered by index.
+            if galaxy_stamp_bank:
+                self.galaxy_tile_decoder.build_stamp_bank(
+                    self.latents, galaxy_stamp_bank_file, latents_file=latents_file
+                )
         else:
             self.galaxy_tile_decoder = None
             self.register_buffer("latents", torch.zeros(1, 8))
 
-        # background
-        assert len(background_values) == n_bands
-        self.background_values = background_values
-
     def forward(self):
         return self.star_tile_decoder.psf_forward()
 
-    def sample_prior(self, batch_size=1):
-        n_sources = self._sample_n_sources(batch_size)
+    def sample_prior(self, batch_size=1, generator=None):
+        # generator: (optional) torch.Generator on self.device used for all random draws,
+        #   instead of the global random number generator.
+        n_sources = self._sample_n_sources(batch_size, generator)
         is_on_array = get_is_on_from_n_sources(n_sources, self.max_sources)
-        locs = self._sample_locs(is_on_array, batch_size)
+        locs = self._sample_locs(is_on_array, batch_size, generator)
 
-        _, _, galaxy_bool, star_bool = self._sample_n_galaxies_and_stars(n_sources, is_on_array)
-        galaxy_params = self._sample_galaxy_params(galaxy_bool)
-        fluxes = self._sample_fluxes(n_sources, star_bool, batch_size)
+        _, _, galaxy_bool, star_bool = self._sample_n_galaxies_and_stars(
+            n_sources, is_on_array, generator
+        )
+        galaxy_params, galaxy_indices = self._sample_galaxy_params(galaxy_bool, generator)
+        fluxes = self._sample_fluxes(n_sources, star_bool, batch_size, generator)
         log_fluxes = self._get_log_fluxes(fluxes)
 
         # per tile quantities.
-        return {
+        prior_sample = {
             "n_sources": n_sources,
             "locs": locs,
             "galaxy_bool": galaxy_bool,
@@ -152,38 +174,80 @@ class ImageDecoder(pl.LightningModule):
             "log_fluxes": log_fluxes,
         }
 
-    def render_images(self, n_sources, locs, galaxy_bool, galaxy_params, fluxes, add_noise=True):
+        # indices of the galaxy latents in `self.latents`, only needed to render with the bank.
+        if self.has_galaxy_stamp_bank:
+            prior_sample["galaxy_indices"] = galaxy_indices
+
+        return prior_sample
+
+    @property
+    def has_galaxy_stamp_bank(self):
+        if self.galaxy_tile_decoder is None:
+            return False
+        return self.galaxy_tile_decoder.stamp_bank is not None
+
+    def render_images(
+        self,
+        n_sources,
+        locs,
+        galaxy_bool,
+        galaxy_params,
+        fluxes,
+        add_noise=True,
+        galaxy_indices=None,
+        render_var=True,
+        generator=None,
+    ):
         # returns the **full** image in shape (batch_size x n_bands x slen x slen)
+        # and its variance, which is None if `render_var` is False.
 
         # n_sources: is (batch_size x n_tiles_per_image)
         # locs: is (batch_size x n_tiles_per_image x max_sources x 2)
         # galaxy_bool: Is (batch_size x n_tiles_per_image x max_sources x 1)
         # galaxy_params : is (batch_size x n_tiles_per_image x max_sources x latent_dim)
         # fluxes: Is (batch_size x n_tiles_per_image x max_sources x n_bands)
+        # galaxy_indices: (optional) is (batch_size x n_tiles_per_image x max_sources x 1),
+        #   indices of `galaxy_params` in `self.latents`, galaxies are then rendered from
+        #   the precomputed stamp bank instead of the galaxy decoder.
 
         assert n_sources.shape[0] == locs.shape[0]
         assert n_sources.shape[1] == locs.shape[1]
         assert galaxy_bool.shape[-1] == 1
 
-        # first render the padded tiles
-        image_ptiles, var_ptiles = self._render_ptiles(
-            n_sources, locs, galaxy_bool, galaxy_params, fluxes
-        )
+        if self.render_mode == "global":
+            images, var_images = render.render_images_global(
+                self,
+                n_sources,
+                locs,
+                galaxy_bool,
+                galaxy_params,
+                fluxes,
+                galaxy_indices,
+                render_var,
+            )
+        else:
+            # first render the padded tiles
+            image_ptiles, var_ptiles = self._render_ptiles(
+                n_sources, locs, galaxy_bool, galaxy_params, fluxes, galaxy_indices, render_var
+            )
 
-        # render the image from padded tiles
-        images = self._construct_full_image_from_ptiles(
-            image_ptiles, self.tile_slen, self.border_padding
-        )
-        var_images = self._construct_full_image_from_ptiles(
-            var_ptiles, self.tile_slen, self.border_padding
-        )
+            # render the image from padded tiles
+            images = self._construct_full_image_from_ptiles(
+                image_ptiles, self.tile_slen, self.border_padding
+            )
+            var_images = None
+            if render_var:
+                var_images = self._construct_full_image_from_ptiles(
+                    var_ptiles, self.tile_slen, self.border_padding
+                )
 
         # add background and noise
         background = self.get_background(images.shape[-1])
         images += background.unsqueeze(0)
-        var_images += background.unsqueeze(0)
+        if render_var:
+            var_images += background.unsqueeze(0)
         if add_noise:
-            images = self._apply_noise(images)
+            images = self._apply_noise(images, generator)
 
         return images, var_images
 
@@ -201,21 +265,21 @@ class ImageDecoder(pl.LightningModule):
 
         return background
 
-    def _sample_n_sources(self, batch_size):
+    def _sample_n_sources(self, batch_size, generator=None):
         # returns number of sources for each batch x tile
         # output dimension is batch_size x n_tiles_per_image
 
         # always poisson distributed.
         p = torch.full((1,), self.mean_sources, device=self.device, dtype=torch.float)
-        m = Poisson(p)
-        n_sources = m.sample([batch_size, self.n_tiles_per_image])
+        p = p.expand(batch_size, self.n_tiles_per_image, 1)
+        n_sources = torch.poisson(p, generator=generator)
 
         # long() here is necessary because used for indexing and one_hot encoding.
         n_sources = n_sources.clamp(max=self.max_sources, min=self.min_sources)
         n_sources = rearrange(n_sources.long(), "b n 1 -> b n")
         return n_sources
 
-    def _sample_locs(self, is_on_array, batch_size):
+    def _sample_locs(self, is_on_array, batch_size, generator=None):
         # output dimension is batch_size x n_tiles_per_image x max_sources x 2
 
         # 2 = (x,y)
@@ -225,14 +289,14 @@ class ImageDecoder(pl.LightningModule):
             self.max_sources,
             2,
         )
-        locs = torch.rand(*shape, device=is_on_array.device)
+        locs = torch.rand(*shape, device=is_on_array.device, generator=generator)
         locs *= self.loc_max - self.loc_min
         locs += self.loc_min
         locs *= is_on_array.unsqueeze(-1)
 
         return locs
 
-    def _sample_n_galaxies_and_stars(self, n_sources, is_on_array):
+    def _sample_n_galaxies_and_stars(self, n_sources, is_on_array, generator=None):
         # the counts returned (n_galaxies, n_stars) are of shape (batch_size x n_tiles_per_image)
         # the booleans returned (galaxy_bool, star_bool) are of shape
         # (batch_size x n_tiles_per_image x max_sources x 1)
@@ -245,6 +309,7 @@ class ImageDecoder(pl.LightningModule):
             self.max_sources,
             1,
             device=is_on_array.device,
+            generator=generator,
         )
         galaxy_bool = uniform < self.prob_galaxy
         galaxy_bool = (galaxy_bool * is_on_array.unsqueeze(-1)).float()
@@ -258,14 +323,14 @@ class ImageDecoder(pl.LightningModule):
     def _pareto_cdf(self, x):
         return 1 - (self.f_min / x) ** self.alpha
 
-    def _draw_pareto_maxed(self, shape):
+    def _draw_pareto_maxed(self, shape, generator=None):
         # draw pareto conditioned on being less than f_max
 
         u_max = self._pareto_cdf(self.f_max)
-        uniform_samples = torch.rand(*shape, device=self.device) * u_max
+        uniform_samples = torch.rand(*shape, device=self.device, generator=generator) * u_max
         return self.f_min / (1.0 - uniform_samples) ** (1 / self.alpha)
 
-    def _sample_fluxes(self, n_stars, star_bool, batch_size):
+    def _sample_fluxes(self, n_stars, star_bool, batch_size, generator=None):
         """
         Returns:
             fluxes, tensor shape (batch_size x self.n_tiles_per_image x self.max_sources x n_bands)
@@ -273,7 +338,7 @@ class ImageDecoder(pl.LightningModule):
         assert n_stars.shape[0] == batch_size
 
         shape = (batch_size, self.n_tiles_per_image, self.max_sources, 1)
-        base_fluxes = self._draw_pareto_maxed(shape)
+        base_fluxes = self._draw_pareto_maxed(shape, generator)
 
         if self.n_bands > 1:
             shape = (
@@ -282,7 +347,7 @@ class ImageDecoder(pl.LightningModule):
                 self.max_sources,
                 self.n_bands - 1,
             )
-            colors = torch.randn(*shape, device=base_fluxes.device)
+            colors = torch.randn(*shape, device=base_fluxes.device, generator=generator)
             _fluxes = 10 ** (colors / 2.5) * base_fluxes
             fluxes = torch.cat((base_fluxes, _fluxes), dim=3)
             fluxes *= star_bool.float()
@@ -291,7 +356,7 @@ class ImageDecoder(pl.LightningModule):
 
         return fluxes
 
-    def _sample_galaxy_params(self, galaxy_bool):
+    def _sample_galaxy_params(self, galaxy_bool, generator=None):
         # galaxy latent variables are obtaind from previously encoded variables from
         # large dataset of simulated galaxies stored in `self.latents`
         # NOTE: These latent variables DO NOT follow a specific distribution.
@@ -301,7 +366,9 @@ class ImageDecoder(pl.LightningModule):
         total_latent = batch_size * self.n_tiles_per_image * self.max_sources
 
         # first get random subset of indices to extract from self.latents
-        indices = torch.randint(0, len(self.latents), (total_latent,), device=galaxy_bool.device)
+        indices = torch.randint(
+            0, len(self.latents), (total_latent,), device=galaxy_bool.device, generator=generator
+        )
         galaxy_params = rearrange(
             self.latents[indices],
             "(b n s) g -> b n s g",
@@ -309,7 +376,10 @@ class ImageDecoder(pl.LightningModule):
             s=self.max_sources,
             g=self.n_galaxy_params,
         )
-        return galaxy_params * galaxy_bool
+        galaxy_indices = rearrange(
+            indices, "(b n s) -> b n s 1", n=self.n_tiles_per_image, s=self.max_sources
+        )
+        return galaxy_params * galaxy_bool, galaxy_indices * galaxy_bool.long()
 
     @staticmethod
     def _get_log_fluxes(fluxes):
@@ -321,19 +391,27 @@ class ImageDecoder(pl.LightningModule):
         return log_fluxes
 
     @staticmethod
-    def _apply_noise(images_mean):
+    def _apply_noise(images_mean, generator=None):
         # add noise to images.
 
         if torch.any(images_mean <= 0):
             warnings.warn("image mean less than 0")
             images_mean = images_mean.clamp(min=1.0)
 
-        _images = torch.sqrt(images_mean) * torch.randn_like(images_mean)
+        noise = torch.randn(
+            images_mean.shape,
+            device=images_mean.device,
+            dtype=images_mean.dtype,
+            generator=generator,
+        )
+        _images = torch.sqrt(images_mean) * noise
         images = _images + images_mean
 
         return images
 
-    def _render_ptiles(self, n_sources, locs, galaxy_bool, galaxy_params, fluxes):
+    def _render_ptiles(
+        self, n_sources, locs, galaxy_bool, galaxy_params, fluxes, galaxy_indices, render_var=True
+    ):
         # n_sources: is (batch_size x n_tiles_per_image)
         # locs: is (batch_size x n_tiles_per_image x max_sources x 2)
         # galaxy_bool: Is (batch_size x n_tiles_per_image x max_sources)
@@ -342,6 +420,7 @@ class ImageDecoder(pl.LightningModule):
 
         # returns the ptiles with shape =
         # (batch_size x n_tiles_per_image x n_bands x ptile_slen x ptile_slen)
+        # and their variance, which is None if `render_var` is False.
 
         # b: batch, n: n_tiles_per_image, s: max_sources
         n_tiles_per_image = n_sources.shape[1]
@@ -355,6 +434,8 @@ class ImageDecoder(pl.LightningModule):
         _locs = rearrange(locs, "b t s xy -> (b t) s xy", xy=2)
         _galaxy_bool = rearrange(galaxy_bool, "b t s 1 -> (b t) s 1")
         _fluxes = rearrange(fluxes, "b t s band -> (b t) s band")
+        if galaxy_indices is not None:
+            galaxy_indices = rearrange(galaxy_indices, "b t s 1 -> (b t) s 1")
 
         # draw stars and galaxies
         _is_on_array = get_is_on_from_n_sources(_n_sources, max_sources)
@@ -372,17 +453,33 @@ class ImageDecoder(pl.LightningModule):
             self.ptile_slen,
         )
 
-        # draw stars and galaxies
-        stars = self.star_tile_decoder(_locs, _fluxes, _star_bool)
-        galaxies = torch.zeros(img_shape, device=locs.device)
-        var_images = torch.zeros(img_shape, device=locs.device)
-        if self.galaxy_tile_decoder is not None:
-            galaxies, var_images = self.galaxy_tile_decoder(_locs, galaxy_params, _galaxy_bool)
+        if self.render_mode == "sparse":
+            _galaxy_params = rearrange(galaxy_params, "b t s d -> (b t) s d")
+            images, var_images = render.render_ptiles_sparse(
+                self,
+                _locs,
+                _galaxy_bool,
+                _galaxy_params,
+                _fluxes,
+                _star_bool,
+                galaxy_indices,
+                render_var,
+            )
+            if render_var:
+                var_images = var_images.view(img_shape)
+            return images.view(img_shape), var_images
 
-        images = galaxies.view(img_shape) + stars.view(img_shape)
-        var_images = var_images.view(img_shape)
+        # draw stars and galaxies
+        images = self.star_tile_decoder(_locs, _fluxes, _star_bool).view(img_shape)
+        if self.galaxy_tile_decoder is None:
+            var_images = torch.zeros(img_shape, device=locs.device) if render_var else None
+            return images, var_images
 
-        return images, var_images
+        galaxies, var_images = self.galaxy_tile_decoder(
+            _locs, galaxy_params, _galaxy_bool, galaxy_indices
+        )
+        images = images + galaxies.view(img_shape)
+        return images, var_images.view(img_shape) if render_var else None
 
     @staticmethod
     def _construct_full_image_from_ptiles(image_ptiles, tile_slen, border_padding):
@@ -411,74 +508,30 @@ class ImageDecoder(pl.LightningModule):
         n_tiles1_in_ptile = int(n_tiles1_in_ptile)
         n_tiles_of_padding = int(n_tiles_of_padding)
 
+        # construct the full image, the ptiles whose tile offsets are equal modulo the number of
+        # tiles in a ptile do not overlap, so each such group is added to the canvas at once.
+        # each pixel then sums its ptiles in order of offset (i, j), the same order as the
+        # previous implementation, so that (seeded) images are exactly reproduced.
+        canvas_slen = (n_tiles1 - 1) * tile_slen + ptile_slen
+        canvas = torch.zeros(
+            batch_size, n_bands, canvas_slen, canvas_slen, device=image_ptiles.device
+        )
         image_tiles_4d = image_ptiles.view(
             batch_size, n_tiles1, n_tiles1, n_bands, ptile_slen, ptile_slen
         )
-
-        # zero pad tiles, so that the number of tiles in a row (and column)
-        # are divisible by n_tiles1_in_ptile
-        n_tiles_pad = n_tiles1_in_ptile - (n_tiles1 % n_tiles1_in_ptile)
-        zero_pads1 = torch.zeros(
-            batch_size,
-            n_tiles_pad,
-            n_tiles1,
-            n_bands,
-            ptile_slen,
-            ptile_slen,
-            device=image_ptiles.device,
-        )
-        zero_pads2 = torch.zeros(
-            batch_size,
-            n_tiles1 + n_tiles_pad,
-            n_tiles_pad,
-            n_bands,
-            ptile_slen,
-            ptile_slen,
-            device=image_ptiles.device,
-        )
-        image_tiles_4d = torch.cat((image_tiles_4d, zero_pads1), dim=1)
-        image_tiles_4d = torch.cat((image_tiles_4d, zero_pads2), dim=2)
-
-        # construct the full image
-        n_tiles = n_tiles1 + n_tiles_pad
-        canvas = torch.zeros(
-            batch_size,
-            n_bands,
-            (n_tiles + n_tiles1_in_ptile - 1) * tile_slen,
-            (n_tiles + n_tiles1_in_ptile - 1) * tile_slen,
-            device=image_ptiles.device,
-        )
-
-        # loop through all tiles in a ptile
         for i in range(n_tiles1_in_ptile):
             for j in range(n_tiles1_in_ptile):
-                indx_vec1 = torch.arange(
-                    start=i,
-                    end=n_tiles,
-                    step=n_tiles1_in_ptile,
-                    device=image_ptiles.device,
-                )
-                indx_vec2 = torch.arange(
-                    start=j,
-                    end=n_tiles,
-                    step=n_tiles1_in_ptile,
-                    device=image_ptiles.device,
-                )
-
-                canvas_len = len(indx_vec1) * ptile_slen
-
-                image_tile_rows = image_tiles_4d[:, indx_vec1]
-                image_tile_cols = image_tile_rows[:, :, indx_vec2]
+                image_tile_cols = image_tiles_4d[:, i::n_tiles1_in_ptile, j::n_tiles1_in_ptile]
+                rows_len = image_tile_cols.shape[1] * ptile_slen
+                cols_len = image_tile_cols.shape[2] * ptile_slen
                 image_tile_cols = rearrange(
                     image_tile_cols, "b x1 y1 band x2 y2 -> b band (x1 x2) (y1 y2)"
                 )
-
-                # get canvas
                 canvas[
                     :,
                     :,
-                    (i * tile_slen) : (i * tile_slen + canvas_len),
-                    (j * tile_slen) : (j * tile_slen + canvas_len),
+                    (i * tile_slen) : (i * tile_slen + rows_len),
+                    (j * tile_slen) : (j * tile_slen + cols_len),
                 ] += image_tile_cols
 
         # trim to original image size
@@ -492,11 +545,24 @@ class Tiler(nn.Module):
     This class creates an image tile from multiple sources.
     """
 
-    def __init__(self, tile_slen, ptile_slen):
+    def __init__(self, tile_slen, ptile_slen, render_chunk_size=None, shift_engine="grid_sample"):
         super().__init__()
         self.tile_slen = tile_slen
         self.ptile_slen = ptile_slen
 
+        # maximum number of sources rendered in a single call to F.grid_sample,
+        # (None means all sources of all ptiles are rendered at once).
+        assert render_chunk_size is None or render_chunk_size > 0
+        self.render_chunk_size = render_chunk_size
+
+        # 'grid_sample' shifts sources with bilinear interpolation, 'fft' applies a phase ramp
+        # to their Fourier transform (no interpolation blurring, but sources are band-limited).
+        assert shift_engine in {"grid_sample", "fft"}, "shift_engine not supported."
+        self.shift_engine = shift_engine
+        # zero padding added to each side of a source before its FFT, so that shifts of up to
+        # tile_slen / 2 + 1/2 pixels do not wrap around.
+        self.fft_padding = self.tile_slen // 2 + 2
+
         # caching the underlying
         # coordinates on which we simulate source
         # grid: between -1 and 1,
@@ -519,6 +585,10 @@ class Tiler(nn.Module):
         assert source.shape[2] == source.shape[3]
         assert locs.shape[1] == 2
 
+        if self.shift_engine == "fft":
+            source_fft = self.get_source_fft(source)
+            return render.render_one_source_fft(self, locs, source_fft, source.shape[-1])
+
         # scale so that they land in the tile within the padded tile
         padding = (self.ptile_slen - self.tile_slen) / 2
         locs = locs * (self.tile_slen / self.ptile_slen) + (padding / self.ptile_slen)
@@ -542,20 +612,39 @@ class Tiler(nn.Module):
 
         :return: ptile = (n_ptiles x n_bands x slen x slen)
         """
+        n_ptiles = locs.shape[0]
         max_sources = locs.shape[1]
-        ptile_shape = (
-            sources.size(0),
-            sources.size(2),
-            self.ptile_slen,
-            self.ptile_slen,
-        )
-        ptile = torch.zeros(ptile_shape, device=locs.device)
-
-        for n in range(max_sources):
-            one_star = self.render_one_source(locs[:, n, :], sources[:, n])
-            ptile += one_star
+        assert sources.shape[:2] == locs.shape[:2]
+
+        # the source dimension is folded into the batch dimension so that all sources in
+        # a chunk of ptiles are rendered with a single call to F.grid_sample (only the
+        # rendering is batched, see `render.sum_sources`).
+        chunk_size = n_ptiles
+        if self.render_chunk_size is not None:
+            chunk_size = max(1, self.render_chunk_size // max_sources)
+
+        ptiles = []
+        for start in range(0, n_ptiles, chunk_size):
+            _locs = rearrange(locs[start : start + chunk_size], "np s xy -> (np s) xy", xy=2)
+            _sources = rearrange(sources[start : start + chunk_size], "np s b h w -> (np s) b h w")
+            rendered = self.render_one_source(_locs, _sources)
+            rendered = rearrange(rendered, "(np s) b h w -> np s b h w", s=max_sources)
+            ptiles.append(render.sum_sources(rendered))
+
+        return torch.cat(ptiles)
+
+    def get_source_fft(self, source):
+        """
+        :param source: is a (... x slen x slen) tensor.
+        :return: the rfft of the zero-padded source, shape = (... x fft_slen x fft_slen // 2 + 1)
+        """
+        fft_slen = source.shape[-1] + 2 * self.fft_padding
+        source_fft, _ = render.get_padded_fft(source, fft_slen, self.fft_padding)
+        return source_fft
 
-        return ptile
+    def render_tile_fft(self, locs, source_fft, source_slen, weights):
+        # see `render.render_tile_fft`.
+        return render.render_tile_fft(self, locs, source_fft, source_slen, weights)
 
     def fit_source_to_ptile(self, source):
         if self.ptile_slen >= source.shape[-1]:
@@ -635,6 +724,12 @@ class StarTileDecoder(nn.Module):
             self.normalization_constant[i] = 1 / psf_i.sum()
         self.normalization_constant = self.normalization_constant.detach()
 
+        # cache of the PSF fitted to a ptile (and of its spectrum if the tiler shifts sources
+        # with FFTs), recomputed only when `self.params` changes.
+        self._psf_cache = {}
+        self.psf_cache_hits = 0
+        self.psf_cache_misses = 0
+
     def forward(self, locs, fluxes, star_bool):
         # locs: is (n_ptiles x max_num_stars x 2)
         # fluxes: Is (n_ptiles x max_stars x n_bands)
@@ -652,6 +747,12 @@ class StarTileDecoder(nn.Module):
         assert fluxes.shape[2] == psf.shape[0] == self.n_bands
         assert star_bool.shape[2] == 1
 
+        if self.tiler.shift_engine == "fft":
+            # all stars are the same PSF, so only its (cached) spectrum needs to be shifted.
+            psf_fft = self._adjust_psf_fft()
+            weights = fluxes * star_bool
+            return self.tiler.render_tile_fft(locs, psf_fft, psf.shape[-1], weights)
+
         # all stars are just the PSF so we copy it.
         expanded_psf = psf.expand(n_ptiles, max_sources, self.n_bands, -1, -1)
         sources = expanded_psf * rearrange(fluxes, "np ms nb -> np ms nb 1 1")
@@ -714,6 +815,35 @@ class StarTileDecoder(nn.Module):
         )
 
     def _adjust_psf(self):
+        # returns the psf fitted to a ptile, cached until `self.params` changes.
+        # NOTE: the returned tensor might be shared, so it should not be modified in place.
+        return self._get_cached("psf", self._get_adjusted_psf)
+
+    def _adjust_psf_fft(self):
+        # spectrum of the psf fitted to a ptile, as used by `Tiler.render_tile_fft`.
+        return self._get_cached(
+            "psf_fft", lambda: self.tiler.get_source_fft(self._get_adjusted_psf())
+        )
+
+    def _get_cached(self, name, compute):
+        # in place updates bump the version counter of the tensor, moving it changes its storage.
+        # the cache is bypassed when gradients w.r.t. the psf params are needed (e.g. wake phase).
+        if torch.is_grad_enabled() and self.params.requires_grad:
+            return compute()
+
+        # pylint: disable=protected-access
+        key = (self.params.data_ptr(), self.params._version, self.params.device)
+        if name in self._psf_cache and self._psf_cache[name][0] == key:
+            self.psf_cache_hits += 1
+            return self._psf_cache[name][1]
+
+        self.psf_cache_misses += 1
+        with torch.no_grad():
+            value = compute()
+        self._psf_cache[name] = (key, value)
+        return value
+
+    def _get_adjusted_psf(self):
         # use power_law_psf and current psf parameters to forward and obtain fresh psf model.
         # first dimension of psf is number of bands
         # dimension of the psf/slen should be odd
@@ -736,13 +866,16 @@ class GalaxyTileDecoder(nn.Module):
         gal_slen,
         n_galaxy_params,
         autoencoder_ckpt,
+        render_chunk_size=None,
+        shift_engine="grid_sample",
     ):
         super().__init__()
         self.n_bands = n_bands
-        self.tiler = Tiler(tile_slen, ptile_slen)
+        self.tiler = Tiler(tile_slen, ptile_slen, render_chunk_size, shift_engine)
         self.ptile_slen = ptile_slen
 
         # load decoder after loading autoencoder from checkpoint.
+        self.autoencoder_ckpt = autoencoder_ckpt
         autoencoder = galaxy_net.OneCenteredGalaxyAE.load_from_checkpoint(autoencoder_ckpt)
         assert gal_slen == autoencoder.hparams.slen
         assert n_galaxy_params == autoencoder.hparams.latent_dim
@@ -753,7 +886,33 @@ class GalaxyTileDecoder(nn.Module):
         self.gal_slen = gal_slen
         self.n_galaxy_params = n_galaxy_params
 
-    def forward(self, locs, galaxy_params, galaxy_bool):
+        # (optional) output of the galaxy decoder for each latent of a fixed bank of latents,
+        # has shape (n_latents x n_bands x gal_slen x gal_slen), see `build_stamp_bank`.
+        self.register_buffer("stamp_bank", None, persistent=False)
+
+    def build_stamp_bank(self, latents, stamp_bank_file=None, batch_size=1000, latents_file=None):
+        # run the galaxy decoder once for each latent, so that galaxies can then be rendered
+        # with a gather instead of a forward pass. If `stamp_bank_file` (.npy) is given, the
+        # stamps are memory-mapped from it, and it is created first if it does not exist.
+        # A .json file next to it records the autoencoder and latents the bank was built from,
+        # and the bank is rebuilt if they do not match.
+        key = render.get_stamp_bank_key(self.autoencoder_ckpt, latents, latents_file)
+        stamps = render.load_stamp_bank(stamp_bank_file, key)
+        if stamps is None:
+            device = next(self.galaxy_decoder.parameters()).device
+            with torch.no_grad():
+                stamps = [
+                    self.galaxy_decoder(z.to(device)).cpu() for z in latents.split(batch_size)
+                ]
+            stamps = torch.cat(stamps)
+            if stamp_bank_file is not None:
+                stamps = render.save_stamp_bank(stamp_bank_file, stamps, key)
+
+        assert stamps.shape == (len(latents), self.n_bands, self.gal_slen, self.gal_slen)
+        # pylint: disable=attribute-defined-outside-init
+        self.stamp_bank = stamps.to(latents.device)
+
+    def forward(self, locs, galaxy_params, galaxy_bool, galaxy_indices=None):
         # max_sources obtained from locs, allows for more flexibility when rendering.
         n_ptiles = locs.shape[0]
         max_sources = locs.shape[1]
@@ -764,19 +923,14 @@ class GalaxyTileDecoder(nn.Module):
         assert galaxy_params.shape[2] == self.n_galaxy_params
         assert galaxy_bool.shape[2] == 1
 
-        single_galaxies, single_vars = self._render_single_galaxies(galaxy_params, galaxy_bool)
-
-        ptile = self.tiler.render_tile(
-            locs, single_galaxies * galaxy_bool.unsqueeze(-1).unsqueeze(-1)
-        )
-        var_ptile = self.tiler.render_tile(
-            locs, single_vars * galaxy_bool.unsqueeze(-1).unsqueeze(-1)
-        )
-
-        return ptile, var_ptile
+        single_galaxies = self._render_single_galaxies(galaxy_params, galaxy_bool, galaxy_indices)
 
-    def _render_single_galaxies(self, galaxy_params, galaxy_bool):
+        _galaxy_bool = rearrange(galaxy_bool, "np ms 1 -> np ms 1 1 1")
+        ptile = self.tiler.render_tile(locs, single_galaxies * _galaxy_bool)
+        # poisson approximation, the variance is the mean.
+        return ptile, ptile
 
+    def _render_single_galaxies(self, galaxy_params, galaxy_bool, galaxy_indices=None):
         # flatten parameters
         z = galaxy_params.view(-1, self.n_galaxy_params)
         b = galaxy_bool.flatten()
@@ -784,27 +938,24 @@ class GalaxyTileDecoder(nn.Module):
         # allocate memory
         _slen = self.ptile_slen + ((self.ptile_slen % 2) == 0) * 1
         gal = torch.zeros(z.shape[0], self.n_bands, _slen, _slen, device=galaxy_params.device)
-        var = torch.zeros(z.shape[0], self.n_bands, _slen, _slen, device=galaxy_params.device)
 
         # forward only galaxies that are on!
         # no background
-        gal_on = self.galaxy_decoder(z[b == 1])
-        var_on = gal_on  # poisson approximation, mean = var.
+        if galaxy_indices is None:
+            gal_on = self.galaxy_decoder(z[b == 1])
+        else:
+            # gather the precomputed output of the galaxy decoder instead.
+            assert self.stamp_bank is not None, "Stamp bank has not been built."
+            indices = galaxy_indices.flatten()[b == 1]
+            gal_on = self.stamp_bank[indices.to(self.stamp_bank.device)].to(z.device)
 
         # size the galaxy (either trims or crops to the size of ptile)
-        gal_on = self._size_galaxy(gal_on)
-        var_on = self._size_galaxy(var_on)
-
-        # set galaxies
-        gal[b == 1] = gal_on
-        var[b == 1] = var_on
+        # and set galaxies
+        gal[b == 1] = self._size_galaxy(gal_on)
 
         batchsize = galaxy_params.shape[0]
         gal_shape = (batchsize, -1, self.n_bands, gal.shape[-1], gal.shape[-1])
-        single_galaxies = gal.view(gal_shape)
-        single_vars = var.view(gal_shape)
-
-        return single_galaxies, single_vars
+        return gal.view(gal_shape)
 
     def _size_galaxy(self, galaxy):
         # galaxy should be shape n_galaxies x n_bands x galaxy_slen x galaxy_slen
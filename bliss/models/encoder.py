@@ -1,3 +1,5 @@
+import inspect
+
 import numpy as np
 from einops import rearrange, repeat
 
@@ -5,6 +7,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import categorical
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
+
+# newer versions of torch warn unless the kind of checkpointing is explicit.
+_CHECKPOINT_KWARGS = {}
+if "use_reentrant" in inspect.signature(checkpoint).parameters:
+    _CHECKPOINT_KWARGS["use_reentrant"] = True
 
 
 def get_mgrid(slen):
@@ -124,6 +133,39 @@ def get_full_params(tile_params: dict, slen: int, wlen: int = None):
     return params
 
 
+def checkpoint_chunk(fn, module, *args):
+    """Run `fn(*args)` without keeping its activations, which are recomputed in backward.
+
+    The (reentrant) checkpoint only backpropagates to the parameters of `fn` if one of its
+    inputs requires grad, so a dummy one is added. The running statistics of the batchnorms in
+    `module` are not updated again by the recomputation.
+    """
+    # pylint: disable=protected-access
+    batchnorms = [
+        m
+        for m in module.modules()
+        if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats
+    ]
+
+    def run(*inputs):
+        if not torch.is_grad_enabled():
+            return fn(*inputs[:-1])
+
+        # recomputation in the backward pass, with a momentum of 0 for the running statistics.
+        states = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in batchnorms]
+        for bn in batchnorms:
+            bn.momentum = 0.0
+        output = fn(*inputs[:-1])
+        with torch.no_grad():
+            for bn, (momentum, num_batches_tracked) in zip(batchnorms, states):
+                bn.momentum = momentum
+                bn.num_batches_tracked.copy_(num_batches_tracked)
+        return output
+
+    requires_grad = torch.ones((), requires_grad=True)
+    return checkpoint(run, *args, requires_grad, **_CHECKPOINT_KWARGS)
+
+
 def _argfront(is_on_array, dim):
     # return indices that sort pushing all zeroes of tensor to the back.
     # dim is dimension along which do the ordering.
@@ -138,6 +180,34 @@ def _sample_class_weights(class_weights, n_samples=1):
     return cat_rv.sample((n_samples,)).squeeze()
 
 
+def _fuse_linear_bn_eval(linear, bn):
+    # fold an eval-mode BatchNorm1d into the preceding linear layer.
+    assert not (linear.training or bn.training), "Fusion only for eval!"
+    fused_linear = nn.Linear(linear.in_features, linear.out_features).to(linear.weight.device)
+    with torch.no_grad():
+        scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+        fused_linear.weight.copy_(linear.weight * scale.unsqueeze(1))
+        fused_linear.bias.copy_((linear.bias - bn.running_mean) * scale + bn.bias)
+    return fused_linear
+
+
+def _fuse_sequential(layers):
+    # fold batchnorms into the preceding conv/linear layers and remove dropout.
+    fused_layers = []
+    for layer in layers:
+        if isinstance(layer, (nn.Dropout, nn.Dropout2d)):
+            continue
+        if isinstance(layer, nn.BatchNorm2d) and isinstance(fused_layers[-1], nn.Conv2d):
+            fused_layers[-1] = fuse_conv_bn_eval(fused_layers[-1], layer)
+        elif isinstance(layer, nn.BatchNorm1d) and isinstance(fused_layers[-1], nn.Linear):
+            fused_layers[-1] = _fuse_linear_bn_eval(fused_layers[-1], layer)
+        else:
+            if isinstance(layer, ConvBlock):
+                layer.fuse_for_inference()
+            fused_layers.append(layer)
+    return nn.Sequential(*fused_layers)
+
+
 def _loc_mean_func(x):
     return torch.sigmoid(x) * (x != 0).float()
 
@@ -164,6 +234,8 @@ class ConvBlock(nn.Module):
         self.drop1 = nn.Dropout2d(dropout)
         self.conv2 = nn.Conv2d(out_channel, out_channel, kernel_size=3, padding=1)
         self.bn2 = nn.BatchNorm2d(out_channel)
+        # the residual connection can also add quantized tensors (see `bliss.quantize`).
+        self.skip_add = nn.quantized.FloatFunctional()
 
     def forward(self, x):
         identity = x
@@ -179,10 +251,19 @@ class ConvBlock(nn.Module):
         if self.downsample:
             identity = self.sc_bn(self.sc_conv(identity))
 
-        out = x + identity
+        out = self.skip_add.add(x, identity)
         out = F.relu(out)
         return out
 
+    def fuse_for_inference(self):
+        # fold the batchnorms into the convolutions and remove dropout (eval mode only).
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn1, self.bn2, self.drop1 = nn.Identity(), nn.Identity(), nn.Identity()
+        if self.downsample:
+            self.sc_conv = fuse_conv_bn_eval(self.sc_conv, self.sc_bn)
+            self.sc_bn = nn.Identity()
+
 
 class EncoderCNN(nn.Module):
     def __init__(self, n_bands, channel, dropout):
@@ -225,6 +306,8 @@ class ImageEncoder(nn.Module):
         spatial_dropout=0,
         dropout=0,
         hidden=128,
+        fully_convolutional=False,
+        max_ptiles_mb=None,
     ):
         """
         This class implements the source encoder, which is supposed to take in a synthetic image of
@@ -237,6 +320,13 @@ class ImageEncoder(nn.Module):
         n_bands (int): number of bands
         max_detections (int): Number of maximum detections in a single tile.
         n_galaxy_params (int): Number of latent dimensions in the galaxy AE network.
+        fully_convolutional (bool): Run the CNN once on full images and read the features of each
+                           padded tile off its output (see `encode`), instead of running
+                           it on each padded tile. The methods taking padded tiles
+                           (`forward`, `tile_map_n_sources`, ...) are then not available.
+        max_ptiles_mb (float): If not None, cap (in MB) on the padded tiles extracted at once
+                           from full images, in training (with checkpointing) and in
+                           inference (see `map_images_in_tiles`).
 
         """
         super().__init__()
@@ -248,9 +338,17 @@ class ImageEncoder(nn.Module):
         assert tile_slen <= ptile_slen
         assert border_padding % 1 == 0, "amount of border padding should be an integer"
         self.border_padding = int(border_padding)
+        self.fully_convolutional = fully_convolutional
+        self.max_ptiles_mb = max_ptiles_mb
+        if fully_convolutional:
+            # the CNN downsamples twice by 2, so tiles need to be aligned with its features.
+            assert tile_slen % 4 == 0, "fully convolutional encoder needs tile_slen % 4 == 0"
 
         # cache the weights used for the tiling convolution
 
+        # channels of the first (full resolution) layers of the CNN, kept here because the
+        # layers themselves are replaced when the CNN is fused or quantized.
+        self.channel = channel
         self.enc_conv = EncoderCNN(n_bands, channel, spatial_dropout)
 
         # Number of variational parameters used to characterize each source in an image.
@@ -267,6 +365,7 @@ class ImageEncoder(nn.Module):
             + self.max_detections
         )
         dim_enc_conv_out = ((self.ptile_slen + 1) // 2 + 1) // 2
+        self.dim_enc_conv_out = dim_enc_conv_out
         self.enc_final = nn.Sequential(
             nn.Flatten(1),
             nn.Linear(channel * 4 * dim_enc_conv_out ** 2, hidden),
@@ -297,6 +396,21 @@ class ImageEncoder(nn.Module):
 
         # misc
         self.register_buffer("swap", torch.tensor([1, 0]), persistent=False)
+        self.channels_last = False
+
+    def optimize_for_inference(self, channels_last=False):
+        """Fuse batchnorms into the preceding conv/linear layers and remove dropout.
+
+        The encoder is put in eval mode and should not be trained afterwards. Optionally, the
+        convolutions use the channels_last memory format (faster on some GPUs).
+        """
+        self.eval()
+        self.enc_conv.layer = _fuse_sequential(self.enc_conv.layer)
+        self.enc_final = _fuse_sequential(self.enc_final)
+        self.channels_last = channels_last
+        if channels_last:
+            self.enc_conv.to(memory_format=torch.channels_last)
+        return self
 
     def get_images_in_tiles(self, images):
         """
@@ -309,6 +423,73 @@ class ImageEncoder(nn.Module):
         tiles = rearrange(tiles, "b (c h w) n -> (b n) c h w", c=self.n_bands, h=window, w=window)
         return tiles
 
+    def iter_image_chunks(self, images):
+        """Yields consecutive chunks of `images` (whole images, or else rows of tiles with their
+        border padding) whose padded tiles take at most `self.max_ptiles_mb` MB each.
+        """
+        if self.max_ptiles_mb is None:
+            yield images
+            return
+
+        batch_size, n_bands, height, width = images.shape
+        n_tiles_h = (height - 2 * self.border_padding) // self.tile_slen
+        n_tiles_w = (width - 2 * self.border_padding) // self.tile_slen
+        ptile_bytes = images.element_size() * n_bands * self.ptile_slen ** 2
+        max_ptiles = max(1, int(self.max_ptiles_mb * 2 ** 20 // ptile_bytes))
+
+        if max_ptiles >= n_tiles_h * n_tiles_w:
+            n_images = max_ptiles // (n_tiles_h * n_tiles_w)
+            for i in range(0, batch_size, n_images):
+                yield images[i : i + n_images]
+            return
+
+        n_rows = max(1, max_ptiles // n_tiles_w)
+        for i in range(batch_size):
+            for row in range(0, n_tiles_h, n_rows):
+                end_row = min(row + n_rows, n_tiles_h)
+                yield images[
+                    i : i + 1,
+                    :,
+                    row * self.tile_slen : end_row * self.tile_slen + 2 * self.border_padding,
+                ]
+
+    def iter_images_in_tiles(self, images):
+        # same as `get_images_in_tiles`, but yields the padded tiles of each `iter_image_chunks`.
+        for chunk in self.iter_image_chunks(images):
+            yield self.get_images_in_tiles(chunk)
+
+    def map_images_in_tiles(self, fn, images, *tile_args, module=None):
+        """Concatenate `fn(image_ptiles, *args)` over the padded tiles of each chunk of `images`
+        (see `iter_image_chunks`), where `args` are the rows of `tile_args` for those tiles.
+
+        With gradients enabled, each chunk is checkpointed (see `checkpoint_chunk`): its padded
+        tiles and activations are recomputed in the backward pass instead of being kept, so that
+        only one chunk of them is in memory at a time. The buffers of `module` (by default the
+        encoder) are only updated once per chunk, but batchnorm statistics are per chunk.
+        """
+        module = self if module is None else module
+        chunks = list(self.iter_image_chunks(images))
+        if len(chunks) == 1:
+            return fn(self.get_images_in_tiles(images), *tile_args)
+
+        def run_chunk(chunk, *args):
+            return fn(self.get_images_in_tiles(chunk), *args)
+
+        outputs = []
+        start = 0
+        for chunk in chunks:
+            n_tiles_h = (chunk.shape[-2] - 2 * self.border_padding) // self.tile_slen
+            n_tiles_w = (chunk.shape[-1] - 2 * self.border_padding) // self.tile_slen
+            end = start + chunk.shape[0] * n_tiles_h * n_tiles_w
+            args = [tile_arg[start:end] for tile_arg in tile_args]
+            if torch.is_grad_enabled():
+                outputs.append(checkpoint_chunk(run_chunk, module, chunk, *args))
+            else:
+                outputs.append(run_chunk(chunk, *args))
+            start = end
+        assert all(tile_arg.shape[0] == start for tile_arg in tile_args)
+        return torch.cat(outputs)
+
     def center_ptiles(self, image_ptiles, tile_locs):
         # assume there is at most one source per tile
         # return a centered version of sources in tiles using their true locations in tiles.
@@ -409,15 +590,53 @@ class ImageEncoder(nn.Module):
         )
         return var_param
 
-    def get_var_params_all(self, image_ptiles):
+    def get_var_params_all(self, image_ptiles, image_min=None):
         # get h matrix.
+        # a fully convolutional encoder only encodes full images (see `encode`), its CNN would
+        # not see the same context on isolated padded tiles.
+        assert not self.fully_convolutional, "fully convolutional encoder, use `encode` instead."
+        # `image_min` replaces the minimum of `image_ptiles` in the log transform, e.g. to encode
+        # chunks of a large image consistently.
         # Forward to the layer that is shared by all n_sources.
-        log_img = torch.log(image_ptiles - image_ptiles.min() + 1.0)
+        image_min = image_ptiles.min() if image_min is None else image_min
+        log_img = torch.log(image_ptiles - image_min + 1.0)
+        if self.channels_last:
+            log_img = log_img.contiguous(memory_format=torch.channels_last)
         h = self.enc_conv(log_img)
 
         # Concatenate all output parameters for all possible n_sources
         return self.enc_final(h)
 
+    def encode(self, images, image_min=None):
+        """Get h matrix (n_ptiles x dim_out_all) for all padded tiles of a batch of full images.
+
+        If `fully_convolutional`, the CNN runs once on the full images and the features of each
+        padded tile are a window of its output (with stride tile_slen / 4), so that overlapping
+        padded tiles share the computation.
+        """
+        image_min = images.min() if image_min is None else image_min
+        if not self.fully_convolutional:
+            return self.map_images_in_tiles(
+                lambda image_ptiles: self.get_var_params_all(image_ptiles, image_min), images
+            )
+
+        log_img = torch.log(images - image_min + 1.0)
+        if self.channels_last:
+            log_img = log_img.contiguous(memory_format=torch.channels_last)
+        features = self.enc_conv(log_img)
+
+        # feature i of the output is centered on pixel 4 * i of the image.
+        n_tiles_h = (images.shape[-2] - 2 * self.border_padding) // self.tile_slen
+        n_tiles_w = (images.shape[-1] - 2 * self.border_padding) // self.tile_slen
+        window = self.dim_enc_conv_out
+        stride = self.tile_slen // 4
+        features = features[
+            :, :, : (n_tiles_h - 1) * stride + window, : (n_tiles_w - 1) * stride + window
+        ]
+        ftiles = F.unfold(features, kernel_size=window, stride=stride)
+        ftiles = rearrange(ftiles, "b (c h w) n -> (b n) c h w", h=window, w=window)
+        return self.enc_final(ftiles)
+
     def _get_var_params_for_n_sources(self, h, n_sources):
         """
         Args:
@@ -463,7 +682,9 @@ class ImageEncoder(nn.Module):
         assert image_ptiles.shape[0] == tile_n_sources_sampled.shape[1]
         # h.shape = (n_ptiles x self.dim_out_all)
         h = self.get_var_params_all(image_ptiles)
+        return self._get_var_params_from_h(h, tile_n_sources_sampled)
 
+    def _get_var_params_from_h(self, h, tile_n_sources_sampled):
         # get probability of params except n_sources
         # e.g. loc_mean: shape = (n_samples x n_ptiles x max_detections x len(x,y))
         var_params = self._get_var_params_for_n_sources(h, tile_n_sources_sampled)
@@ -486,11 +707,21 @@ class ImageEncoder(nn.Module):
         var_params = {key: value.squeeze(0) for key, value in var_params.items()}
         return var_params
 
+    def forward_images(self, images, tile_n_sources):
+        # same as `forward` but on all the padded tiles of a batch of full images (see `encode`).
+        # tile_n_sources shape = (n_ptiles)
+        assert len(tile_n_sources.shape) == 1
+        tile_n_sources = tile_n_sources.clamp(max=self.max_detections).unsqueeze(0)
+        h = self.encode(images)
+        assert h.shape[0] == tile_n_sources.shape[1]
+        var_params = self._get_var_params_from_h(h, tile_n_sources)
+        var_params = {key: value.squeeze(0) for key, value in var_params.items()}
+        return var_params
+
     def sample_encoder(self, images, n_samples):
         assert len(images.shape) == 4
         assert images.shape[0] == 1, "Only works for 1 image"
-        image_ptiles = self.get_images_in_tiles(images)
-        h = self.get_var_params_all(image_ptiles)
+        h = self.encode(images)
         log_probs_n_sources_per_tile = self._get_logprob_n_from_var_params(h)
 
         # sample number of sources.
@@ -503,7 +734,7 @@ class ImageEncoder(nn.Module):
         tile_is_on_array = tile_is_on_array.unsqueeze(-1).float()
 
         # get var_params conditioned on n_sources
-        pred = self.forward_sampled(image_ptiles, tile_n_sources)
+        pred = self._get_var_params_from_h(h, tile_n_sources)
 
         # other quantities based on var_params
         # tile_galaxy_bool shape = (n_samples x n_ptiles x max_detections x 1)
@@ -580,18 +811,34 @@ class ImageEncoder(nn.Module):
         tile_n_sources = torch.argmax(log_probs_n_sources_per_tile, dim=1)
         return tile_n_sources
 
-    def tile_map_estimate(self, images):
+    def tile_map_inference_images(self, images, image_min=None):
+        # runs the encoder network only once on all the padded tiles of `images` (see `encode`)
+        # and returns a tuple with:
+        #   tile_n_sources: MAP estimate of the number of sources, shape = (n_ptiles)
+        #   var_params: variational params conditioned on tile_n_sources (same as `forward`)
+        #   tile_estimate: MAP estimate of tile parameters (same as `tile_map_estimate`)
+        h = self.encode(images, image_min)
+        return self._tile_map_inference_from_h(h, images.shape[0])
 
-        # extract image_ptiles
-        batch_size = images.shape[0]
-        image_ptiles = self.get_images_in_tiles(images)
-        n_tiles_per_image = int(image_ptiles.shape[0] / batch_size)
+    def _tile_map_inference_from_h(self, h, batch_size):
+        n_tiles_per_image = int(h.shape[0] / batch_size)
 
         # MAP (for n_sources) prediction on var params on each tile
-        tile_n_sources = self.tile_map_n_sources(image_ptiles)
-        pred = self(image_ptiles, tile_n_sources)
+        n_source_log_probs = self._get_logprob_n_from_var_params(h)
+        tile_n_sources = torch.argmax(n_source_log_probs, dim=1)
+        _tile_n_sources = tile_n_sources.clamp(max=self.max_detections).unsqueeze(0)
+        var_params = self._get_var_params_for_n_sources(h, _tile_n_sources)
+        var_params = {key: value.squeeze(0) for key, value in var_params.items()}
+        var_params["n_source_log_probs"] = n_source_log_probs
 
-        return self.tile_map_estimate_from_var_params(pred, n_tiles_per_image, batch_size)
+        tile_estimate = self.tile_map_estimate_from_var_params(
+            var_params, n_tiles_per_image, batch_size
+        )
+        return tile_n_sources, var_params, tile_estimate
+
+    def tile_map_estimate(self, images):
+        _, _, tile_estimate = self.tile_map_inference_images(images)
+        return tile_estimate
 
     def map_estimate(self, images, slen: int, wlen: int = None):
         # return full estimate of parameters in full image.
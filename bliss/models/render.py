@@ -0,0 +1,353 @@
+"""Rendering helpers used by `bliss.models.decoder`.
+
+Sub-pixel shifts with the Fourier shift theorem, rendering of only the sources that are on
+('sparse' and 'global' render modes), and the on-disk bank of decoded galaxy stamps.
+"""
+import hashlib
+import json
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.fft
+import torch.nn.functional as F
+from einops import rearrange, repeat
+
+from .encoder import get_is_on_from_n_sources
+
+
+def get_padded_fft(source, fft_slen, padding):
+    # zero-pad the last two dimensions of source to (at least) fft_slen, with `padding` pixels
+    # before the source, and return its rfft. The padded size is made odd so that there is
+    # no Nyquist frequency, whose phase is ambiguous for sub-pixel shifts.
+    fft_slen += (fft_slen % 2) == 0
+    source_slen = source.shape[-1]
+    after = fft_slen - source_slen - padding
+    assert after >= 0
+    padded_source = F.pad(source, (padding, after, padding, after))
+    return torch.fft.rfftn(padded_source, dim=(-2, -1)), fft_slen
+
+
+def fft_shift(source_fft, shifts, fft_slen):
+    """Shift images by (sub-pixel) amounts using the Fourier shift theorem.
+
+    :param source_fft: is (n or 1 x n_bands x fft_slen x fft_slen // 2 + 1), see `get_padded_fft`.
+    :param shifts: is (n x 2), shift in pixels along rows and columns respectively.
+    :return: the shifted images, shape = (n x n_bands x fft_slen x fft_slen)
+    """
+    device = shifts.device
+    freqs = torch.arange(fft_slen, device=device, dtype=shifts.dtype)
+    row_freqs = torch.where(freqs > fft_slen // 2, freqs - fft_slen, freqs) / fft_slen
+    col_freqs = freqs[: fft_slen // 2 + 1] / fft_slen
+
+    # the phase ramp exp(-2 pi i (k1 x1 + k2 x2)) is separable along rows and columns.
+    row_phase = rearrange(shifts[:, 0], "n -> n 1") * row_freqs * (-2 * np.pi)
+    col_phase = rearrange(shifts[:, 1], "n -> n 1") * col_freqs * (-2 * np.pi)
+    row_ramp = torch.view_as_complex(torch.stack((row_phase.cos(), row_phase.sin()), dim=-1))
+    col_ramp = torch.view_as_complex(torch.stack((col_phase.cos(), col_phase.sin()), dim=-1))
+    ramp = rearrange(row_ramp, "n h -> n 1 h 1") * rearrange(col_ramp, "n w -> n 1 1 w")
+
+    shifted_fft = source_fft * ramp
+    return torch.fft.irfftn(shifted_fft, s=(fft_slen, fft_slen), dim=(-2, -1))
+
+
+def render_one_source_fft(tiler, locs, source_fft, source_slen):
+    """
+    :param tiler: the `Tiler` whose ptiles the sources are rendered on.
+    :param locs: is n_ptiles x len((x,y))
+    :param source_fft: is a (n_ptiles or 1, n_bands, fft_slen, fft_slen // 2 + 1) tensor,
+                    the output of `Tiler.get_source_fft` for sources of side-length `source_slen`.
+    :return: shape = (n_ptiles x n_bands x ptile_slen x ptile_slen)
+    """
+    assert locs.shape[1] == 2
+    fft_slen = source_slen + 2 * tiler.fft_padding
+    fft_slen += (fft_slen % 2) == 0
+
+    # shift (in pixels) from the center of the source to its location in the ptile.
+    padding = (tiler.ptile_slen - tiler.tile_slen) / 2
+    shifts = padding + locs * tiler.tile_slen - 0.5 - (source_slen - 1) / 2
+
+    shifted = fft_shift(source_fft, shifts, fft_slen)
+    start, end = tiler.fft_padding, tiler.fft_padding + tiler.ptile_slen
+    return shifted[:, :, start:end, start:end]
+
+
+def render_tile_fft(tiler, locs, source_fft, source_slen, weights):
+    """
+    Render copies of a single source (e.g. the psf) scaled by `weights` (e.g. fluxes).
+
+    :param tiler: the `Tiler` whose ptiles the sources are rendered on.
+    :param locs: is (n_ptiles x max_num_stars x 2)
+    :param source_fft: is (n_bands x fft_slen x fft_slen // 2 + 1), see `Tiler.get_source_fft`.
+    :param weights: is (n_ptiles x max_num_stars x n_bands)
+
+    :return: ptile = (n_ptiles x n_bands x slen x slen)
+    """
+    n_ptiles = locs.shape[0]
+    max_sources = locs.shape[1]
+    assert weights.shape[:2] == locs.shape[:2]
+
+    chunk_size = n_ptiles
+    if tiler.render_chunk_size is not None:
+        chunk_size = max(1, tiler.render_chunk_size // max_sources)
+
+    ptiles = []
+    for start in range(0, n_ptiles, chunk_size):
+        _locs = rearrange(locs[start : start + chunk_size], "np s xy -> (np s) xy", xy=2)
+        _weights = rearrange(weights[start : start + chunk_size], "np s b -> np s b 1 1")
+        rendered = render_one_source_fft(tiler, _locs, source_fft.unsqueeze(0), source_slen)
+        rendered = rearrange(rendered, "(np s) b h w -> np s b h w", s=max_sources)
+        rendered = rendered * _weights
+        ptiles.append(sum_sources(rendered))
+
+    return torch.cat(ptiles)
+
+
+def sum_sources(rendered):
+    # sum of the (n_ptiles x max_sources x n_bands x slen x slen) rendered sources over sources.
+    # they are added one at a time, in the same order as rendering each source separately,
+    # since `rendered.sum(1)` accumulates in another order (float rounding) for > 4 sources.
+    ptile = torch.zeros_like(rendered[:, 0])
+    for n in range(rendered.shape[1]):
+        ptile += rendered[:, n]
+    return ptile
+
+
+def render_ptiles_sparse(
+    image_decoder,
+    locs,
+    galaxy_bool,
+    galaxy_params,
+    fluxes,
+    star_bool,
+    galaxy_indices=None,
+    render_var=True,
+):
+    # only render the (ptile, source) slots that contain a star or galaxy,
+    # then scatter the rendered sources back into their ptiles.
+    # all inputs are flattened so that the first dimension is n_ptiles.
+
+    # returns ptiles with shape = (n_ptiles x n_bands x ptile_slen x ptile_slen)
+    n_ptiles = locs.shape[0]
+    ptile_slen = image_decoder.ptile_slen
+    ptile_shape = (n_ptiles, image_decoder.n_bands, ptile_slen, ptile_slen)
+    images = torch.zeros(ptile_shape, device=locs.device)
+    var_images = torch.zeros(ptile_shape, device=locs.device) if render_var else None
+
+    # every source on is rendered on its own ptile, so max_sources = 1 below.
+    # p: n_ptiles, s: max_sources
+    _locs = rearrange(locs, "p s xy -> (p s) 1 xy", xy=2)
+    _star_bool = rearrange(star_bool, "p s 1 -> (p s)").bool()
+    _galaxy_bool = rearrange(galaxy_bool, "p s 1 -> (p s)").bool()
+    _ptile_indx = torch.arange(n_ptiles, device=locs.device)
+    _ptile_indx = _ptile_indx.repeat_interleave(locs.shape[1])
+
+    star_indx = _star_bool.nonzero(as_tuple=True)[0]
+    if len(star_indx) > 0:
+        star_fluxes = rearrange(fluxes, "p s band -> (p s) 1 band")[star_indx]
+        star_on = torch.ones(len(star_indx), 1, 1, device=locs.device)
+        stars = image_decoder.star_tile_decoder(_locs[star_indx], star_fluxes, star_on)
+        images.index_add_(0, _ptile_indx[star_indx], stars)
+
+    galaxy_indx = _galaxy_bool.nonzero(as_tuple=True)[0]
+    if image_decoder.galaxy_tile_decoder is not None and len(galaxy_indx) > 0:
+        _galaxy_params = rearrange(galaxy_params, "p s d -> (p s) 1 d")[galaxy_indx]
+        galaxy_on = torch.ones(len(galaxy_indx), 1, 1, device=locs.device)
+        _galaxy_indices = None
+        if galaxy_indices is not None:
+            _galaxy_indices = rearrange(galaxy_indices, "p s 1 -> (p s) 1 1")[galaxy_indx]
+        galaxies, galaxy_vars = image_decoder.galaxy_tile_decoder(
+            _locs[galaxy_indx], _galaxy_params, galaxy_on, _galaxy_indices
+        )
+        images.index_add_(0, _ptile_indx[galaxy_indx], galaxies)
+        if render_var:
+            var_images.index_add_(0, _ptile_indx[galaxy_indx], galaxy_vars)
+
+    return images, var_images
+
+
+def render_images_global(
+    image_decoder,
+    n_sources,
+    locs,
+    galaxy_bool,
+    galaxy_params,
+    fluxes,
+    galaxy_indices=None,
+    render_var=True,
+):
+    # render one stamp per source that is on directly at its position in the full image,
+    # instead of rendering (mostly empty) padded tiles and then overlap-adding them.
+    # returns images of shape (batch_size x n_bands x padded_slen x padded_slen)
+    # where padded_slen = slen + 2 * border_padding, and their variance (None if not
+    # `render_var`).
+    # pylint: disable=protected-access
+    tile_slen = image_decoder.tile_slen
+    border_padding = image_decoder.border_padding
+    batch_size = n_sources.shape[0]
+    n_tiles_per_image = n_sources.shape[1]
+    max_sources = locs.shape[2]
+    n_tiles1 = np.sqrt(n_tiles_per_image)
+    assert n_tiles1 % 1 == 0
+    n_tiles1 = int(n_tiles1)
+    padded_slen = n_tiles1 * tile_slen + 2 * border_padding
+
+    # b: batch, t: n_tiles_per_image, s: max_sources
+    is_on_array = get_is_on_from_n_sources(n_sources, max_sources)
+    _is_on_array = rearrange(is_on_array, "b t s -> (b t s)")
+    _galaxy_bool = rearrange(galaxy_bool, "b t s 1 -> (b t s)")
+    _star_bool = (1 - _galaxy_bool) * _is_on_array
+
+    # pixel coordinates (row, col) of each source in the padded full image,
+    # following the same convention as rendering on ptiles (pixel centers are integers).
+    tile_coords = torch.cartesian_prod(
+        torch.arange(n_tiles1, device=locs.device), torch.arange(n_tiles1, device=locs.device)
+    )
+    tile_coords = repeat(tile_coords, "t xy -> b t s xy", b=batch_size, s=max_sources)
+    centers = (tile_coords + locs) * tile_slen + border_padding - 0.5
+    centers = rearrange(centers, "b t s xy -> (b t s) xy", xy=2)
+    image_indx = torch.arange(batch_size, device=locs.device)
+    image_indx = image_indx.repeat_interleave(n_tiles_per_image * max_sources)
+
+    canvas_shape = (batch_size, image_decoder.n_bands, padded_slen, padded_slen)
+    images = torch.zeros(canvas_shape, device=locs.device)
+    var_images = torch.zeros(canvas_shape, device=locs.device) if render_var else None
+    stamp_kwargs = {
+        "render_chunk_size": image_decoder.render_chunk_size,
+        "shift_engine": image_decoder.shift_engine,
+    }
+
+    star_indx = _star_bool.nonzero(as_tuple=True)[0]
+    if len(star_indx) > 0:
+        psf = image_decoder.star_tile_decoder._adjust_psf()
+        star_fluxes = rearrange(fluxes, "b t s band -> (b t s) band")[star_indx]
+        stamps = psf.unsqueeze(0) * rearrange(star_fluxes, "ns band -> ns band 1 1")
+        add_stamps(images, stamps, centers[star_indx], image_indx[star_indx], **stamp_kwargs)
+
+    galaxy_indx = _galaxy_bool.nonzero(as_tuple=True)[0]
+    if image_decoder.galaxy_tile_decoder is not None and len(galaxy_indx) > 0:
+        _galaxy_params = rearrange(galaxy_params, "b t s d -> (b t s) 1 d")[galaxy_indx]
+        galaxy_on = torch.ones(len(galaxy_indx), 1, 1, device=locs.device)
+        _galaxy_indices = None
+        if galaxy_indices is not None:
+            _galaxy_indices = rearrange(galaxy_indices, "b t s 1 -> (b t s) 1 1")[galaxy_indx]
+        galaxies = image_decoder.galaxy_tile_decoder._render_single_galaxies(
+            _galaxy_params, galaxy_on, _galaxy_indices
+        )
+        # the galaxies are also the variance (poisson approximation, mean = var).
+        galaxy_images = var_images
+        if galaxy_images is None:
+            galaxy_images = torch.zeros(canvas_shape, device=locs.device)
+        add_stamps(
+            galaxy_images,
+            galaxies[:, 0],
+            centers[galaxy_indx],
+            image_indx[galaxy_indx],
+            **stamp_kwargs,
+        )
+        images += galaxy_images
+
+    return images, var_images
+
+
+def add_stamps(
+    images, stamps, centers, image_indx, render_chunk_size=None, shift_engine="grid_sample"
+):
+    # images: (batch_size x n_bands x slen x slen) canvas to which stamps are added (in place).
+    # stamps: (n_stamps x n_bands x stamp_slen x stamp_slen) centered sources (odd size).
+    # centers: (n_stamps x 2) pixel coordinates (row, col) of the stamp centers in images.
+    # image_indx: (n_stamps,) index of the image each stamp belongs to.
+    batch_size, n_bands, slen, _ = images.shape
+    stamp_slen = stamps.shape[-1]
+    assert stamp_slen % 2 == 1, "stamps should have odd size."
+    n_stamps = stamps.shape[0]
+
+    # each stamp is shifted by the sub-pixel part of its center onto a window with one
+    # extra pixel (to keep all the flux), then added at the integer part of its center.
+    window_slen = stamp_slen + 1
+    pixel_centers = torch.floor(centers)
+    offsets = centers - pixel_centers
+    corners = pixel_centers.long() - (stamp_slen - 1) // 2
+
+    # pad the canvas so that windows never fall outside of it.
+    margin = window_slen
+    canvas_slen = slen + 2 * margin
+    canvas = torch.zeros(batch_size * canvas_slen * canvas_slen, n_bands, device=images.device)
+
+    window = torch.arange(window_slen, device=images.device)
+    chunk_size = n_stamps if render_chunk_size is None else render_chunk_size
+    for start in range(0, n_stamps, chunk_size):
+        end = start + chunk_size
+
+        if shift_engine == "fft":
+            # pad by 2 pixels on each side so that the shifted stamps do not wrap around.
+            stamps_fft, fft_slen = get_padded_fft(stamps[start:end], window_slen + 4, 2)
+            shifted = fft_shift(stamps_fft, offsets[start:end], fft_slen)
+            shifted = shifted[:, :, 2 : 2 + window_slen, 2 : 2 + window_slen]
+        else:
+            # coordinates (in units of stamp pixels) at which to sample the stamps,
+            # normalized to [-1, 1] as expected by F.grid_sample.
+            coords = rearrange(window, "w -> 1 w 1")
+            coords = coords - rearrange(offsets[start:end], "n xy -> n 1 xy")
+            coords = coords * 2 / (stamp_slen - 1) - 1
+            grid = torch.stack(
+                (
+                    repeat(coords[..., 1], "n w2 -> n w1 w2", w1=window_slen),
+                    repeat(coords[..., 0], "n w1 -> n w1 w2", w2=window_slen),
+                ),
+                dim=-1,
+            )
+            shifted = F.grid_sample(stamps[start:end], grid, align_corners=True)
+
+        # linear indices of each window pixel in the flattened canvas.
+        rows = rearrange(corners[start:end, 0], "n -> n 1") + window + margin
+        cols = rearrange(corners[start:end, 1], "n -> n 1") + window + margin
+        indx = rearrange(image_indx[start:end], "n -> n 1 1") * canvas_slen ** 2
+        indx = indx + rearrange(rows, "n w -> n w 1") * canvas_slen
+        indx = indx + rearrange(cols, "n w -> n 1 w")
+        canvas.index_add_(0, indx.flatten(), rearrange(shifted, "n band w1 w2 -> (n w1 w2) band"))
+
+    canvas = rearrange(
+        canvas, "(b h w) band -> b band h w", b=batch_size, h=canvas_slen, w=canvas_slen
+    )
+    images += canvas[:, :, margin : margin + slen, margin : margin + slen]
+
+
+def get_stamp_bank_key(autoencoder_ckpt, latents, latents_file=None):
+    # identifies the autoencoder checkpoint and latents used to build a stamp bank.
+    autoencoder_sha256 = hashlib.sha256()
+    with open(autoencoder_ckpt, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            autoencoder_sha256.update(block)
+    latents_sha256 = hashlib.sha256(latents.detach().cpu().numpy().tobytes())
+    return {
+        "autoencoder_ckpt": str(autoencoder_ckpt),
+        "autoencoder_sha256": autoencoder_sha256.hexdigest(),
+        "latents_file": None if latents_file is None else str(latents_file),
+        "latents_sha256": latents_sha256.hexdigest(),
+    }
+
+
+def load_stamp_bank(stamp_bank_file, key):
+    # memory-map the stamps saved in `stamp_bank_file` (.npy), returns None if it does not
+    # exist or if the .json file next to it does not match `key` (see `get_stamp_bank_key`).
+    if stamp_bank_file is None or not Path(stamp_bank_file).exists():
+        return None
+    key_file = Path(stamp_bank_file).with_suffix(".json")
+    saved_key = json.loads(key_file.read_text()) if key_file.exists() else {}
+    hashes = ("autoencoder_sha256", "latents_sha256")
+    if not all(saved_key.get(name) == key[name] for name in hashes):
+        warnings.warn(
+            f"Rebuilding {stamp_bank_file}, which was not built from the same "
+            "autoencoder checkpoint and latents."
+        )
+        return None
+    return torch.from_numpy(np.load(stamp_bank_file, mmap_mode="c"))
+
+
+def save_stamp_bank(stamp_bank_file, stamps, key):
+    # save the stamps along with their key, and return them memory-mapped from disk.
+    np.save(stamp_bank_file, stamps.numpy())
+    Path(stamp_bank_file).with_suffix(".json").write_text(json.dumps(key, indent=2))
+    return torch.from_numpy(np.load(stamp_bank_file, mmap_mode="c"))
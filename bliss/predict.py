@@ -1,83 +1,623 @@
+import json
+import logging
+import multiprocessing as mp
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+
+import numpy as np
 import torch
-from omegaconf import DictConfig
+from torch import nn
+from omegaconf import DictConfig, OmegaConf
 from einops import rearrange
 
 from bliss.datasets import sdss
-from bliss import sleep
+from bliss import quantize, sleep
 
 _models = [sleep.SleepPhase]
 models = {cls.__name__: cls for cls in _models}
 
+logger = logging.getLogger(__name__)
 
-def predict(cfg: DictConfig):
-    bands = list(cfg.predict.bands)
-    assert isinstance(bands, list) and len(bands) == 1, "Only 1 band supported"
 
-    sdss_obj = sdss.SloanDigitalSkySurvey(**cfg.predict.sdss_kwargs)
+def get_n_tiles(image_shape, tile_slen, border_padding):
+    # number of tiles (with a full border of padding) along each dimension of an image.
+    n_tiles_h = (image_shape[-2] - 2 * border_padding) // tile_slen
+    n_tiles_w = (image_shape[-1] - 2 * border_padding) // tile_slen
+    assert n_tiles_h > 0 and n_tiles_w > 0, "image is too small."
+    return n_tiles_h, n_tiles_w
+
+
+def get_chunk_windows(n_tiles, chunk_tiles):
+    """Split `n_tiles` tiles along one dimension into windows of (at most) `chunk_tiles` tiles.
+
+    Returns a list of tuples (start, keep, end) in units of tiles. Each window covers tiles
+    [start, end) but only tiles [keep, end) are kept. The last window is shifted back so that all
+    windows have the same size, and `keep` avoids counting the overlapping tiles twice.
+    """
+    assert n_tiles > 0 and chunk_tiles > 0
+    chunk_tiles = min(chunk_tiles, n_tiles)
+    windows = []
+    for keep in range(0, n_tiles, chunk_tiles):
+        end = min(keep + chunk_tiles, n_tiles)
+        windows.append((end - chunk_tiles, keep, end))
+    return windows
+
+
+def get_batch_chunks(image_encoder, n_tiles_per_chunk, memory_budget):
+    """Number of chunks of `n_tiles_per_chunk` tiles to encode at once within `memory_budget` MB.
+
+    The peak memory of the encoder is roughly the padded tiles plus a few feature maps of the
+    first (full resolution) layers of the CNN.
+    """
+    channel = image_encoder.channel
+    n_floats_per_ptile = image_encoder.ptile_slen ** 2 * (image_encoder.n_bands + 4 * channel)
+    bytes_per_chunk = 4 * n_floats_per_ptile * n_tiles_per_chunk
+    return max(1, int(memory_budget * 2 ** 20 // bytes_per_chunk))
+
+
+def iter_chunk_batches(image, batch_windows, tile_slen, border_padding, device, n_prefetch=2):
+    """Yields batches of chunks (n_chunks x n_bands x h x w) of `image` on `device`.
+
+    A background thread cuts the next `n_prefetch` batches while the current one is encoded. On
+    gpu, the batches are pinned and copied asynchronously on a separate CUDA stream.
+    """
+    use_cuda = device.type == "cuda"
+    stream = torch.cuda.Stream(device) if use_cuda else None
+
+    def get_chunks(windows):
+        chunks = []
+        for (r0, _, r1), (c0, _, c1) in windows:
+            x0, x1 = r0 * tile_slen, r1 * tile_slen + 2 * border_padding
+            y0, y1 = c0 * tile_slen, c1 * tile_slen + 2 * border_padding
+            chunks.append(image[0, :, x0:x1, y0:y1])
+        chunks = torch.stack(chunks)
+        event = None
+        if use_cuda:
+            chunks = chunks if chunks.is_cuda else chunks.pin_memory()
+            with torch.cuda.stream(stream):
+                chunks = chunks.to(device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+        return chunks.to(device), event
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = deque()
+        for windows in batch_windows:
+            futures.append(executor.submit(get_chunks, windows))
+            if len(futures) > n_prefetch:
+                yield _wait_for_chunks(*futures.popleft().result(), device)
+        while futures:
+            yield _wait_for_chunks(*futures.popleft().result(), device)
+
+
+def _wait_for_chunks(chunks, event, device):
+    if event is not None:
+        # wait for the copy and let the caching allocator know that the memory of the chunks is
+        # now used by the current stream.
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(event)
+        chunks.record_stream(current_stream)
+    return chunks
+
+
+class ChunkPredictor(nn.Module):
+    """Encodes a batch of chunks (n_chunks x n_bands x h x w) with the encoder(s) of `sleep_net`.
+
+    The outputs are a tuple with the variational parameters of each tile, in the order given by
+    `output_names`, so that the predictor can be traced (see `export_predictor`).
+    """
+
+    input_shape = None
+
+    def __init__(self, sleep_net):
+        super().__init__()
+        self.image_encoder = sleep_net.image_encoder
+        self.galaxy_encoder = sleep_net.galaxy_encoder
+        self.tile_slen = self.image_encoder.tile_slen
+        self.border_padding = self.image_encoder.border_padding
+        self.max_sources = sleep_net.image_decoder.max_sources
+
+        output_names = list(self.image_encoder.variational_params) + ["n_source_log_probs"]
+        if self.galaxy_encoder is not None:
+            output_names.append("galaxy_param_mean")
+            ptile_background = sleep_net.image_decoder.get_background(sleep_net.cropped_slen)
+            self.register_buffer("ptile_background", ptile_background, persistent=False)
+        self.output_names = tuple(output_names)
+
+    @property
+    def device(self):
+        # quantized encoders (cpu only) have no parameters.
+        param = next(self.parameters(), None)
+        return torch.device("cpu") if param is None else param.device
+
+    def forward(self, chunks, image_min):
+        # use MAP estimate on n_sources and locs (for galaxy encoder), and
+        # get var_params in tiles (excluding galaxy params) in a single pass.
+        _, var_params, tile_params = self.image_encoder.tile_map_inference_images(chunks, image_min)
+
+        # get galaxy params per tile
+        if self.galaxy_encoder is not None:
+            ptiles = self.image_encoder.get_images_in_tiles(chunks)
+            var_params["galaxy_param_mean"] = self.forward_galaxy(ptiles, tile_params["locs"])
+
+        return tuple(var_params[name] for name in self.output_names)
+
+    def forward_galaxy(self, image_ptiles, tile_locs):
+        # same as `SleepPhase.forward_galaxy`, without the rest of the LightningModule.
+        n_ptiles = image_ptiles.shape[0]
+        _tile_locs = tile_locs.reshape(n_ptiles, self.max_sources, 2)
+        centered_ptiles = self.image_encoder.center_ptiles(image_ptiles, _tile_locs)
+        centered_ptiles -= self.ptile_background.unsqueeze(0)
+        return self.galaxy_encoder(centered_ptiles)
+
+
+class TracedChunkPredictor:
+    """A `ChunkPredictor` exported by `export_predictor`.
+
+    The exported file only needs `torch.jit.load` (no Lightning or Hydra), and only accepts
+    batches of chunks with the shape it was traced with (`input_shape`).
+    """
+
+    def __init__(self, predictor_file, device="cpu"):
+        extra_files = {"predictor.json": ""}
+        self.module = torch.jit.load(predictor_file, map_location=device, _extra_files=extra_files)
+        self.module.eval()
+        metadata = json.loads(extra_files["predictor.json"])
+        self.device = torch.device(device)
+        self.tile_slen = metadata["tile_slen"]
+        self.border_padding = metadata["border_padding"]
+        self.output_names = tuple(metadata["output_names"])
+        self.input_shape = tuple(metadata["input_shape"])
+        # how the predictor was exported, see `export_predictor`.
+        self.exported_device = metadata.get("device")
+        self.settings = metadata.get("settings")
+
+    def __call__(self, chunks, image_min):
+        return self.module(chunks, image_min)
+
+
+def export_predictor(sleep_net, predictor_file, input_shape, settings=None):
+    # trace the encoder(s) of `sleep_net` on batches of chunks of shape `input_shape`.
+    # `settings` (checkpoint, chunk settings) are saved with it, see `load_predictor`.
+    predictor = ChunkPredictor(sleep_net).eval()
+    chunks = torch.rand(*input_shape, device=predictor.device) + 1.0
+    image_min = torch.tensor(0.0, device=predictor.device)
+    with torch.no_grad(), warnings.catch_warnings():
+        # shapes and asserts are fixed at tracing time, which is fine for a fixed `input_shape`.
+        warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+        traced = torch.jit.trace(predictor, (chunks, image_min), check_trace=False)
+
+    metadata = {
+        "tile_slen": predictor.tile_slen,
+        "border_padding": predictor.border_padding,
+        "output_names": predictor.output_names,
+        "input_shape": list(input_shape),
+        "device": str(predictor.device),
+        "settings": settings,
+    }
+    torch.jit.save(traced, predictor_file, _extra_files={"predictor.json": json.dumps(metadata)})
+
+
+def predict_on_image(
+    image, predictor, chunk_slen=200, batch_chunks=None, memory_budget=1024, n_prefetch=2
+):
+    """Run `predictor` on a full (possibly large) image with sliding windows.
+
+    `predictor` is a `ChunkPredictor` (or a `SleepPhase` to wrap in one) or a
+    `TracedChunkPredictor`. The image of shape (1 x n_bands x h x w) is divided into tiles of size
+    `tile_slen` starting `border_padding` pixels away from its edges. Chunks of `chunk_slen` x
+    `chunk_slen` pixels worth of tiles, plus a halo of `border_padding` pixels, are encoded
+    `batch_chunks` at a time. If `batch_chunks` is None, it is chosen so that each batch fits in
+    `memory_budget` MB. Traced predictors fix `batch_chunks` and the shape of the chunks.
+
+    Yields a dictionary per batch of chunks with the variational parameters of each tile and
+    "tile_indices", the row-major index of each tile in the full (n_tiles_h x n_tiles_w) grid of
+    tiles. Together the results cover every tile in the image exactly once, and match encoding
+    the whole image at once.
+    """
+    assert len(image.shape) == 4 and image.shape[0] == 1, "Only works for 1 image"
+    if isinstance(predictor, sleep.SleepPhase):
+        predictor = ChunkPredictor(predictor)
+    tile_slen = predictor.tile_slen
+    border_padding = predictor.border_padding
+    device = predictor.device
+    assert chunk_slen % tile_slen == 0, "chunk_slen must be a multiple of tile_slen"
+
+    n_tiles_h, n_tiles_w = get_n_tiles(image.shape, tile_slen, border_padding)
+    row_windows = get_chunk_windows(n_tiles_h, chunk_slen // tile_slen)
+    col_windows = get_chunk_windows(n_tiles_w, chunk_slen // tile_slen)
+    windows = [(rw, cw) for rw in row_windows for cw in col_windows]
+
+    # all chunks have the same size, so the same number of chunks fit in memory in every batch.
+    (r0, _, r1), (c0, _, c1) = windows[0]
+    if predictor.input_shape is not None:
+        chunk_shape = [(n * tile_slen + 2 * border_padding) for n in (r1 - r0, c1 - c0)]
+        assert (image.shape[1], *chunk_shape) == predictor.input_shape[1:], "incompatible chunks"
+        batch_chunks = predictor.input_shape[0]
+    elif batch_chunks is None:
+        image_encoder = predictor.image_encoder
+        batch_chunks = get_batch_chunks(image_encoder, (r1 - r0) * (c1 - c0), memory_budget)
+    batch_windows = [windows[i : i + batch_chunks] for i in range(0, len(windows), batch_chunks)]
+
+    # traced predictors need full batches, so repeat the last chunk (and discard its results).
+    chunk_windows = batch_windows
+    if predictor.input_shape is not None:
+        n_pad = batch_chunks - len(batch_windows[-1])
+        chunk_windows = batch_windows[:-1] + [batch_windows[-1] + [windows[-1]] * n_pad]
+
+    # normalize every chunk with the minimum of the whole image, so that tiles do not depend on
+    # the chunk they belong to.
+    h = n_tiles_h * tile_slen + 2 * border_padding
+    w = n_tiles_w * tile_slen + 2 * border_padding
+    image_min = image[:, :, :h, :w].min().to(device)
+
+    chunk_batches = iter_chunk_batches(
+        image, chunk_windows, tile_slen, border_padding, device, n_prefetch
+    )
+    for windows, chunks in zip(batch_windows, chunk_batches):
+        outputs = dict(zip(predictor.output_names, predictor(chunks, image_min)))
+
+        # only keep the tiles in each chunk that were not covered by a previous chunk.
+        keep_indx = []
+        tile_indices = []
+        n_tiles_per_chunk = len(outputs["n_source_log_probs"]) // len(chunks)
+        for n, ((r0, keep_r, r1), (c0, keep_c, c1)) in enumerate(windows):
+            rows = torch.arange(r0, r1, device=device).unsqueeze(1)
+            cols = torch.arange(c0, c1, device=device).unsqueeze(0)
+            is_kept = ((rows >= keep_r) & (cols >= keep_c)).flatten()
+            keep_indx.append(is_kept.nonzero().squeeze(1) + n * n_tiles_per_chunk)
+            tile_indices.append((rows * n_tiles_w + cols).flatten()[is_kept])
+        keep_indx = torch.cat(keep_indx)
+
+        results = {key: value[keep_indx] for key, value in outputs.items()}
+        results["tile_indices"] = torch.cat(tile_indices)
+        yield results
+
+
+class MemorySink:
+    """Collects the results of `predict_on_image` into preallocated full-frame buffers.
+
+    Each buffer has shape (n_tiles_h x n_tiles_w x ...) and is allocated from the first results
+    written for its key. "tile_is_written" records the tiles that have been written so far.
+    """
+
+    def __init__(self, n_tiles_h, n_tiles_w):
+        self.tile_shape = (n_tiles_h, n_tiles_w)
+        self.buffers = {"tile_is_written": self._allocate("tile_is_written", (), torch.bool)}
+
+    def _allocate(self, key, shape, dtype):  # pylint: disable=unused-argument
+        return torch.zeros(*self.tile_shape, *shape, dtype=dtype)
+
+    def write(self, results):
+        tile_indices = results["tile_indices"].cpu()
+        for key, value in results.items():
+            if key == "tile_indices":
+                continue
+            if key not in self.buffers:
+                self.buffers[key] = self._allocate(key, value.shape[1:], value.dtype)
+            self._flat(key)[tile_indices] = value.cpu()
+        self._flat("tile_is_written")[tile_indices] = True
+
+    def _flat(self, key):
+        return self.buffers[key].view(-1, *self.buffers[key].shape[2:])
+
+    def get_results(self):
+        return self.buffers
+
+    def close(self):
+        pass
+
+
+class NpySink(MemorySink):
+    """Writes the results of `predict_on_image` to one .npy memory map per key in `output_dir`.
+
+    Results are flushed to disk after every write, so that frames of any size use constant
+    memory. Existing arrays are overwritten, they might be from another field or checkpoint.
+    """
+
+    def __init__(self, output_dir, n_tiles_h, n_tiles_w):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.memmaps = {}
+        super().__init__(n_tiles_h, n_tiles_w)
 
+    def _allocate(self, key, shape, dtype):
+        npy_file = self.output_dir.joinpath(f"{key}.npy").as_posix()
+        dtype = torch.empty(0, dtype=dtype).numpy().dtype
+        shape = (*self.tile_shape, *shape)
+        memmap = np.lib.format.open_memmap(npy_file, mode="w+", dtype=dtype, shape=shape)
+        self.memmaps[key] = memmap
+        return torch.from_numpy(memmap)
+
+    def write(self, results):
+        super().write(results)
+        self.flush()
+
+    def flush(self):
+        for memmap in self.memmaps.values():
+            memmap.flush()
+
+    def close(self):
+        self.flush()
+
+
+def load_sleep_net(cfg: DictConfig):
     if cfg.predict.checkpoint is not None:
         sleep_net = sleep.SleepPhase.load_from_checkpoint(cfg.predict.checkpoint)
     else:
         # for unit testing.
         sleep_net = sleep.SleepPhase(**cfg.model.kwargs)
 
-    # image for prediction from SDSS
-    image = sdss_obj[0]["image"][bands[0]]
-    h, w = image.shape
-    image = rearrange(torch.from_numpy(image), "h w -> 1 1 h w")
-
     # move everything to specified GPU
     sleep_net.to(cfg.predict.device)
     sleep_net.eval()
-    image_encoder = sleep_net.image_encoder.eval()
 
-    list_var_params = []
-    clen = 200  # sdss image is too big so we need to chunk it.
+    # replace the encoders by their int8 versions saved by `quantize.quantize` (cpu only).
+    if cfg.predict.quantized_encoders_file is not None:
+        assert torch.device(cfg.predict.device).type == "cpu", "quantized encoders are cpu only."
+        quantize.load_quantized_encoders(sleep_net, cfg.predict.quantized_encoders_file)
+    return sleep_net
+
+
+def get_predictor_settings(cfg: DictConfig):
+    # settings an exported predictor depends on, besides the device.
+    checkpoint = cfg.predict.checkpoint
+    quantized_encoders_file = cfg.predict.quantized_encoders_file
+    if quantized_encoders_file is not None:
+        quantized_encoders_file = Path(quantized_encoders_file).resolve().as_posix()
+    return {
+        "checkpoint": None if checkpoint is None else Path(checkpoint).resolve().as_posix(),
+        "quantized_encoders_file": quantized_encoders_file,
+        "chunk_slen": cfg.predict.chunk_slen,
+        "batch_chunks": cfg.predict.batch_chunks,
+        "memory_budget": cfg.predict.memory_budget,
+    }
+
+
+def load_predictor(cfg: DictConfig):
+    # prefer the exported predictor if there is one, it avoids the python overhead of the encoder.
+    # it is only used if it was exported from the same checkpoint (and quantized encoders), device
+    # and chunk settings.
+    predictor_file = cfg.predict.predictor_file
+    if predictor_file is not None and Path(predictor_file).exists():
+        predictor = TracedChunkPredictor(predictor_file, cfg.predict.device)
+        device = torch.empty(0, device=cfg.predict.device).device  # e.g. "cuda" -> "cuda:0"
+        is_same_device = predictor.exported_device == str(device)
+        if is_same_device and predictor.settings == get_predictor_settings(cfg):
+            return predictor
+        warnings.warn(
+            f"{predictor_file} was exported with other settings than `predict` (checkpoint, "
+            "quantized encoders, device or chunk settings), using the checkpoint instead."
+        )
+    return ChunkPredictor(load_sleep_net(cfg))
+
+
+def export(cfg: DictConfig):
+    # export the predictor for the chunks of `predict` to `cfg.predict.predictor_file`.
+    sleep_net = load_sleep_net(cfg)
+    image_encoder = sleep_net.image_encoder
+    chunk_slen = cfg.predict.chunk_slen + 2 * image_encoder.border_padding
+    batch_chunks = cfg.predict.batch_chunks
+    if batch_chunks is None:
+        n_tiles_per_chunk = (cfg.predict.chunk_slen // image_encoder.tile_slen) ** 2
+        batch_chunks = get_batch_chunks(image_encoder, n_tiles_per_chunk, cfg.predict.memory_budget)
+    input_shape = (batch_chunks, image_encoder.n_bands, chunk_slen, chunk_slen)
+    settings = get_predictor_settings(cfg)
+    export_predictor(sleep_net, cfg.predict.predictor_file, input_shape, settings)
+
+
+def predict_sdss_field(cfg: DictConfig, sdss_obj, idx, predictor, sink_fn):
+    """Predict on the field `idx` of `sdss_obj` and write the results to `sink_fn(*n_tiles)`.
+
+    Returns the sink and the number of tiles in the field.
+    """
+    bands = list(cfg.predict.bands)
+    assert isinstance(bands, list) and len(bands) == 1, "Only 1 band supported"
+
+    # image for prediction from SDSS
+    image = sdss_obj[idx]["image"][bands[0]]
+    image = rearrange(torch.from_numpy(image), "h w -> 1 1 h w")
+
+    n_tiles = get_n_tiles(image.shape, predictor.tile_slen, predictor.border_padding)
+    sink = sink_fn(*n_tiles)
+
+    # sdss image is too big so we need to chunk it.
+    chunk_kwargs = {
+        "chunk_slen": cfg.predict.chunk_slen,
+        "batch_chunks": cfg.predict.batch_chunks,
+        "memory_budget": cfg.predict.memory_budget,
+    }
 
     with torch.no_grad():
-        for i in range(h // clen):
-            for j in range(w // clen):
-                chunk = image[:, :, i * clen : (i + 1) * clen, j * clen : (j + 1) * clen]
-                chunk = chunk.to(cfg.predict.device)
-
-                # tile the image
-                ptiles = image_encoder.get_images_in_tiles(chunk)
-
-                # use MAP estimate on n_sources and locs (for galaxy encoder)
-                tile_n_sources = image_encoder.tile_map_n_sources(ptiles)
-                tile_params = image_encoder.tile_map_estimate(chunk)
-
-                # get var_params in tiles (excluding galaxy params)
-                var_params = image_encoder.forward(ptiles, tile_n_sources)
-
-                # get galaxy params per tile
-                galaxy_param_mean = sleep_net.forward_galaxy(ptiles, tile_params["locs"])
-
-                # collect all parameters into one dictionary
-                var_params["galaxy_param_mean"] = galaxy_param_mean
-
-                # put everything in the cpu before saving
-                var_params = {key: value.cpu() for key, value in var_params.items()}
-                list_var_params.append(var_params)
-
-                # delete extra stuff in GPU and clear cache for next iteration.
-                del chunk
-                del ptiles
-                del tile_params
-                del tile_n_sources
-                if "cuda" in cfg.predict.device:
-                    torch.cuda.empty_cache()
-
-                # just for coverage so only run one index.
-                if cfg.predict.testing:
-                    break
-
-    all_var_params = {}
-    for var_params in list_var_params:
-        for key in var_params:
-            t1 = all_var_params.get(key, torch.tensor([]))
-            t2 = var_params[key]
-            all_var_params[key] = torch.cat((t1, t2))
-
-    if cfg.predict.output_file is not None:
-        torch.save(var_params, cfg.predict.output_file)
+        for var_params in predict_on_image(image, predictor, **chunk_kwargs):
+            sink.write(var_params)
+
+            # just for coverage so only run one batch of chunks.
+            if cfg.predict.testing:
+                break
+    sink.close()
+
+    if "cuda" in cfg.predict.device:
+        torch.cuda.empty_cache()
+
+    return sink, n_tiles[0] * n_tiles[1]
+
+
+def predict(cfg: DictConfig):
+    sdss_obj = sdss.SloanDigitalSkySurvey(**cfg.predict.sdss_kwargs)
+    predictor = load_predictor(cfg)
+
+    # results are written to .npy memory maps in `output_dir` or kept in memory.
+    if cfg.predict.output_dir is not None:
+        sink_fn = partial(NpySink, cfg.predict.output_dir)
+    else:
+        sink_fn = MemorySink
+    sink, _ = predict_sdss_field(cfg, sdss_obj, 0, predictor, sink_fn)
+
+    # results on disk are not gathered into a single file, which would load all of them in memory.
+    if cfg.predict.output_dir is not None:
+        logger.info("results are in %s, output_file is not written.", cfg.predict.output_dir)
+    elif cfg.predict.output_file is not None:
+        torch.save(sink.get_results(), cfg.predict.output_file)
+
+
+# state of each process of `predict_survey`, i.e. its own replica of the model.
+_survey_worker = {}
+
+
+def _init_survey_worker(cfg, n_threads=None):
+    # the number of threads is only limited in spawned workers, not in the calling process.
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    cfg = OmegaConf.create(cfg)
+    _survey_worker["cfg"] = cfg
+    _survey_worker["predictor"] = load_predictor(cfg)
+
+
+def _predict_survey_field(run, camcol, field, catalog_file):
+    cfg = _survey_worker["cfg"]
+    sdss_kwargs = dict(cfg.predict.sdss_kwargs, run=run, camcol=camcol, fields=[field])
+
+    t0 = time.perf_counter()
+    sdss_obj = sdss.SloanDigitalSkySurvey(**sdss_kwargs)
+    sink, n_tiles = predict_sdss_field(cfg, sdss_obj, 0, _survey_worker["predictor"], MemorySink)
+    torch.save(sink.get_results(), catalog_file)
+    return {"n_tiles": n_tiles, "time": time.perf_counter() - t0}
+
+
+def _get_survey_fields(cfg: DictConfig):
+    # the (run, camcol, field) triples of the survey, by default all fields of `sdss_kwargs`.
+    fields = cfg.predict.survey.fields
+    if fields is None:
+        sdss_kwargs = cfg.predict.sdss_kwargs
+        fields = [(sdss_kwargs.run, sdss_kwargs.camcol, field) for field in sdss_kwargs.fields]
+    return [tuple(rcf) for rcf in fields]
+
+
+def _load_survey_index(index_file):
+    return json.loads(index_file.read_text()) if index_file.exists() else {}
+
+
+def _write_survey_index(index_file, index):
+    # the index is rewritten after every field (atomically), so it always lists the
+    # completed fields, even if the survey is interrupted.
+    tmp_index_file = index_file.with_suffix(".tmp")
+    tmp_index_file.write_text(json.dumps(index, indent=2))
+    tmp_index_file.replace(index_file)
+
+
+def _add_failed_field(index, rcf, error):
+    run, camcol, field = rcf
+    warnings.warn(f"field {run}-{camcol}-{field} failed: {error!r}")
+    index[f"{run}-{camcol}-{field}"] = {
+        "run": run,
+        "camcol": camcol,
+        "field": field,
+        "error": repr(error),
+    }
+
+
+def _add_completed_field(index, rcf, catalog_file, result, fields_per_hour):
+    run, camcol, field = rcf
+    tiles_per_s = result["n_tiles"] / result["time"]
+    logger.info(
+        "field %d-%d-%d: %d tiles in %.1fs (%.1f tiles/s, %.1f fields/hour overall).",
+        run,
+        camcol,
+        field,
+        result["n_tiles"],
+        result["time"],
+        tiles_per_s,
+        fields_per_hour,
+    )
+    index[f"{run}-{camcol}-{field}"] = {
+        "run": run,
+        "camcol": camcol,
+        "field": field,
+        "catalog_file": Path(catalog_file).name,
+        **result,
+    }
+
+
+def _iter_survey_results(cfg_container, catalog_files, n_workers, n_threads=None):
+    # yields (rcf, result, error) for each field of `catalog_files` as soon as it is done,
+    # where exactly one of result and error is None.
+    # n_workers = 0 runs every field in the main process.
+    if n_workers == 0:
+        _init_survey_worker(cfg_container)
+        for rcf, catalog_file in catalog_files.items():
+            try:
+                result = _predict_survey_field(*rcf, catalog_file)
+            except Exception as error:  # pylint: disable=broad-except
+                yield rcf, None, error
+            else:
+                yield rcf, result, None
+        return
+
+    # each worker process loads its own replica of the model with `n_threads` cpu threads.
+    with ProcessPoolExecutor(
+        n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_survey_worker,
+        initargs=(cfg_container, n_threads),
+    ) as executor:
+        futures = {
+            executor.submit(_predict_survey_field, *rcf, catalog_file): rcf
+            for rcf, catalog_file in catalog_files.items()
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                yield futures[future], None, error
+            else:
+                yield futures[future], result, None
+
+
+def predict_survey(cfg: DictConfig):
+    """Predict on many SDSS (run, camcol, field) triples with a pool of processes.
+
+    Each field is catalogued into its own file in `cfg.predict.survey.output_dir`, and
+    "index.json" in the same directory lists the completed fields. Fields that are already in the
+    index are skipped, so an interrupted survey can be resumed. A field that fails is recorded in
+    the index with its error (and retried when the survey is resumed), and the survey goes on.
+    """
+    survey_cfg = cfg.predict.survey
+    output_dir = Path(survey_cfg.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    index_file = output_dir.joinpath("index.json")
+    index = _load_survey_index(index_file)
+
+    fields = _get_survey_fields(cfg)
+    completed = {key for key, entry in index.items() if "error" not in entry}
+    todo = [rcf for rcf in fields if "{}-{}-{}".format(*rcf) not in completed]
+    logger.info("%d of %d fields are already completed.", len(fields) - len(todo), len(fields))
+
+    catalog_files = {
+        rcf: output_dir.joinpath("catalog-{:06d}-{:d}-{:04d}.pt".format(*rcf)).as_posix()
+        for rcf in todo
+    }
+    cfg_container = OmegaConf.to_container(cfg, resolve=True)
+    results = _iter_survey_results(
+        cfg_container, catalog_files, survey_cfg.n_workers, survey_cfg.n_threads
+    )
+
+    t0 = time.perf_counter()
+    n_done = 0
+    n_failed = 0
+    for rcf, result, error in results:
+        if error is not None:
+            n_failed += 1
+            _add_failed_field(index, rcf, error)
+        else:
+            n_done += 1
+            fields_per_hour = n_done / (time.perf_counter() - t0) * 3600
+            _add_completed_field(index, rcf, catalog_files[rcf], result, fields_per_hour)
+        _write_survey_index(index_file, index)
+
+    if n_failed > 0:
+        warnings.warn(f"{n_failed} fields failed, they are retried when the survey is resumed.")
@@ -0,0 +1,122 @@
+import copy
+import warnings
+
+import torch
+from torch import nn
+from omegaconf import DictConfig
+
+from bliss import sleep
+from bliss.datasets import simulated
+
+
+def quantize_image_encoder(image_encoder, mode="dynamic", calibration_images=()):
+    """Return an int8 copy of `image_encoder` for inference on cpu.
+
+    mode="dynamic" quantizes the weights of the linear layers of `enc_final` (activations are
+    quantized on the fly). mode="static" also quantizes the conv stack, with activation ranges
+    calibrated on `calibration_images` (full images with border padding).
+    """
+    assert mode in {"dynamic", "static"}
+    image_encoder = copy.deepcopy(image_encoder).cpu().optimize_for_inference()
+
+    if mode == "static":
+        enc_conv = image_encoder.enc_conv
+        layers = [torch.quantization.QuantStub(), *enc_conv.layer, torch.quantization.DeQuantStub()]
+        enc_conv.layer = nn.Sequential(*layers)
+        enc_conv.qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+        torch.quantization.prepare(enc_conv, inplace=True)
+        with torch.no_grad():
+            for images in calibration_images:
+                image_encoder.tile_map_estimate(images.cpu())
+        torch.quantization.convert(enc_conv, inplace=True)
+
+    image_encoder.enc_final = torch.quantization.quantize_dynamic(
+        image_encoder.enc_final, {nn.Linear}, dtype=torch.qint8
+    )
+    return image_encoder
+
+
+def quantize_galaxy_encoder(galaxy_encoder):
+    # weights of the linear layers of `CenteredGalaxyEncoder` in int8 (dynamic quantization).
+    galaxy_encoder = copy.deepcopy(galaxy_encoder).cpu().eval()
+    return torch.quantization.quantize_dynamic(galaxy_encoder, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_encoders(sleep_net, quantized_encoders_file):
+    """Replace the encoders of `sleep_net` by the int8 encoders saved by `quantize`.
+
+    The int8 modules are rebuilt from the float encoders of `sleep_net` (which should come from
+    the same checkpoint), then their quantized weights and activation ranges are loaded.
+    """
+    quantized_encoders = torch.load(quantized_encoders_file)
+    with warnings.catch_warnings():
+        # the activation ranges of the rebuilt conv stack are loaded below, not calibrated.
+        warnings.filterwarnings("ignore", message="must run observer before calling")
+        image_encoder = quantize_image_encoder(sleep_net.image_encoder, quantized_encoders["mode"])
+    image_encoder.load_state_dict(quantized_encoders["image_encoder"])
+    sleep_net.image_encoder = image_encoder
+    if "galaxy_encoder" in quantized_encoders:
+        galaxy_encoder = quantize_galaxy_encoder(sleep_net.galaxy_encoder)
+        galaxy_encoder.load_state_dict(quantized_encoders["galaxy_encoder"])
+        sleep_net.galaxy_encoder = galaxy_encoder
+    return sleep_net
+
+
+def get_average_metrics(sleep_net, batches):
+    metrics = {}
+    with torch.no_grad():
+        for batch in batches:
+            for key, value in sleep_net.get_metrics(batch).items():
+                metrics[key] = metrics.get(key, 0.0) + float(value) / len(batches)
+    return metrics
+
+
+def quantize(cfg: DictConfig):
+    """Quantize the encoders of a trained `SleepPhase` and report the change in its metrics.
+
+    The static quantization of the conv stack is calibrated on `n_calibration_batches` batches of
+    `SimulatedDataset`, and the metrics of the float and int8 models are compared on
+    `n_eval_batches` other batches.
+    """
+    if cfg.quantize.checkpoint is not None:
+        sleep_net = sleep.SleepPhase.load_from_checkpoint(cfg.quantize.checkpoint)
+    else:
+        # for unit testing.
+        sleep_net = sleep.SleepPhase(**cfg.model.kwargs)
+    sleep_net.cpu().eval()
+
+    dataset_kwargs = dict(cfg.dataset.kwargs, generate_device="cpu", prefetch_batches=0)
+    n_batches = cfg.quantize.n_calibration_batches + cfg.quantize.n_eval_batches
+    dataset_kwargs.update({"n_batches": n_batches, "num_workers": 0})
+    batches = list(simulated.SimulatedDataset(**dataset_kwargs))
+    calibration_batches = batches[: cfg.quantize.n_calibration_batches]
+    eval_batches = batches[cfg.quantize.n_calibration_batches :]
+
+    metrics = get_average_metrics(sleep_net, eval_batches)
+
+    calibration_images = [batch["images"] for batch in calibration_batches]
+    image_encoder = quantize_image_encoder(
+        sleep_net.image_encoder, cfg.quantize.mode, calibration_images
+    )
+    sleep_net.image_encoder = image_encoder
+    if sleep_net.use_galaxy_encoder:
+        sleep_net.galaxy_encoder = quantize_galaxy_encoder(sleep_net.galaxy_encoder)
+    quantized_metrics = get_average_metrics(sleep_net, eval_batches)
+
+    print(f"{'metric':>20} {'float32':>12} {'int8':>12} {'delta':>12}")
+    for key, value in metrics.items():
+        quantized_value = quantized_metrics[key]
+        delta = quantized_value - value
+        print(f"{key:>20} {value:>12.4f} {quantized_value:>12.4f} {delta:>12.4f}")
+
+    if cfg.quantize.output_file is not None:
+        # state dicts rather than modules, see `load_quantized_encoders`.
+        quantized_encoders = {
+            "mode": cfg.quantize.mode,
+            "image_encoder": image_encoder.state_dict(),
+        }
+        if sleep_net.use_galaxy_encoder:
+            quantized_encoders["galaxy_encoder"] = sleep_net.galaxy_encoder.state_dict()
+        torch.save(quantized_encoders, cfg.quantize.output_file)
+
+    return metrics, quantized_metrics
@@ -6,7 +6,7 @@ model.
 
 """
 
-import math
+from functools import lru_cache
 from itertools import permutations
 
 import numpy as np
@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 import pytorch_lightning as pl
 
 import torch
+from scipy import optimize as sp_optim
 from torch.nn import CrossEntropyLoss
 from torch.distributions import Normal
 from einops import rearrange
@@ -22,10 +23,17 @@ from bliss import plotting
 from bliss.optimizer import get_optimizer
 from bliss.models import encoder, decoder, galaxy_net
 from bliss.models.encoder import get_star_bool, get_full_params
-from bliss.metrics import eval_error_on_batch
+from bliss.metrics import eval_error_on_batch, MetricsAccumulator
 
 plt.switch_backend("Agg")
 
+# above this, the matching loss uses the Hungarian algorithm instead of all permutations.
+MAX_PERM_DETECTIONS = 4
+
+# above this number of matchings of the true sources of a tile, the Hungarian loss solves each
+# tile with `scipy.optimize.linear_sum_assignment` instead of comparing all the matchings at once.
+MAX_ENUMERATED_MATCHINGS = 500
+
 
 def sort_locs(locs):
     # sort according to x location
@@ -34,44 +42,55 @@ def sort_locs(locs):
     return locs[indx_sort, :], indx_sort
 
 
+def _get_perms(max_detections):
+    # shape = (n_permutations x max_detections), with the permutations in lexicographic order.
+    return torch.tensor(list(permutations(range(max_detections))), dtype=torch.long)
+
+
+@lru_cache(maxsize=None)
+def _get_partial_perms(max_detections, n_sources):
+    # shape = (n_matchings x n_sources), the estimated sources matched with the first
+    # `n_sources` true sources.
+    perms = list(permutations(range(max_detections), n_sources))
+    return np.array(perms, dtype=np.int64).reshape(len(perms), n_sources)
+
+
 def _get_log_probs_all_perms(
     locs_log_probs_all,
     star_params_log_probs_all,
     prob_galaxy,
     true_galaxy_bool,
     is_on_array,
+    perms=None,
 ):
     # get log-probability under every possible matching of estimated source to true source
-    n_ptiles = star_params_log_probs_all.size(0)
     max_detections = star_params_log_probs_all.size(-1)
-
-    n_permutations = math.factorial(max_detections)
-    locs_log_probs_all_perm = torch.zeros(
-        n_ptiles, n_permutations, device=locs_log_probs_all.device
-    )
-    star_params_log_probs_all_perm = locs_log_probs_all_perm.clone()
-    galaxy_bool_log_probs_all_perm = locs_log_probs_all_perm.clone()
-
-    for i, perm in enumerate(permutations(range(max_detections))):
-        # note that we multiply is_on_array, we only evaluate the loss if the source is on.
-        locs_log_probs_all_perm[:, i] = (
-            locs_log_probs_all[:, perm].diagonal(dim1=1, dim2=2) * is_on_array
-        ).sum(1)
-
-        # if star, evaluate the star parameters,
-        # hence the multiplication by (1 - true_galaxy_bool)
-        # the diagonal is a clever way of selecting the elements of each permutation (first index
-        # of mean/var with second index of true_param etc.)
-        star_params_log_probs_all_perm[:, i] = (
-            star_params_log_probs_all[:, perm].diagonal(dim1=1, dim2=2)
-            * is_on_array
-            * (1 - true_galaxy_bool)
-        ).sum(1)
-
-        _prob_galaxy = prob_galaxy[:, perm]
-        galaxy_bool_loss = true_galaxy_bool * torch.log(_prob_galaxy)
-        galaxy_bool_loss += (1 - true_galaxy_bool) * torch.log(1 - _prob_galaxy)
-        galaxy_bool_log_probs_all_perm[:, i] = (galaxy_bool_loss * is_on_array).sum(1)
+    if perms is None:
+        perms = _get_perms(max_detections).to(locs_log_probs_all.device)
+    assert perms.shape[1] == max_detections
+
+    # the estimated source perm[i] is matched with the true source i, so selecting the elements
+    # [:, perm[i], i] of the log-probs for every permutation at once gives
+    # shape = (n_ptiles x 2 x n_permutations x max_detections)
+    true_indx = torch.arange(max_detections, device=perms.device)
+    log_probs_all = torch.stack((locs_log_probs_all, star_params_log_probs_all), dim=1)
+    log_probs_all_perm = log_probs_all[:, :, perms, true_indx]
+
+    # note that we multiply is_on_array, we only evaluate the loss if the source is on.
+    _is_on_array = is_on_array.unsqueeze(1)
+    locs_log_probs_all_perm = (log_probs_all_perm[:, 0] * _is_on_array).sum(-1)
+
+    # if star, evaluate the star parameters,
+    # hence the multiplication by (1 - true_galaxy_bool)
+    _true_galaxy_bool = true_galaxy_bool.unsqueeze(1)
+    star_params_log_probs_all_perm = (
+        log_probs_all_perm[:, 1] * _is_on_array * (1 - _true_galaxy_bool)
+    ).sum(-1)
+
+    _prob_galaxy = prob_galaxy[:, perms]
+    galaxy_bool_loss = _true_galaxy_bool * torch.log(_prob_galaxy)
+    galaxy_bool_loss += (1 - _true_galaxy_bool) * torch.log(1 - _prob_galaxy)
+    galaxy_bool_log_probs_all_perm = (galaxy_bool_loss * _is_on_array).sum(-1)
 
     return (
         locs_log_probs_all_perm,
@@ -86,6 +105,7 @@ def _get_min_perm_loss(
     prob_galaxy,
     true_galaxy_bool,
     is_on_array,
+    perms=None,
 ):
     # get log-probability under every possible matching of estimated star to true star
     (
@@ -98,6 +118,7 @@ def _get_min_perm_loss(
         prob_galaxy,
         true_galaxy_bool,
         is_on_array,
+        perms,
     )
 
     # find the permutation that minimizes the location losses
@@ -110,6 +131,64 @@ def _get_min_perm_loss(
     return locs_loss, star_params_loss, galaxy_bool_loss
 
 
+def _get_hungarian_loss(
+    locs_log_probs_all,
+    star_params_log_probs_all,
+    prob_galaxy,
+    true_galaxy_bool,
+    is_on_array,
+    max_enumerated_matchings=MAX_ENUMERATED_MATCHINGS,
+):
+    # same as `_get_min_perm_loss`, but the matching that minimizes the location losses is found
+    # on the CPU for all tiles with the same number of sources at once, either by comparing all
+    # the matchings or, if there are too many of them, with the Hungarian algorithm on each tile.
+    n_ptiles, max_detections = is_on_array.shape
+
+    # cost of matching estimated source i (rows) with true source j (columns), transferred once.
+    locs_cost = -(locs_log_probs_all * is_on_array.unsqueeze(1)).detach()
+    locs_cost = np.nan_to_num(locs_cost.cpu().numpy())
+
+    # the true sources that are on are the first `n_sources` ones (see `get_is_on_from_n_sources`),
+    # the others have zero cost and are matched with the remaining estimated sources in order.
+    n_sources = is_on_array.sum(1).long().cpu().numpy()
+
+    # indx[n, j] is the estimated source matched with the true source j of tile n.
+    indx = np.tile(np.arange(max_detections), (n_ptiles, 1))
+    for k in np.unique(n_sources[n_sources > 0]):
+        tiles = np.flatnonzero(n_sources == k)
+        perms = _get_partial_perms(max_detections, int(k))
+        if len(perms) <= max_enumerated_matchings:
+            # shape = (n_tiles x n_matchings), summed cost of each matching.
+            tiles_cost = locs_cost[tiles]
+            costs = sum(tiles_cost[:, perms[:, j], j] for j in range(k))
+            matched = perms[costs.argmin(1)]
+        else:
+            matched = np.empty((len(tiles), k), dtype=np.int64)
+            for i, n in enumerate(tiles):
+                row_indx, col_indx = sp_optim.linear_sum_assignment(locs_cost[n, :, :k])
+                matched[i, col_indx] = row_indx
+
+        # the unmatched estimated sources in increasing order complete the permutation.
+        used = np.zeros((len(tiles), max_detections), dtype=bool)
+        np.put_along_axis(used, matched, True, axis=1)
+        unused = np.argsort(used, axis=1, kind="stable")[:, : max_detections - k]
+        indx[tiles] = np.concatenate((matched, unused), axis=1)
+    indx = torch.from_numpy(indx).to(is_on_array.device)
+
+    # get the losses according to the found matching
+    _indx = indx.unsqueeze(1)
+    locs_log_probs = locs_log_probs_all.gather(1, _indx).squeeze(1)
+    star_params_log_probs = star_params_log_probs_all.gather(1, _indx).squeeze(1)
+    locs_loss = -(locs_log_probs * is_on_array).sum(1)
+    star_params_loss = -(star_params_log_probs * is_on_array * (1 - true_galaxy_bool)).sum(1)
+
+    _prob_galaxy = prob_galaxy.gather(1, indx)
+    galaxy_bool_loss = true_galaxy_bool * torch.log(_prob_galaxy)
+    galaxy_bool_loss += (1 - true_galaxy_bool) * torch.log(1 - _prob_galaxy)
+    galaxy_bool_loss = -(galaxy_bool_loss * is_on_array).sum(1)
+    return locs_loss, star_params_loss, galaxy_bool_loss
+
+
 def _get_params_logprob_all_combs(true_params, param_mean, param_logvar):
     # return shape (n_ptiles x max_detections x max_detections)
     assert true_params.shape == param_mean.shape == param_logvar.shape
@@ -154,6 +233,7 @@ class SleepPhase(pl.LightningModule):
         galaxy_encoder_kwargs: dict = None,
         use_galaxy_encoder=False,
         optimizer_params: dict = None,
+        recon_metrics_every_n_batches: int = 1,
     ):
         super().__init__()
         self.save_hyperparameters()
@@ -163,11 +243,35 @@ class SleepPhase(pl.LightningModule):
         self.image_decoder.requires_grad_(False)
         self.optimizer_params = optimizer_params
 
+        # validation metrics are accumulated over each epoch, but the metrics that need
+        # to reconstruct the images are only computed every few batches.
+        val_metrics_names = [
+            "counts_acc",
+            "galaxy_counts_acc",
+            "locs_mae",
+            "star_fluxes_mae",
+            "avg_tpr",
+            "avg_ppv",
+            "image_fluxes_mae",
+            "norm_pp_mae",
+        ]
+        if use_galaxy_encoder:
+            val_metrics_names.append("galaxy_params_mae")
+        self.val_metrics = MetricsAccumulator(
+            val_metrics_names, median_names=("locs_mae", "star_fluxes_mae")
+        )
+        self.recon_metrics_every_n_batches = recon_metrics_every_n_batches
+
         # consistency
         assert self.image_decoder.tile_slen == self.image_encoder.tile_slen
         assert self.image_decoder.border_padding == self.image_encoder.border_padding
         assert self.image_encoder.max_detections <= self.image_decoder.max_sources
 
+        # all permutations of the detections in a tile, used to match them with the true sources.
+        max_detections = self.image_encoder.max_detections
+        perms = _get_perms(max_detections) if max_detections <= MAX_PERM_DETECTIONS else None
+        self.register_buffer("perms", perms, persistent=False)
+
         self.use_galaxy_encoder = use_galaxy_encoder
         self.galaxy_encoder = None
         if self.use_galaxy_encoder:
@@ -203,6 +307,14 @@ class SleepPhase(pl.LightningModule):
 
         return z
 
+    def forward_galaxy_images(self, images, tile_locs):
+        # same as `forward_galaxy` on all padded tiles of `images`, extracted in chunks
+        # (see `ImageEncoder.map_images_in_tiles`).
+        tile_locs = tile_locs.reshape(-1, self.image_decoder.max_sources, 2)
+        return self.image_encoder.map_images_in_tiles(
+            self.forward_galaxy, images, tile_locs, module=self.galaxy_encoder
+        )
+
     def forward(self, image_ptiles, n_sources):
         raise NotImplementedError()
 
@@ -217,8 +329,7 @@ class SleepPhase(pl.LightningModule):
             tile_locs = rearrange(
                 tile_est["locs"], "b n d xy -> (b n) d xy", b=batch_size, d=max_detections
             )
-            image_ptiles = self.image_encoder.get_images_in_tiles(images)
-            tile_galaxy_params = self.forward_galaxy(image_ptiles, tile_locs)
+            tile_galaxy_params = self.forward_galaxy_images(images, tile_locs)
 
             tile_galaxy_params = rearrange(
                 tile_galaxy_params, "(b n d) p -> b n d p", b=batch_size, d=max_detections
@@ -246,10 +357,8 @@ class SleepPhase(pl.LightningModule):
     def get_galaxy_loss(self, batch):
         images = batch["images"]
         batch_size = images.shape[0]
-        # shape = (n_ptiles x band x ptile_slen x ptile_slen)
-        image_ptiles = self.image_encoder.get_images_in_tiles(images)
         n_galaxy_params = self.image_decoder.n_galaxy_params
-        galaxy_params = self.forward_galaxy(image_ptiles, batch["locs"])  # use true locations.
+        galaxy_params = self.forward_galaxy_images(images, batch["locs"])  # use true locations.
         galaxy_params = galaxy_params.view(batch_size, -1, 1, n_galaxy_params)
 
         # draw fully reconstructed image.
@@ -328,9 +437,8 @@ class SleepPhase(pl.LightningModule):
         true_tile_n_sources = rearrange(true_tile_n_sources, "b n -> (b n)")
         true_tile_is_on_array = encoder.get_is_on_from_n_sources(true_tile_n_sources, max_sources)
 
-        # extract image tiles
-        image_ptiles = self.image_encoder.get_images_in_tiles(images)
-        pred = self.image_encoder.forward(image_ptiles, true_tile_n_sources)
+        # encode all image tiles
+        pred = self.image_encoder.forward_images(images, true_tile_n_sources)
 
         # the loss for estimating the true number of sources
         n_source_log_probs = pred["n_source_log_probs"].view(n_ptiles, max_sources + 1)
@@ -353,13 +461,25 @@ class SleepPhase(pl.LightningModule):
 
         # inside _get_min_perm_loss is where the matching happens:
         # we construct a bijective map from each estimated source to each true source
-        (locs_loss, star_params_loss, galaxy_bool_loss,) = _get_min_perm_loss(
+        matching_args = (
             locs_log_probs_all,
             star_params_log_probs_all,
             prob_galaxy,
             true_tile_galaxy_bool,
             true_tile_is_on_array,
         )
+        if self.perms is not None:
+            (
+                locs_loss,
+                star_params_loss,
+                galaxy_bool_loss,
+            ) = _get_min_perm_loss(*matching_args, perms=self.perms)
+        else:
+            (
+                locs_loss,
+                star_params_loss,
+                galaxy_bool_loss,
+            ) = _get_hungarian_loss(*matching_args)
 
         loss_vec = (
             locs_loss * (locs_loss.detach() < 1e6).float()
@@ -396,6 +516,11 @@ class SleepPhase(pl.LightningModule):
             loss = self.get_detection_loss(batch)[0]
             self.log("train_detection_loss", loss)
 
+            # time spent waiting for the simulated batch (see `SimulatedDataset`).
+            data_wait_time = getattr(self.trainer.datamodule, "data_wait_time", None)
+            if data_wait_time is not None:
+                self.log("train_data_wait_time", data_wait_time)
+
         if optimizer_idx == 1:  # galaxy_encoder
             loss = self.get_galaxy_loss(batch)
             self.log("train_galaxy_loss", loss)
@@ -421,20 +546,30 @@ class SleepPhase(pl.LightningModule):
             galaxy_loss = self.get_galaxy_loss(batch)
             self.log("val_galaxy_loss", galaxy_loss)
 
-        # calculate metrics for this batch
-        metrics = self.get_metrics(batch)
-        self.log("val_acc_counts", metrics["counts_acc"])
-        self.log("val_gal_counts", metrics["galaxy_counts_acc"])
-        self.log("val_locs_mae", metrics["locs_mae"])
-        self.log("val_star_fluxes_mae", metrics["star_fluxes_mae"])
-        self.log("val_avg_tpr", metrics["avg_tpr"])
-        self.log("val_avg_ppv", metrics["avg_ppv"])
-        self.log("val_galaxy_params_mae", metrics["galaxy_params_mae"])
-        self.log("val_image_fluxes_mae", metrics["image_fluxes_mae"])
-        self.log("val_norm_pp_mae", metrics["norm_pp_mae"])
+        # accumulate metrics for this batch
+        reconstruct = batch_idx % self.recon_metrics_every_n_batches == 0
+        self.val_metrics.update(self.get_metrics_vecs(batch, reconstruct))
         return batch
 
     def validation_epoch_end(self, outputs):
+        # log the metrics accumulated over all validation batches (and processes).
+        names = {
+            "counts_acc": "val_acc_counts",
+            "galaxy_counts_acc": "val_gal_counts",
+            "locs_mae": "val_locs_mae",
+            "star_fluxes_mae": "val_star_fluxes_mae",
+            "avg_tpr": "val_avg_tpr",
+            "avg_ppv": "val_avg_ppv",
+            "galaxy_params_mae": "val_galaxy_params_mae",
+            "image_fluxes_mae": "val_image_fluxes_mae",
+            "norm_pp_mae": "val_norm_pp_mae",
+        }
+        metrics = self.val_metrics.compute(self.device)
+        self.val_metrics.reset()
+        for name, value in metrics.items():
+            median_suffix = "_median" if name.endswith("_median") else ""
+            self.log(names[name[: len(name) - len(median_suffix)]] + median_suffix, value)
+
         # NOTE: outputs is a list containing all validation step batches.
         if self.current_epoch > 1:
             self.make_plots(outputs[-1], kind="validation")
@@ -458,6 +593,16 @@ class SleepPhase(pl.LightningModule):
         self.make_plots(batch, kind="testing")
 
     def get_metrics(self, batch):
+        metrics = {
+            name: value.float().mean() for name, value in self.get_metrics_vecs(batch).items()
+        }
+        metrics.setdefault("galaxy_params_mae", 0.0)
+        return metrics
+
+    def get_metrics_vecs(self, batch, reconstruct=True):
+        # same as `get_metrics`, but with the values per image (or per matched source) that are
+        # averaged, and without the image metrics if not `reconstruct`.
+
         # get images and properties
         exclude = {"images", "slen", "background"}
         true_images = batch["images"]
@@ -470,51 +615,44 @@ class SleepPhase(pl.LightningModule):
         # get map estimates
         tile_estimate = self.tile_map_estimate(batch)
         estimates = get_full_params(tile_estimate, slen)
-        recon_images, _ = self.image_decoder.render_images(
-            tile_estimate["n_sources"],
-            tile_estimate["locs"],
-            tile_estimate["galaxy_bool"],
-            tile_estimate["galaxy_params"],
-            tile_estimate["fluxes"],
-            add_noise=False,
-        )
 
         # get detection and star fluxes metrics
         errors = eval_error_on_batch(true_params, estimates, slen)
-
-        locs_mae = errors["locs_mae_vec"].mean()
-        star_fluxes_mae = errors["fluxes_mae_vec"].mean()
-        counts_acc = errors["count_bool"].float().mean()
-        galaxy_counts_acc = errors["galaxy_counts_bool"].float().mean()
-        avg_tpr = errors["tpr_vec"].mean()
-        avg_ppv = errors["ppv_vec"].mean()
+        metrics = {
+            "counts_acc": errors["count_bool"],
+            "galaxy_counts_acc": errors["galaxy_counts_bool"],
+            "locs_mae": errors["locs_mae_vec"],
+            "star_fluxes_mae": errors["fluxes_mae_vec"],
+            "avg_tpr": errors["tpr_vec"],
+            "avg_ppv": errors["ppv_vec"],
+        }
 
         # galaxy metrics
-        gal_params_mae = 0.0
         if self.use_galaxy_encoder:
-            gal_params_mae = errors["galaxy_params_mae_vec"].float().mean()
+            metrics["galaxy_params_mae"] = errors["galaxy_params_mae_vec"]
+
+        if not reconstruct:
+            return metrics
 
         # image metrics
+        recon_images, _ = self.image_decoder.render_images(
+            tile_estimate["n_sources"],
+            tile_estimate["locs"],
+            tile_estimate["galaxy_bool"],
+            tile_estimate["galaxy_params"],
+            tile_estimate["fluxes"],
+            add_noise=False,
+            render_var=False,
+        )
         background = self.image_decoder.get_background(true_images.shape[-1])
         image_diff = true_images - recon_images
         diff_fluxes = true_images.sum((1, 2, 3)) - recon_images.sum((1, 2, 3))
         # TODO: normalize the expression below?
-        image_fluxes_mae = diff_fluxes.abs().mean()
-        norm_pp_mae = (
-            (image_diff.sum((1, 2, 3)) / (true_images - background).sum((1, 2, 3))).abs().mean()
-        )
-
-        return {
-            "counts_acc": counts_acc,
-            "galaxy_counts_acc": galaxy_counts_acc,
-            "locs_mae": locs_mae,
-            "star_fluxes_mae": star_fluxes_mae,
-            "avg_tpr": avg_tpr,
-            "avg_ppv": avg_ppv,
-            "galaxy_params_mae": gal_params_mae,
-            "image_fluxes_mae": image_fluxes_mae,
-            "norm_pp_mae": norm_pp_mae,
-        }
+        metrics["image_fluxes_mae"] = diff_fluxes.abs()
+        metrics["norm_pp_mae"] = (
+            image_diff.sum((1, 2, 3)) / (true_images - background).sum((1, 2, 3))
+        ).abs()
+        return metrics
 
     # pylint: disable=too-many-statements
     def make_plots(self, batch, kind="validation"):
@@ -588,6 +726,7 @@ class SleepPhase(pl.LightningModule):
                 tile_estimate["galaxy_params"][None, i],
                 tile_estimate["fluxes"][None, i],
                 add_noise=False,
+                render_var=False,
             )
 
             recon_image = recon_image[0, 0].cpu().numpy()
@@ -58,6 +58,7 @@ class WakeNet(pl.LightningModule):
             zero_gal_params,
             sample["fluxes"].contiguous(),
             add_noise=False,
+            render_var=False,
         )
 
         return recon_mean
@@ -0,0 +1,52 @@
+"""Micro-benchmarks for the inference code in `bliss.models.encoder`.
+
+Run from the root of the repository, e.g.::
+
+    python case_studies/benchmarks/encoder_benchmarks.py
+
+"""
+
+import copy
+
+import torch
+
+from bliss.models.encoder import ImageEncoder
+from render_benchmarks import timeit
+
+
+def benchmark_optimize_for_inference(device="cpu"):
+    # compare `tile_map_estimate` on 200 x 200 SDSS chunks before and after fusing the batchnorms,
+    # with the encoder settings of the sdss configs.
+    encoder_kwargs = dict(
+        n_bands=1, tile_slen=4, ptile_slen=52, max_detections=1, channel=8, hidden=128
+    )
+    border_padding = 24
+    chunk_slen = 200 + 2 * border_padding
+
+    image_encoder = ImageEncoder(**encoder_kwargs).to(device).eval()
+    fused_encoder = copy.deepcopy(image_encoder).optimize_for_inference()
+    encoders = {"unfused": image_encoder, "fused": fused_encoder}
+    if "cuda" in str(device):
+        channels_last_encoder = copy.deepcopy(image_encoder)
+        encoders["fused channels_last"] = channels_last_encoder.optimize_for_inference(True)
+
+    print("tile_map_estimate on 200 x 200 chunks")
+    print(f"{'batch':>6} " + " ".join(f"{name + ' (s)':>24}" for name in encoders))
+    for batch_size in (1, 4):
+        chunks = torch.rand(batch_size, 1, chunk_slen, chunk_slen, device=device) * 100 + 865.0
+        expected = image_encoder.tile_map_estimate(chunks)
+        for encoder in encoders.values():
+            tile_estimate = encoder.tile_map_estimate(chunks)
+            assert torch.allclose(tile_estimate["locs"], expected["locs"], atol=1e-4)
+
+        times = [
+            timeit(lambda e=encoder: e.tile_map_estimate(chunks), n_repeats=3, device=device)
+            for encoder in encoders.values()
+        ]
+        print(f"{batch_size:>6} " + " ".join(f"{t:>24.4f}" for t in times))
+
+
+if __name__ == "__main__":
+    _device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    with torch.no_grad():
+        benchmark_optimize_for_inference(_device)
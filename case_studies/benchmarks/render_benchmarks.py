@@ -0,0 +1,202 @@
+"""Micro-benchmarks for the rendering code in `bliss.models.decoder`.
+
+Run from the root of the repository, e.g.::
+
+    python case_studies/benchmarks/render_benchmarks.py
+
+"""
+
+import time
+
+import numpy as np
+import torch
+from einops import rearrange
+
+from bliss.models.decoder import ImageDecoder, Tiler
+
+
+def timeit(fn, n_repeats=5, device="cpu"):
+    # returns the best wall-clock time (in seconds) over `n_repeats` calls of `fn`.
+    fn()  # warm-up
+    times = []
+    for _ in range(n_repeats):
+        if "cuda" in str(device):
+            torch.cuda.synchronize(device)
+        t0 = time.perf_counter()
+        fn()
+        if "cuda" in str(device):
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def loop_full_image_from_ptiles(image_ptiles, tile_slen, border_padding):
+    # previous implementation of `ImageDecoder._construct_full_image_from_ptiles`,
+    # which adds the ptiles to the canvas one offset (i, j) within a ptile at a time.
+    batch_size, n_tiles_per_image, n_bands, ptile_slen, _ = image_ptiles.shape
+    n_tiles1 = int(np.sqrt(n_tiles_per_image))
+    n_tiles1_in_ptile = ptile_slen // tile_slen
+    n_tiles_of_padding = (n_tiles1_in_ptile - 1) // 2
+    device = image_ptiles.device
+
+    image_tiles_4d = image_ptiles.view(
+        batch_size, n_tiles1, n_tiles1, n_bands, ptile_slen, ptile_slen
+    )
+    n_tiles_pad = n_tiles1_in_ptile - (n_tiles1 % n_tiles1_in_ptile)
+    zero_pads1 = torch.zeros(
+        batch_size, n_tiles_pad, n_tiles1, n_bands, ptile_slen, ptile_slen, device=device
+    )
+    zero_pads2 = torch.zeros(
+        batch_size,
+        n_tiles1 + n_tiles_pad,
+        n_tiles_pad,
+        n_bands,
+        ptile_slen,
+        ptile_slen,
+        device=device,
+    )
+    image_tiles_4d = torch.cat((image_tiles_4d, zero_pads1), dim=1)
+    image_tiles_4d = torch.cat((image_tiles_4d, zero_pads2), dim=2)
+
+    n_tiles = n_tiles1 + n_tiles_pad
+    canvas_slen = (n_tiles + n_tiles1_in_ptile - 1) * tile_slen
+    canvas = torch.zeros(batch_size, n_bands, canvas_slen, canvas_slen, device=device)
+    for i in range(n_tiles1_in_ptile):
+        for j in range(n_tiles1_in_ptile):
+            indx_vec1 = torch.arange(i, n_tiles, n_tiles1_in_ptile, device=device)
+            indx_vec2 = torch.arange(j, n_tiles, n_tiles1_in_ptile, device=device)
+            canvas_len = len(indx_vec1) * ptile_slen
+            image_tile_cols = image_tiles_4d[:, indx_vec1][:, :, indx_vec2]
+            image_tile_cols = rearrange(
+                image_tile_cols, "b x1 y1 band x2 y2 -> b band (x1 x2) (y1 y2)"
+            )
+            canvas[
+                :,
+                :,
+                (i * tile_slen) : (i * tile_slen + canvas_len),
+                (j * tile_slen) : (j * tile_slen + canvas_len),
+            ] += image_tile_cols
+
+    x0 = n_tiles_of_padding * tile_slen - border_padding
+    x1 = (n_tiles1 + n_tiles_of_padding) * tile_slen + border_padding
+    return canvas[:, :, x0:x1, x0:x1]
+
+
+def benchmark_full_image_assembly(device="cpu"):
+    # compare the loop and grouped implementations of the overlap-add of ptiles.
+    # (slen, tile_slen, ptile_slen, border_padding)
+    settings = [
+        (40, 4, 52, 24),
+        (100, 4, 52, 24),
+        (100, 2, 26, 3),
+        (30, 2, 6, 2),
+    ]
+    batch_sizes = [1, 8, 32]
+
+    print("full image assembly from ptiles")
+    print(f"{'slen':>6} {'tile':>5} {'ptile':>6} {'batch':>6} {'loop (s)':>10} {'grouped (s)':>12}")
+    for slen, tile_slen, ptile_slen, border_padding in settings:
+        n_tiles_per_image = (slen // tile_slen) ** 2
+        for batch_size in batch_sizes:
+            shape = (batch_size, n_tiles_per_image, 1, ptile_slen, ptile_slen)
+            image_ptiles = torch.rand(*shape, device=device)
+
+            def loop():
+                return loop_full_image_from_ptiles(image_ptiles, tile_slen, border_padding)
+
+            def grouped():
+                return ImageDecoder._construct_full_image_from_ptiles(
+                    image_ptiles, tile_slen, border_padding
+                )
+
+            assert torch.equal(loop(), grouped())
+            t_loop = timeit(loop, device=device)
+            t_grouped = timeit(grouped, device=device)
+            print(
+                f"{slen:>6} {tile_slen:>5} {ptile_slen:>6} {batch_size:>6} "
+                f"{t_loop:>10.4f} {t_grouped:>12.4f}"
+            )
+
+
+def benchmark_render_modes(psf_params_file="data/psField-000094-1-0012.fits", device="cpu"):
+    # compare end-to-end rendering of star fields with each `render_mode` of ImageDecoder.
+    decoder_kwargs = dict(
+        n_bands=1,
+        slen=100,
+        tile_slen=4,
+        ptile_slen=52,
+        border_padding=24,
+        max_sources=2,
+        prob_galaxy=0.0,
+        psf_params_file=psf_params_file,
+        background_values=(865.0,),
+        sdss_bands=(2,),
+    )
+    render_modes = ("dense", "sparse", "global")
+
+    print("rendering of star fields")
+    print(f"{'mean':>6} {'batch':>6} " + " ".join(f"{mode + ' (s)':>12}" for mode in render_modes))
+    for mean_sources in (0.01, 0.05, 0.2):
+        decoders = [
+            ImageDecoder(**decoder_kwargs, mean_sources=mean_sources, render_mode=mode).to(device)
+            for mode in render_modes
+        ]
+        for batch_size in (1, 8):
+            batch = decoders[0].sample_prior(batch_size)
+            args = [
+                batch[k] for k in ("n_sources", "locs", "galaxy_bool", "galaxy_params", "fluxes")
+            ]
+            times = [
+                timeit(lambda d=decoder: d.render_images(*args, add_noise=False), device=device)
+                for decoder in decoders
+            ]
+            print(f"{mean_sources:>6} {batch_size:>6} " + " ".join(f"{t:>12.4f}" for t in times))
+
+
+def benchmark_shift_engines(device="cpu"):
+    # find the crossover in ptile_slen between the grid_sample and fft shift engines of Tiler,
+    # both for distinct sources (galaxies) and copies of a single source with a cached spectrum
+    # (stars, i.e. the psf).
+    tile_slen = 4
+    n_ptiles, max_sources, n_bands = 256, 2, 1
+
+    print("shifting sources onto ptiles")
+    print(
+        f"{'ptile':>6} {'grid_sample (s)':>16} {'fft (s)':>10} "
+        f"{'grid_sample psf (s)':>20} {'fft psf (s)':>12}"
+    )
+    for ptile_slen in (8, 12, 20, 28, 36, 52, 76, 100):
+        source_slen = ptile_slen + 1
+        locs = torch.rand(n_ptiles, max_sources, 2, device=device)
+        shape = (n_ptiles, max_sources, n_bands, source_slen, source_slen)
+        sources = torch.rand(*shape, device=device)
+        psf = torch.rand(n_bands, source_slen, source_slen, device=device)
+        fluxes = torch.rand(n_ptiles, max_sources, n_bands, device=device)
+
+        times = []
+        for shift_engine in ("grid_sample", "fft"):
+            tiler = Tiler(tile_slen, ptile_slen, shift_engine=shift_engine).to(device)
+            times.append(timeit(lambda t=tiler: t.render_tile(locs, sources), device=device))
+
+        tiler = Tiler(tile_slen, ptile_slen).to(device)
+        expanded_psf = psf.expand(n_ptiles, max_sources, n_bands, -1, -1)
+        sources_psf = expanded_psf * rearrange(fluxes, "np s b -> np s b 1 1")
+        times.append(timeit(lambda: tiler.render_tile(locs, sources_psf), device=device))
+
+        tiler = Tiler(tile_slen, ptile_slen, shift_engine="fft").to(device)
+        psf_fft = tiler.get_source_fft(psf)
+        times.append(
+            timeit(lambda: tiler.render_tile_fft(locs, psf_fft, source_slen, fluxes), device=device)
+        )
+        print(
+            f"{ptile_slen:>6} {times[0]:>16.4f} {times[1]:>10.4f} "
+            f"{times[2]:>20.4f} {times[3]:>12.4f}"
+        )
+
+
+if __name__ == "__main__":
+    _device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    with torch.no_grad():
+        benchmark_full_image_assembly(_device)
+        benchmark_render_modes(device=_device)
+        benchmark_shift_engines(_device)
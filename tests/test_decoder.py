@@ -0,0 +1,265 @@
+import json
+from pathlib import Path
+
+import pytest
+import torch
+
+from bliss.models.decoder import ImageDecoder, Tiler
+
+
+@pytest.fixture(scope="module")
+def decoder_kwargs(paths):
+    psf_params_file = Path(paths["data"]).joinpath("psField-000094-1-0012.fits").as_posix()
+    return dict(
+        n_bands=1,
+        slen=40,
+        tile_slen=4,
+        ptile_slen=52,
+        border_padding=24,
+        max_sources=2,
+        mean_sources=0.05,
+        prob_galaxy=0.0,
+        psf_params_file=psf_params_file,
+        background_values=(865.0,),
+        sdss_bands=(2,),
+    )
+
+
+def _render(image_decoder, batch):
+    images, var_images = image_decoder.render_images(
+        batch["n_sources"],
+        batch["locs"],
+        batch["galaxy_bool"],
+        batch["galaxy_params"],
+        batch["fluxes"],
+        add_noise=False,
+    )
+    return images, var_images
+
+
+def _assert_close_to_peak(images, expected, background, rtol=1e-4):
+    # differences in interpolation scale with the flux of the sources, so compare relative
+    # to the brightest pixel.
+    peak = (expected - background).abs().max()
+    assert (images - expected).abs().max() <= rtol * peak + 1e-3
+
+
+class TestTiler:
+    def test_render_tile(self, devices):
+        # rendering all sources at once should match rendering them one at a time.
+        device = devices.device
+
+        n_ptiles = 50
+        max_sources = 5
+        n_bands = 2
+        tile_slen = 2
+        ptile_slen = 26
+
+        locs = torch.rand(n_ptiles, max_sources, 2, device=device)
+        sources = torch.rand(
+            n_ptiles, max_sources, n_bands, ptile_slen + 1, ptile_slen + 1, device=device
+        )
+
+        tiler = Tiler(tile_slen, ptile_slen).to(device)
+        expected = torch.zeros(n_ptiles, n_bands, ptile_slen, ptile_slen, device=device)
+        for n in range(max_sources):
+            expected += tiler.render_one_source(locs[:, n], sources[:, n])
+
+        for render_chunk_size in (None, 1, 7, 10000):
+            tiler = Tiler(tile_slen, ptile_slen, render_chunk_size).to(device)
+            ptiles = tiler.render_tile(locs, sources)
+            assert torch.equal(ptiles, expected)
+
+    def test_fft_shift(self, devices):
+        # shifts by a whole number of pixels are exact for both shift engines.
+        device = devices.device
+        n_ptiles, n_bands, tile_slen, ptile_slen = 10, 2, 4, 12
+
+        locs = torch.tensor([[0.125, 0.375]], device=device).repeat(n_ptiles, 1)
+        sources = torch.rand(n_ptiles, n_bands, ptile_slen + 1, ptile_slen + 1, device=device)
+
+        tiler = Tiler(tile_slen, ptile_slen).to(device)
+        fft_tiler = Tiler(tile_slen, ptile_slen, shift_engine="fft").to(device)
+        expected = tiler.render_one_source(locs, sources)
+        assert torch.allclose(fft_tiler.render_one_source(locs, sources), expected, atol=1e-5)
+
+        # copies of a single source can reuse its spectrum.
+        weights = torch.rand(n_ptiles, 1, n_bands, device=device)
+        source_fft = fft_tiler.get_source_fft(sources[0])
+        ptiles = fft_tiler.render_tile_fft(locs.unsqueeze(1), source_fft, ptile_slen + 1, weights)
+        expected = tiler.render_one_source(locs, sources[[0]].expand(n_ptiles, -1, -1, -1))
+        assert torch.allclose(ptiles, expected * weights.view(n_ptiles, n_bands, 1, 1), atol=1e-5)
+
+
+class TestImageDecoder:
+    def test_full_image_from_ptiles(self, devices):
+        # compare overlap-add of ptiles against placing each ptile on the canvas,
+        # one offset (within a ptile) at a time so that sums are accumulated in the same order.
+        device = devices.device
+        batch_size, n_bands = 2, 2
+        slen, tile_slen, ptile_slen, border_padding = 12, 2, 10, 3
+
+        n_tiles1 = slen // tile_slen
+        shape = (batch_size, n_tiles1 ** 2, n_bands, ptile_slen, ptile_slen)
+        image_ptiles = torch.rand(*shape, device=device)
+
+        pad = (ptile_slen - tile_slen) // 2
+        canvas_slen = (n_tiles1 - 1) * tile_slen + ptile_slen
+        canvas = torch.zeros(batch_size, n_bands, canvas_slen, canvas_slen, device=device)
+        step = ptile_slen // tile_slen
+        for di in range(step):
+            for dj in range(step):
+                for i in range(di, n_tiles1, step):
+                    for j in range(dj, n_tiles1, step):
+                        x, y = i * tile_slen, j * tile_slen
+                        ptile = image_ptiles[:, i * n_tiles1 + j]
+                        canvas[:, :, x : x + ptile_slen, y : y + ptile_slen] += ptile
+        x0, x1 = pad - border_padding, pad + slen + border_padding
+        expected = canvas[:, :, x0:x1, x0:x1]
+
+        images = ImageDecoder._construct_full_image_from_ptiles(
+            image_ptiles, tile_slen, border_padding
+        )
+        padded_slen = slen + 2 * border_padding
+        assert images.shape == (batch_size, n_bands, padded_slen, padded_slen)
+        assert torch.equal(images, expected)
+
+    def test_sparse_render(self, decoder_kwargs, devices):
+        # rendering only the sources that are on should give the same images.
+        device = devices.device
+        dense_decoder = ImageDecoder(**decoder_kwargs).to(device)
+        sparse_decoder = ImageDecoder(**decoder_kwargs, render_mode="sparse").to(device)
+
+        with torch.no_grad():
+            batch = dense_decoder.sample_prior(batch_size=4)
+            images, var_images = _render(dense_decoder, batch)
+            sparse_images, sparse_var_images = _render(sparse_decoder, batch)
+
+        assert torch.allclose(images, sparse_images)
+        assert torch.allclose(var_images, sparse_var_images)
+
+    def test_global_render(self, decoder_kwargs, devices):
+        # rendering sources directly on the full image should match rendering ptiles,
+        # up to interpolation differences at the edges of the ptiles.
+        device = devices.device
+        dense_decoder = ImageDecoder(**decoder_kwargs).to(device)
+        global_decoder = ImageDecoder(**decoder_kwargs, render_mode="global").to(device)
+        chunked_decoder = ImageDecoder(
+            **decoder_kwargs, render_mode="global", render_chunk_size=3
+        ).to(device)
+
+        with torch.no_grad():
+            batch = dense_decoder.sample_prior(batch_size=4)
+            images, var_images = _render(dense_decoder, batch)
+            global_images, global_var_images = _render(global_decoder, batch)
+            chunked_images, _ = _render(chunked_decoder, batch)
+
+        assert images.shape == global_images.shape
+        background = decoder_kwargs["background_values"][0]
+        _assert_close_to_peak(global_images, images, background)
+        _assert_close_to_peak(global_var_images, var_images, background)
+        assert torch.allclose(global_images, chunked_images)
+
+    def test_render_without_var(self, decoder_kwargs, devices):
+        # images should not depend on whether the variance is rendered.
+        for render_mode in ("dense", "sparse", "global"):
+            image_decoder = ImageDecoder(**decoder_kwargs, render_mode=render_mode)
+            image_decoder = image_decoder.to(devices.device)
+            with torch.no_grad():
+                batch = image_decoder.sample_prior(batch_size=4)
+                images, _ = _render(image_decoder, batch)
+                args = [batch[k] for k in ("n_sources", "locs", "galaxy_bool", "galaxy_params")]
+                images_only, var_images = image_decoder.render_images(
+                    *args, batch["fluxes"], add_noise=False, render_var=False
+                )
+            assert var_images is None
+            assert torch.equal(images, images_only)
+
+    def test_psf_cache(self, decoder_kwargs, devices):
+        # the psf should only be recomputed when the psf params change.
+        image_decoder = ImageDecoder(**decoder_kwargs).to(devices.device)
+        star_tile_decoder = image_decoder.star_tile_decoder
+        star_tile_decoder.requires_grad_(False)
+
+        psf = star_tile_decoder._adjust_psf()
+        assert torch.equal(psf, star_tile_decoder._get_adjusted_psf())
+        assert star_tile_decoder._adjust_psf() is psf
+        assert (star_tile_decoder.psf_cache_hits, star_tile_decoder.psf_cache_misses) == (1, 1)
+
+        star_tile_decoder.params[0, 0] += 0.1
+        new_psf = star_tile_decoder._adjust_psf()
+        assert star_tile_decoder.psf_cache_misses == 2
+        assert not torch.allclose(new_psf, psf)
+        assert torch.equal(new_psf, star_tile_decoder._get_adjusted_psf())
+
+        # gradients w.r.t. the psf params bypass the cache.
+        star_tile_decoder.requires_grad_(True)
+        assert star_tile_decoder._adjust_psf().requires_grad
+        assert (star_tile_decoder.psf_cache_hits, star_tile_decoder.psf_cache_misses) == (1, 2)
+
+    def test_fft_shift_engine(self, decoder_kwargs, devices):
+        # shifting with FFTs should be consistent across rendering modes, and close to
+        # rendering with bilinear interpolation.
+        device = devices.device
+        decoder = ImageDecoder(**decoder_kwargs).to(device)
+        fft_decoder = ImageDecoder(**decoder_kwargs, shift_engine="fft").to(device)
+        global_fft_decoder = ImageDecoder(
+            **decoder_kwargs, shift_engine="fft", render_mode="global"
+        ).to(device)
+
+        with torch.no_grad():
+            batch = decoder.sample_prior(batch_size=4)
+            images, _ = _render(decoder, batch)
+            fft_images, _ = _render(fft_decoder, batch)
+            global_fft_images, _ = _render(global_fft_decoder, batch)
+
+        background = decoder_kwargs["background_values"][0]
+        _assert_close_to_peak(global_fft_images, fft_images, background)
+        total_flux = (images - background).sum()
+        assert torch.allclose((fft_images - background).sum(), total_flux, rtol=1e-4)
+
+    def test_galaxy_stamp_bank(self, sleep_setup, devices, tmp_path):
+        # rendering galaxies from the precomputed stamp bank should match the galaxy decoder.
+        cfg = sleep_setup.get_cfg({"model": "sleep_galaxy_detection_basic"})
+        decoder_kwargs = dict(cfg.model.kwargs.decoder_kwargs)
+        decoder_kwargs.update({"mean_sources": 0.1})
+        image_decoder = ImageDecoder(**decoder_kwargs).to(devices.device)
+        stamp_bank_file = tmp_path.joinpath("stamp_bank.npy").as_posix()
+        bank_decoders = [
+            ImageDecoder(
+                **decoder_kwargs,
+                galaxy_stamp_bank=True,
+                galaxy_stamp_bank_file=stamp_bank_file,
+                render_mode=render_mode,
+            ).to(devices.device)
+            for render_mode in ("dense", "sparse")
+        ]
+        assert not image_decoder.has_galaxy_stamp_bank
+        assert all(decoder.has_galaxy_stamp_bank for decoder in bank_decoders)
+
+        with torch.no_grad():
+            batch = bank_decoders[0].sample_prior(batch_size=4)
+            galaxy_indices = batch.pop("galaxy_indices")
+            images, var_images = _render(image_decoder, batch)
+            for bank_decoder in bank_decoders:
+                bank_images, bank_var_images = bank_decoder.render_images(
+                    batch["n_sources"],
+                    batch["locs"],
+                    batch["galaxy_bool"],
+                    batch["galaxy_params"],
+                    batch["fluxes"],
+                    add_noise=False,
+                    galaxy_indices=galaxy_indices,
+                )
+                assert torch.allclose(images, bank_images, atol=1e-3)
+                assert torch.allclose(var_images, bank_var_images, atol=1e-3)
+
+        # a bank built from other latents or another autoencoder is rebuilt.
+        key_file = tmp_path.joinpath("stamp_bank.json")
+        key = json.loads(key_file.read_text())
+        key_file.write_text(json.dumps({**key, "latents_sha256": "other"}))
+        with pytest.warns(UserWarning, match="Rebuilding"):
+            ImageDecoder(
+                **decoder_kwargs, galaxy_stamp_bank=True, galaxy_stamp_bank_file=stamp_bank_file
+            )
+        assert json.loads(key_file.read_text()) == key
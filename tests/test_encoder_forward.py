@@ -1,5 +1,9 @@
+import copy
+
+import pytest
 import torch
 import numpy as np
+from torch import nn
 
 from bliss.models import encoder
 
@@ -167,3 +171,218 @@ class TestSourceEncoder:
                 assert torch.all(pred_i["loc_logvar"].eq(pred["loc_logvar"][i]))
                 assert torch.all(pred_i["log_flux_mean"].eq(pred["log_flux_mean"][i]))
                 assert torch.all(pred_i["log_flux_logvar"].eq(pred["log_flux_logvar"][i]))
+
+    def test_tile_map_inference_images(self, devices):
+        """Consistency check of the single pass inference vs separate calls."""
+        device = devices.device
+
+        batch_size = 2
+        max_detections = 2
+        ptile_slen = 10
+        tile_slen = 2
+        n_bands = 1
+        slen = 8
+
+        star_encoder = encoder.ImageEncoder(
+            ptile_slen=ptile_slen,
+            tile_slen=tile_slen,
+            n_bands=n_bands,
+            max_detections=max_detections,
+        ).to(device)
+
+        with torch.no_grad():
+            star_encoder.eval()
+            images = torch.randn(batch_size, n_bands, slen + 8, slen + 8, device=device) + 10.0
+            image_ptiles = star_encoder.get_images_in_tiles(images)
+
+            tile_n_sources, var_params, tile_estimate = star_encoder.tile_map_inference_images(
+                images
+            )
+
+            expected_n_sources = star_encoder.tile_map_n_sources(image_ptiles)
+            expected_var_params = star_encoder.forward(image_ptiles, expected_n_sources)
+            expected_tile_estimate = star_encoder.tile_map_estimate(images)
+
+            assert torch.equal(tile_n_sources, expected_n_sources)
+            assert var_params.keys() == expected_var_params.keys()
+            for key, value in var_params.items():
+                assert torch.allclose(value, expected_var_params[key])
+            assert tile_estimate.keys() == expected_tile_estimate.keys()
+            for key, value in tile_estimate.items():
+                assert torch.allclose(value, expected_tile_estimate[key])
+
+    def test_optimize_for_inference(self, devices):
+        """Fusing batchnorms and removing dropout should not change the outputs in eval mode."""
+        device = devices.device
+
+        star_encoder = encoder.ImageEncoder(
+            ptile_slen=10,
+            tile_slen=2,
+            n_bands=2,
+            max_detections=2,
+            spatial_dropout=0.1,
+            dropout=0.1,
+        ).to(device)
+        images = torch.randn(2, 2, 16, 16, device=device) * 10.0 + 100.0
+
+        with torch.no_grad():
+            # update the running statistics of the batchnorms.
+            for _ in range(3):
+                star_encoder.tile_map_estimate(images)
+            star_encoder.eval()
+            expected = star_encoder.tile_map_estimate(images)
+
+            for channels_last in (False, True):
+                fused_encoder = copy.deepcopy(star_encoder)
+                fused_encoder.optimize_for_inference(channels_last=channels_last)
+                layers = list(fused_encoder.modules())
+                assert not any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in layers)
+                assert not any(isinstance(m, (nn.Dropout, nn.Dropout2d)) for m in layers)
+
+                tile_estimate = fused_encoder.tile_map_estimate(images)
+                for key, value in tile_estimate.items():
+                    assert torch.allclose(value, expected[key], atol=1e-5)
+
+    def test_fully_convolutional(self, devices):
+        """The shared-trunk encoder should encode full images with the same outputs and weights."""
+        device = devices.device
+        kwargs = dict(ptile_slen=12, tile_slen=4, n_bands=2, max_detections=2)
+        star_encoder = encoder.ImageEncoder(**kwargs).to(device)
+        conv_encoder = encoder.ImageEncoder(**kwargs, fully_convolutional=True).to(device)
+        conv_encoder.load_state_dict(star_encoder.state_dict())
+
+        # 2 x 3 tiles of 4 pixels, with a border of 4 pixels.
+        images = torch.randn(2, 2, 16, 20, device=device) * 10.0 + 100.0
+        h = star_encoder.encode(images)
+        conv_h = conv_encoder.encode(images)
+        assert h.shape == conv_h.shape == (2 * 6, star_encoder.dim_out_all)
+
+        # the CNN is trained through the windows of its output.
+        tile_n_sources = torch.randint(0, 3, (2 * 6,), device=device)
+        var_params = conv_encoder.forward_images(images, tile_n_sources)
+        var_params["loc_mean"].sum().backward()
+        assert all(p.grad is not None for p in conv_encoder.enc_conv.parameters())
+
+        with torch.no_grad():
+            conv_encoder.eval()
+            tile_estimate = conv_encoder.tile_map_estimate(images)
+        assert tile_estimate["locs"].shape == (2, 6, 2, 2)
+
+        with pytest.raises(AssertionError):
+            encoder.ImageEncoder(ptile_slen=10, tile_slen=2, fully_convolutional=True)
+
+        # padded tiles cannot be encoded on their own.
+        with pytest.raises(AssertionError):
+            conv_encoder.forward(star_encoder.get_images_in_tiles(images), tile_n_sources)
+
+    def test_fully_convolutional_matches_ptiles(self, devices):
+        """The shared-trunk encoder should give the same h as the ptile encoder (same CNN)
+        run on each padded tile with the context its receptive field sees in the full image."""
+        device = devices.device
+        kwargs = dict(ptile_slen=12, tile_slen=4, n_bands=1, max_detections=2)
+        star_encoder = encoder.ImageEncoder(**kwargs).to(device).eval()
+        conv_encoder = encoder.ImageEncoder(**kwargs, fully_convolutional=True).to(device).eval()
+        conv_encoder.load_state_dict(star_encoder.state_dict())
+
+        # 26 x 26 tiles, so that interior tiles are far from the edges of the image.
+        n_tiles1 = 26
+        slen = n_tiles1 * 4 + 2 * star_encoder.border_padding
+        images = torch.randn(2, 1, slen, slen, device=device) * 10.0 + 100.0
+        log_img = torch.log(images - images.min() + 1.0)
+
+        def encode_ptile(i, j, margin):
+            # the padded tile of tile (i, j) with `margin` more pixels on each side (within
+            # the image), margin = 0 is the ptile encoder.
+            r0, c0 = max(0, 4 * i - margin), max(0, 4 * j - margin)
+            crop = log_img[:, :, r0 : 4 * i + 12 + margin, c0 : 4 * j + 12 + margin]
+            features = star_encoder.enc_conv(crop)
+            fi, fj = (4 * i - r0) // 4, (4 * j - c0) // 4
+            window = star_encoder.dim_enc_conv_out
+            return star_encoder.enc_final(features[:, :, fi : fi + window, fj : fj + window])
+
+        with torch.no_grad():
+            conv_h = conv_encoder.encode(images).view(2, n_tiles1, n_tiles1, -1)
+            for i, j in ((0, 0), (13, 13), (25, 25), (0, 13), (7, 20)):
+                # the features of the CNN depend on pixels up to 40 pixels away.
+                assert torch.allclose(conv_h[:, i, j], encode_ptile(i, j, 40), atol=1e-6)
+
+            # the ptile encoder zero-pads each padded tile instead.
+            assert not torch.allclose(conv_h[:, 13, 13], encode_ptile(13, 13, 0), atol=1e-3)
+
+    def test_iter_images_in_tiles(self, devices):
+        """Extracting ptiles in chunks should not change the ptiles or the outputs."""
+        device = devices.device
+        kwargs = dict(ptile_slen=10, tile_slen=2, n_bands=2, max_detections=2)
+        star_encoder = encoder.ImageEncoder(**kwargs).to(device).eval()
+        images = torch.randn(3, 2, 16, 20, device=device) * 10.0 + 100.0
+
+        image_ptiles = star_encoder.get_images_in_tiles(images)
+        with torch.no_grad():
+            h = star_encoder.encode(images)
+
+        # 6 x 8 ptiles per image, of 800 bytes each; chunks have at least one row of ptiles.
+        for max_ptiles_mb in (1.0, 100 * 800 / 2 ** 20, 20 * 800 / 2 ** 20, 1e-6):
+            chunked_encoder = encoder.ImageEncoder(**kwargs, max_ptiles_mb=max_ptiles_mb)
+            chunked_encoder.load_state_dict(star_encoder.state_dict())
+            chunked_encoder = chunked_encoder.to(device).eval()
+            with torch.no_grad():
+                chunks = list(chunked_encoder.iter_images_in_tiles(images))
+            max_ptiles = max(1, int(max_ptiles_mb * 2 ** 20 // 800))
+            assert all(len(chunk) <= max(max_ptiles, 8) for chunk in chunks)
+            assert torch.equal(torch.cat(chunks), image_ptiles)
+            with torch.no_grad():
+                assert torch.allclose(chunked_encoder.encode(images), h, atol=1e-5)
+
+    def test_map_images_in_tiles_with_grad(self, devices):
+        """With gradients, each chunk of ptiles is checkpointed: the gradients are the same, but
+        only the ptiles (and activations) of one chunk are in memory at a time."""
+        device = devices.device
+        kwargs = dict(ptile_slen=10, tile_slen=2, n_bands=2, max_detections=2)
+        star_encoder = encoder.ImageEncoder(**kwargs).to(device).eval()
+        chunked_encoder = encoder.ImageEncoder(**kwargs, max_ptiles_mb=20 * 800 / 2 ** 20)
+        chunked_encoder.load_state_dict(star_encoder.state_dict())
+        chunked_encoder = chunked_encoder.to(device).eval()
+        images = torch.randn(3, 2, 16, 20, device=device) * 10.0 + 100.0
+
+        # record the number of ptiles extracted at once, in forward and in backward.
+        n_ptiles = []
+        get_images_in_tiles = chunked_encoder.get_images_in_tiles
+
+        def record_images_in_tiles(images):
+            image_ptiles = get_images_in_tiles(images)
+            n_ptiles.append(image_ptiles.shape[0])
+            return image_ptiles
+
+        chunked_encoder.get_images_in_tiles = record_images_in_tiles
+
+        # bytes of the tensors saved for backward.
+        saved_bytes = {}
+        for name, image_encoder in (("full", star_encoder), ("chunked", chunked_encoder)):
+            saved_bytes[name] = 0
+            if hasattr(torch.autograd, "graph"):
+
+                def pack(tensor, name=name):
+                    saved_bytes[name] += tensor.numel() * tensor.element_size()
+                    return tensor
+
+                with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                    h = image_encoder.encode(images)
+            else:
+                h = image_encoder.encode(images)
+            h.pow(2).sum().backward()
+
+        # 4 x 6 ptiles per image, in chunks of 3 and 1 rows, recomputed in backward.
+        assert sorted(n_ptiles) == [6] * 6 + [18] * 6
+        assert saved_bytes["chunked"] <= images.numel() * images.element_size() * 2
+        assert saved_bytes["chunked"] < saved_bytes["full"] / 10
+        for p, chunked_p in zip(star_encoder.parameters(), chunked_encoder.parameters()):
+            assert torch.allclose(p.grad, chunked_p.grad, rtol=1e-4, atol=1e-5)
+
+        # in training, the running statistics are updated once per chunk (not in backward).
+        chunked_encoder.train()
+        expected_encoder = copy.deepcopy(chunked_encoder)
+        with torch.no_grad():
+            expected_encoder.encode(images)
+        chunked_encoder.encode(images).sum().backward()
+        for buffer, expected_buffer in zip(chunked_encoder.buffers(), expected_encoder.buffers()):
+            assert torch.equal(buffer, expected_buffer)
@@ -4,10 +4,48 @@ import numpy as np
 import torch
 from torch.distributions import Normal
 
-from bliss.sleep import _get_params_logprob_all_combs, _get_min_perm_loss
+from bliss.sleep import (
+    MAX_ENUMERATED_MATCHINGS,
+    MAX_PERM_DETECTIONS,
+    _get_params_logprob_all_combs,
+    _get_min_perm_loss,
+    _get_hungarian_loss,
+    _get_perms,
+)
 from bliss.models.encoder import get_is_on_from_n_sources
 
 
+def _get_min_perm_loss_loop(
+    locs_log_probs_all, star_params_log_probs_all, prob_galaxy, true_galaxy_bool, is_on_array
+):
+    # reference implementation of `_get_min_perm_loss`, with a loop over the permutations.
+    max_detections = star_params_log_probs_all.size(-1)
+    locs_log_probs_all_perm = []
+    star_params_log_probs_all_perm = []
+    galaxy_bool_log_probs_all_perm = []
+    for perm in permutations(range(max_detections)):
+        locs_log_probs_all_perm.append(
+            (locs_log_probs_all[:, perm].diagonal(dim1=1, dim2=2) * is_on_array).sum(1)
+        )
+        star_params_log_probs_all_perm.append(
+            (
+                star_params_log_probs_all[:, perm].diagonal(dim1=1, dim2=2)
+                * is_on_array
+                * (1 - true_galaxy_bool)
+            ).sum(1)
+        )
+        _prob_galaxy = prob_galaxy[:, perm]
+        galaxy_bool_loss = true_galaxy_bool * torch.log(_prob_galaxy)
+        galaxy_bool_loss += (1 - true_galaxy_bool) * torch.log(1 - _prob_galaxy)
+        galaxy_bool_log_probs_all_perm.append((galaxy_bool_loss * is_on_array).sum(1))
+
+    locs_loss, indx = torch.min(-torch.stack(locs_log_probs_all_perm, 1), dim=1)
+    _indx = indx.unsqueeze(1)
+    star_params_loss = -torch.stack(star_params_log_probs_all_perm, 1).gather(1, _indx)
+    galaxy_bool_loss = -torch.stack(galaxy_bool_log_probs_all_perm, 1).gather(1, _indx)
+    return locs_loss, star_params_loss.squeeze(1), galaxy_bool_loss.squeeze(1)
+
+
 class TestStarEncoderObjective:
     def test_get_params_logprob_all_combs(self, devices):
         # this checks that our function to return all combination of losses
@@ -184,3 +222,74 @@ class TestStarEncoderObjective:
             assert torch.abs(locs_loss[i] - min_locs_loss) < 1e-5
             assert torch.abs(star_params_loss[i] - min_star_params_loss) < 1e-5
             assert torch.abs(galaxy_bool_loss[i] - min_galaxy_bool_loss) < 1e-5
+
+    def test_get_hungarian_loss(self, devices):
+        """The Hungarian matching should give the same losses as trying all permutations."""
+        device = devices.device
+
+        n_ptiles = 100
+        n_bands = 2
+        max_detections = MAX_PERM_DETECTIONS + 1
+
+        true_n_sources = torch.randint(0, max_detections + 1, (n_ptiles,), device=device)
+        true_is_on_array = get_is_on_from_n_sources(true_n_sources, max_detections).float()
+        true_locs = torch.rand(n_ptiles, max_detections, 2, device=device)
+        true_locs *= true_is_on_array.unsqueeze(2)
+        true_log_fluxes = torch.randn(n_ptiles, max_detections, n_bands, device=device)
+        true_log_fluxes *= true_is_on_array.unsqueeze(2)
+        true_galaxy_bool = (torch.rand(n_ptiles, max_detections, device=device) > 0.5).float()
+
+        loc_mean = torch.rand(n_ptiles, max_detections, 2, device=device)
+        loc_mean = loc_mean + (true_is_on_array == 0).float().unsqueeze(-1) * 1e16
+        loc_logvar = torch.randn(n_ptiles, max_detections, 2, device=device)
+        log_flux_mean = torch.randn(n_ptiles, max_detections, n_bands, device=device)
+        log_flux_logvar = torch.randn(n_ptiles, max_detections, n_bands, device=device)
+        prob_galaxy = torch.rand(n_ptiles, max_detections, device=device)
+
+        args = (
+            _get_params_logprob_all_combs(true_locs, loc_mean, loc_logvar),
+            _get_params_logprob_all_combs(true_log_fluxes, log_flux_mean, log_flux_logvar),
+            prob_galaxy,
+            true_galaxy_bool,
+            true_is_on_array,
+        )
+        expected_losses = _get_min_perm_loss(*args)
+
+        # compare all the matchings at once, or solve each tile with scipy.
+        for max_enumerated_matchings in (MAX_ENUMERATED_MATCHINGS, 0):
+            losses = _get_hungarian_loss(*args, max_enumerated_matchings=max_enumerated_matchings)
+            for loss, expected_loss in zip(losses, expected_losses):
+                assert loss.shape == expected_loss.shape == (n_ptiles,)
+                assert torch.allclose(loss, expected_loss)
+
+    def test_get_min_perm_loss_precomputed_perms(self, devices):
+        """The precomputed permutations should give the same losses as looping over them."""
+        device = devices.device
+
+        n_ptiles = 100
+        n_bands = 2
+        for max_detections in range(1, MAX_PERM_DETECTIONS + 1):
+            true_n_sources = torch.randint(0, max_detections + 1, (n_ptiles,), device=device)
+            true_is_on_array = get_is_on_from_n_sources(true_n_sources, max_detections).float()
+            true_locs = torch.rand(n_ptiles, max_detections, 2, device=device)
+            true_log_fluxes = torch.randn(n_ptiles, max_detections, n_bands, device=device)
+            true_galaxy_bool = (torch.rand(n_ptiles, max_detections, device=device) > 0.5).float()
+
+            loc_mean = torch.rand(n_ptiles, max_detections, 2, device=device)
+            loc_logvar = torch.randn(n_ptiles, max_detections, 2, device=device)
+            log_flux_mean = torch.randn(n_ptiles, max_detections, n_bands, device=device)
+            log_flux_logvar = torch.randn(n_ptiles, max_detections, n_bands, device=device)
+            prob_galaxy = torch.rand(n_ptiles, max_detections, device=device)
+
+            args = (
+                _get_params_logprob_all_combs(true_locs, loc_mean, loc_logvar),
+                _get_params_logprob_all_combs(true_log_fluxes, log_flux_mean, log_flux_logvar),
+                prob_galaxy,
+                true_galaxy_bool,
+                true_is_on_array,
+            )
+            perms = _get_perms(max_detections).to(device)
+            losses = _get_min_perm_loss(*args, perms=perms)
+            for loss, expected_loss in zip(losses, _get_min_perm_loss_loop(*args)):
+                assert loss.shape == expected_loss.shape == (n_ptiles,)
+                assert torch.allclose(loss, expected_loss)
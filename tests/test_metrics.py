@@ -0,0 +1,164 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from bliss import metrics as metrics_lib
+
+
+def _get_params(batch_size, max_sources, n_bands, n_galaxy_params, device):
+    n_sources = torch.randint(0, max_sources + 1, (batch_size,), device=device)
+    is_on = torch.arange(max_sources, device=device) < n_sources.unsqueeze(1)
+    is_on = is_on.float().unsqueeze(2)
+    locs = torch.rand(batch_size, max_sources, 2, device=device)
+    fluxes = 10 ** (torch.rand(batch_size, max_sources, n_bands, device=device) + 3)
+    return {
+        "n_sources": n_sources,
+        "locs": locs * is_on,
+        "fluxes": fluxes * is_on,
+        "galaxy_bool": (torch.rand(batch_size, max_sources, 1, device=device) > 0.5) * is_on,
+        "galaxy_params": torch.randn(batch_size, max_sources, n_galaxy_params, device=device),
+    }
+
+
+def test_eval_error_on_batch(devices):
+    # the batched metrics should match evaluating each image on its own.
+    device = devices.device
+    slen = 10
+    batch_size = 20
+    for n_bands, n_galaxy_params in ((1, 1), (2, 8)):
+        true_params = _get_params(batch_size, 6, n_bands, n_galaxy_params, device)
+        est_params = _get_params(batch_size, 4, n_bands, n_galaxy_params, device)
+        errors = metrics_lib.eval_error_on_batch(true_params, est_params, slen)
+
+        expected = {key: [] for key in ("locs_mae_vec", "fluxes_mae_vec", "galaxy_params_mae_vec")}
+        for i in range(batch_size):
+            ntrue = int(true_params["n_sources"][i])
+            nest = int(est_params["n_sources"][i])
+            if ntrue == 0 or nest == 0:
+                assert errors["tpr_vec"][i] == 0 and errors["ppv_vec"][i] == 0
+                continue
+            true_locs = true_params["locs"][i, :ntrue] * slen
+            est_locs = est_params["locs"][i, :nest] * slen
+            true_mag = torch.log10(true_params["fluxes"][i, :ntrue]) * 2.5
+            est_mag = torch.log10(est_params["fluxes"][i, :nest]) * 2.5
+            tpr, ppv = metrics_lib.get_tpr_ppv(true_locs, true_mag, est_locs, est_mag)
+            assert torch.isclose(errors["tpr_vec"][i], tpr)
+            assert torch.isclose(errors["ppv_vec"][i], ppv)
+
+            locs_mae, fluxes_mae = metrics_lib.get_l1_error(true_locs, true_mag, est_locs, est_mag)
+            _, galaxy_params_mae = metrics_lib.get_l1_error(
+                true_locs,
+                true_params["galaxy_params"][i, :ntrue],
+                est_locs,
+                est_params["galaxy_params"][i, :nest],
+            )
+            expected["locs_mae_vec"].append(locs_mae)
+            expected["fluxes_mae_vec"].append(fluxes_mae)
+            expected["galaxy_params_mae_vec"].append(galaxy_params_mae)
+
+        for key, value in expected.items():
+            assert torch.allclose(errors[key], torch.cat(value))
+        assert torch.equal(
+            errors["count_bool"], true_params["n_sources"].eq(est_params["n_sources"])
+        )
+
+
+def test_match_catalogs():
+    # a field of well separated blends of 2 sources, with noisy estimates, missed and spurious
+    # sources.
+    n_true = 500
+    true_locs = torch.rand(n_true // 2, 2).repeat_interleave(2, 0) * 2000
+    true_locs[1::2, 0] += 1.0
+    true_mag = torch.rand(n_true, 1) * 5 + 15
+    est_locs = torch.cat((true_locs[:450] + torch.randn(450, 2) * 0.1, torch.rand(50, 2) * 2000))
+    est_mag = torch.cat((true_mag[:450] + torch.randn(450, 1) * 0.1, torch.rand(50, 1) + 15))
+
+    matches = metrics_lib.match_catalogs(true_locs, est_locs, true_mag, est_mag, radius=2.0)
+    expected_mag = true_mag[matches["true_indx"]] - est_mag[matches["est_indx"]]
+    assert torch.allclose(matches["fluxes_mae_vec"], expected_mag.abs().flatten())
+    is_same = matches["true_indx"] == matches["est_indx"]
+    assert is_same[matches["true_indx"] < 450].all()
+    assert 0.85 <= matches["tpr"] <= 0.95
+    assert matches["ppv"] == matches["tpr"]
+
+    parallel_matches = metrics_lib.match_catalogs(
+        true_locs, est_locs, true_mag, est_mag, radius=2.0, n_workers=2
+    )
+    for key, value in matches.items():
+        assert torch.equal(parallel_matches[key], value)
+
+    # when all pairs are candidates, the matching minimizes the same errors as `inner_join_locs`.
+    true_locs, est_locs = torch.rand(30, 2) * 10, torch.rand(20, 2) * 10
+    matches = metrics_lib.match_catalogs(true_locs, est_locs, radius=10.0)
+    _, _, row_indx, col_indx = metrics_lib.inner_join_locs(true_locs, est_locs)
+    expected_error = (true_locs[row_indx] - est_locs[col_indx]).abs().sum()
+    assert len(matches["true_indx"]) == 20
+    assert torch.isclose(matches["locs_mae_vec"].sum(), expected_error)
+    assert matches["ppv"] == 1.0
+
+    # empty catalogs have no matches.
+    for n_true, n_est in ((0, 0), (0, 20), (30, 0)):
+        true_locs, est_locs = torch.rand(n_true, 2) * 10, torch.rand(n_est, 2) * 10
+        true_mag, est_mag = torch.rand(n_true, 1) + 15, torch.rand(n_est, 1) + 15
+        matches = metrics_lib.match_catalogs(true_locs, est_locs, true_mag, est_mag, n_workers=2)
+        assert len(matches["true_indx"]) == len(matches["est_indx"]) == 0
+        assert len(matches["locs_mae_vec"]) == len(matches["fluxes_mae_vec"]) == 0
+        assert matches["tpr"] == matches["ppv"] == 0.0
+
+
+def test_metrics_accumulator(devices):
+    # accumulating metrics over batches should match computing them on all values at once.
+    device = devices.device
+    values = torch.randn(1000, device=device)
+    counts = torch.rand(100, device=device) > 0.5
+
+    accumulator = metrics_lib.MetricsAccumulator(
+        ("values", "counts", "other"), median_names=("values",), reservoir_size=2000
+    )
+    for i in range(10):
+        accumulator.update(
+            {"values": values[i * 100 : (i + 1) * 100], "counts": counts[i * 10 : (i + 1) * 10]}
+        )
+    results = accumulator.compute()
+    assert results.keys() == {"values", "values_median", "counts"}  # "other" has no values.
+    assert torch.isclose(results["values"], values.mean())
+    assert torch.isclose(results["values_median"], values.median())
+    assert torch.isclose(results["counts"], counts.float().mean())
+
+    # the median is estimated from a uniform sample of the values, with its own random stream.
+    accumulator = metrics_lib.MetricsAccumulator(
+        ("values",), median_names=("values",), reservoir_size=200
+    )
+    rng_state = torch.random.get_rng_state()
+    for i in range(10):
+        accumulator.update({"values": values[i * 100 : (i + 1) * 100]})
+    assert torch.equal(torch.random.get_rng_state(), rng_state)
+    assert len(accumulator.reservoirs["values"][1]) == 200
+    assert (accumulator.compute()["values_median"] - values.median()).abs() < 0.5
+
+    accumulator.reset()
+    assert not accumulator.compute()
+
+
+def _compute_distributed_metrics(rank, init_file, results):
+    dist.init_process_group("gloo", f"file://{init_file}", rank=rank, world_size=2)
+    accumulator = metrics_lib.MetricsAccumulator(("a", "b"), median_names=("a", "b"))
+    accumulator.update({"a": torch.arange(4.0) + 4 * rank})
+    if rank == 0:
+        accumulator.update({"b": torch.ones(3)})
+    results[rank] = accumulator.compute()
+    dist.destroy_process_group()
+
+
+def test_metrics_accumulator_distributed(tmp_path):
+    # processes that did not see the same metrics should still reduce them together.
+    with mp.Manager() as manager:
+        results = manager.dict()
+        init_file = tmp_path.joinpath("init").as_posix()
+        mp.spawn(_compute_distributed_metrics, (init_file, results), nprocs=2)
+        results = dict(results)
+    for rank_results in results.values():
+        assert torch.isclose(rank_results["a"], torch.tensor(3.5))
+        assert torch.isclose(rank_results["a_median"], torch.tensor(3.0))
+        assert torch.isclose(rank_results["b"], torch.tensor(1.0))
+        assert torch.isclose(rank_results["b_median"], torch.tensor(1.0))
@@ -1,3 +1,8 @@
+import json
+
+import numpy as np
+import pytest
+import torch
 from hydra import initialize, compose
 from bliss import predict
 
@@ -16,3 +21,133 @@ def test_predict_run(devices):
     with initialize(config_path="../config"):
         cfg = compose("config", overrides=overrides)
         predict.predict(cfg)
+
+
+def test_predict_on_image(sleep_setup, devices):
+    # stitching the sliding windows should give the same tiles as encoding the image at once,
+    # including the remainders at the right and bottom of the image.
+    sleep_net = sleep_setup.get_sleep({"model": "sleep_star_basic"}).to(devices.device).eval()
+    image_encoder = sleep_net.image_encoder
+    image = torch.randn(1, 1, 53, 71) * 10 + 865.0
+
+    n_tiles_h, n_tiles_w = predict.get_n_tiles(image.shape, 2, image_encoder.border_padding)
+    h = n_tiles_h * 2 + 2 * image_encoder.border_padding
+    w = n_tiles_w * 2 + 2 * image_encoder.border_padding
+    with torch.no_grad():
+        _, expected, _ = image_encoder.tile_map_inference_images(
+            image[:, :, :h, :w].to(devices.device)
+        )
+
+        for chunk_slen, batch_chunks in ((10, 1), (16, 3), (200, 2), (10, None)):
+            results = list(predict.predict_on_image(image, sleep_net, chunk_slen, batch_chunks))
+            tile_indices = torch.cat([r["tile_indices"] for r in results])
+            assert torch.equal(tile_indices.sort()[0], torch.arange(n_tiles_h * n_tiles_w))
+            for key, value in expected.items():
+                stitched = torch.cat([r[key] for r in results])
+                assert torch.allclose(stitched, value[tile_indices], atol=1e-5)
+
+
+def test_export_predictor(sleep_setup, devices, tmp_path):
+    # the traced predictor should give the same results, including for the last (padded) batch.
+    sleep_net = sleep_setup.get_sleep({"model": "sleep_star_basic"}).to(devices.device).eval()
+    predictor_file = tmp_path.joinpath("predictor.pt").as_posix()
+    chunk_slen = 16 + 2 * sleep_net.image_encoder.border_padding
+    predict.export_predictor(sleep_net, predictor_file, (2, 1, chunk_slen, chunk_slen))
+    traced_predictor = predict.TracedChunkPredictor(predictor_file, devices.device)
+    image = torch.randn(1, 1, 53, 71) * 10 + 865.0
+
+    with torch.no_grad():
+        results = list(predict.predict_on_image(image, sleep_net, 16, 2))
+        traced_results = list(predict.predict_on_image(image, traced_predictor, 16))
+    assert len(results) == len(traced_results) == 8
+    for result, traced_result in zip(results, traced_results):
+        assert result.keys() == traced_result.keys()
+        for key, value in result.items():
+            assert torch.allclose(value, traced_result[key], atol=1e-5)
+
+
+def test_load_predictor(devices, tmp_path):
+    # the traced predictor should only be used with the settings it was exported with.
+    overrides = {
+        "mode": "export",
+        "predict": "sdss_basic",
+        "predict.device": f"cuda:{devices.device.index}" if devices.use_cuda else "cpu",
+        "predict.checkpoint": "null",
+        "predict.chunk_slen": 16,
+        "predict.batch_chunks": 2,
+        "predict.predictor_file": tmp_path.joinpath("predictor.pt").as_posix(),
+        "model": "sleep_star_basic",
+    }
+    overrides = [f"{k}={v}" for k, v in overrides.items()]
+    with initialize(config_path="../config"):
+        cfg = compose("config", overrides=overrides)
+        predict.export(cfg)
+        assert isinstance(predict.load_predictor(cfg), predict.TracedChunkPredictor)
+
+        # other settings fall back to the checkpoint, with a warning.
+        cfg.predict.chunk_slen = 20
+        with pytest.warns(UserWarning, match="exported with other settings"):
+            assert isinstance(predict.load_predictor(cfg), predict.ChunkPredictor)
+
+
+def test_output_sinks(tmp_path):
+    # results should end up at their tile in the full frame, both in memory and on disk.
+    n_tiles_h, n_tiles_w = 3, 5
+    tile_indices = torch.randperm(n_tiles_h * n_tiles_w)
+    values = torch.rand(n_tiles_h * n_tiles_w, 1, 2)
+    sinks = [
+        predict.MemorySink(n_tiles_h, n_tiles_w),
+        predict.NpySink(tmp_path, n_tiles_h, n_tiles_w),
+    ]
+    for sink in sinks:
+        sink.write({"tile_indices": tile_indices[:7], "loc_mean": values[tile_indices[:7]]})
+        assert sink.get_results()["tile_is_written"].sum() == 7
+        sink.write({"tile_indices": tile_indices[7:], "loc_mean": values[tile_indices[7:]]})
+        sink.close()
+
+        results = sink.get_results()
+        assert results["tile_is_written"].all()
+        assert torch.equal(results["loc_mean"], values.view(n_tiles_h, n_tiles_w, 1, 2))
+
+    loc_mean = np.load(tmp_path.joinpath("loc_mean.npy"))
+    assert np.array_equal(loc_mean, values.view(n_tiles_h, n_tiles_w, 1, 2).numpy())
+
+    # a new sink in the same directory does not keep the results of the previous one.
+    sink = predict.NpySink(tmp_path, n_tiles_h, n_tiles_w)
+    sink.write({"tile_indices": tile_indices[:1], "loc_mean": values[tile_indices[:1]]})
+    sink.close()
+    assert sink.get_results()["tile_is_written"].sum() == 1
+    loc_mean = np.load(tmp_path.joinpath("loc_mean.npy")).reshape(-1, 1, 2)
+    assert np.count_nonzero(loc_mean.any(axis=(1, 2))) == 1
+
+
+def test_predict_survey(devices, tmp_path):
+    overrides = {
+        "mode": "predict_survey",
+        "predict": "sdss_basic",
+        "predict.device": f"cuda:{devices.device.index}" if devices.use_cuda else "cpu",
+        "predict.testing": True,
+        "predict.checkpoint": "null",
+        "predict.survey.output_dir": tmp_path.as_posix(),
+        "predict.survey.fields": "[[3900,6,269],[3900,6,1]]",
+        "model": "sleep_sdss_measure_simple",
+    }
+    overrides = [f"{k}={v}" for k, v in overrides.items()]
+    with initialize(config_path="../config"):
+        cfg = compose("config", overrides=overrides)
+        predict.predict_survey(cfg)
+
+        # the missing field fails without stopping the survey.
+        index_file = tmp_path.joinpath("index.json")
+        index = json.loads(index_file.read_text())
+        assert sorted(index) == ["3900-6-1", "3900-6-269"]
+        assert "error" in index["3900-6-1"]
+        assert tmp_path.joinpath(index["3900-6-269"]["catalog_file"]).exists()
+
+        # completed fields are skipped when the survey is resumed, failed ones are retried.
+        index["3900-6-1"]["error"] = "previous error"
+        index_file.write_text(json.dumps(index))
+        predict.predict_survey(cfg)
+        resumed_index = json.loads(index_file.read_text())
+        assert resumed_index["3900-6-269"] == index["3900-6-269"]
+        assert resumed_index["3900-6-1"]["error"] != "previous error"
@@ -0,0 +1,73 @@
+import torch
+from hydra import initialize, compose
+
+from bliss import predict, quantize
+from bliss.models import encoder
+
+
+def test_quantize_image_encoder():
+    image_encoder = encoder.ImageEncoder(ptile_slen=10, tile_slen=2, n_bands=1, max_detections=2)
+    images = torch.randn(4, 1, 16, 16) * 10.0 + 100.0
+    with torch.no_grad():
+        for _ in range(3):
+            image_encoder.tile_map_estimate(images)
+        image_encoder.eval()
+        expected = image_encoder.tile_map_estimate(images)
+
+        for mode in ("dynamic", "static"):
+            quantized_encoder = quantize.quantize_image_encoder(image_encoder, mode, [images])
+            modules = list(quantized_encoder.modules())
+            assert any(isinstance(m, torch.nn.quantized.dynamic.Linear) for m in modules)
+            has_quantized_conv = any(isinstance(m, torch.nn.quantized.Conv2d) for m in modules)
+            assert has_quantized_conv == (mode == "static")
+
+            # int8 should be close to the float encoder.
+            tile_estimate = quantized_encoder.tile_map_estimate(images)
+            assert (tile_estimate["locs"] - expected["locs"]).abs().mean() < 0.05
+
+
+def test_quantize_run(devices):
+    overrides = {
+        "mode": "quantize",
+        "model": "sleep_star_basic",
+        "dataset": "cpu",
+        "quantize.n_calibration_batches": 1,
+        "quantize.n_eval_batches": 1,
+        "quantize.output_file": "null",
+    }
+    overrides = [f"{k}={v}" for k, v in overrides.items()]
+    with initialize(config_path="../config"):
+        cfg = compose("config", overrides=overrides)
+        metrics, quantized_metrics = quantize.quantize(cfg)
+    assert metrics.keys() == quantized_metrics.keys()
+    assert {"counts_acc", "locs_mae", "avg_tpr"}.issubset(metrics.keys())
+
+
+def test_quantized_predict(devices, tmp_path):
+    # the encoders saved by `quantize` can be used in place of the checkpoint's in `predict`.
+    quantized_encoders_file = tmp_path.joinpath("quantized_encoders.pt").as_posix()
+    overrides = {
+        "model": "sleep_star_basic",
+        "dataset": "cpu",
+        "quantize.n_calibration_batches": 1,
+        "quantize.n_eval_batches": 1,
+        "quantize.output_file": quantized_encoders_file,
+        "predict.checkpoint": "null",
+        "predict.device": "cpu",
+        "predict.quantized_encoders_file": quantized_encoders_file,
+    }
+    overrides = [f"{k}={v}" for k, v in overrides.items()]
+    with initialize(config_path="../config"):
+        cfg = compose("config", overrides=overrides)
+        quantize.quantize(cfg)
+        predictor = predict.load_predictor(cfg)
+
+    modules = list(predictor.image_encoder.modules())
+    assert any(isinstance(m, torch.nn.quantized.Conv2d) for m in modules)
+
+    # the number of chunks per batch does not depend on the (replaced) layers of the CNN.
+    image = torch.randn(1, 1, 53, 71) * 10 + 865.0
+    with torch.no_grad():
+        results = list(predict.predict_on_image(image, predictor, 16, None, 1))
+    n_tiles_h, n_tiles_w = predict.get_n_tiles(image.shape, 2, predictor.border_padding)
+    assert sum(len(r["tile_indices"]) for r in results) == n_tiles_h * n_tiles_w
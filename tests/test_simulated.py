@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import pytest
+import torch
+
+from bliss.datasets.simulated import SimulatedDataset
+
+
+@pytest.fixture(scope="module")
+def decoder_kwargs(paths):
+    psf_params_file = Path(paths["data"]).joinpath("psField-000094-1-0012.fits").as_posix()
+    return dict(
+        n_bands=1,
+        slen=20,
+        tile_slen=4,
+        ptile_slen=20,
+        border_padding=8,
+        max_sources=2,
+        mean_sources=0.1,
+        prob_galaxy=0.0,
+        psf_params_file=psf_params_file,
+        background_values=(865.0,),
+        sdss_bands=(2,),
+    )
+
+
+class TestSimulatedDataset:
+    def test_prefetch(self, decoder_kwargs, devices):
+        dataset = SimulatedDataset(
+            decoder_kwargs,
+            n_batches=5,
+            batch_size=4,
+            generate_device=devices.device,
+            prefetch_batches=2,
+        )
+
+        # batches only depend on the global seed, not on the timing of the producer thread.
+        torch.manual_seed(0)
+        batches = list(dataset)
+        torch.manual_seed(0)
+        same_batches = list(dataset)
+        assert len(batches) == 5
+        for batch, same_batch in zip(batches, same_batches):
+            assert batch.keys() == same_batch.keys()
+            assert torch.equal(batch["images"], same_batch["images"])
+            assert torch.equal(batch["locs"], same_batch["locs"])
+        assert not torch.equal(batches[0]["images"], batches[1]["images"])
+        assert dataset.data_wait_time >= 0
+
+        # stopping early should not leave the producer thread hanging.
+        batch = next(iter(dataset))
+        assert batch["images"].shape == (4, 1, 36, 36)
+
+    def test_multiple_workers(self, decoder_kwargs):
+        dataset = SimulatedDataset(decoder_kwargs, n_batches=5, batch_size=4, num_workers=2)
+
+        # the batches are split across workers, each with its own random stream.
+        torch.manual_seed(0)
+        batches = list(dataset.train_dataloader())
+        torch.manual_seed(0)
+        same_batches = list(dataset.train_dataloader())
+        assert len(batches) == 5
+        for i, batch in enumerate(batches):
+            assert torch.equal(batch["images"], same_batches[i]["images"])
+            for other_batch in batches[i + 1 :]:
+                assert not torch.equal(batch["images"], other_batch["images"])
+        assert dataset.data_wait_time is None
+
+        # the workers persist across epochs and keep drawing new batches.
+        dataloader = dataset.train_dataloader()
+        batches, next_batches = list(dataloader), list(dataloader)
+        assert not torch.equal(batches[0]["images"], next_batches[0]["images"])
+
+        # the decoder is always on cpu with workers.
+        with pytest.warns(UserWarning, match="is ignored with num_workers"):
+            dataset = SimulatedDataset(decoder_kwargs, generate_device="cuda:0", num_workers=2)
+        assert dataset.generate_device == torch.device("cpu")
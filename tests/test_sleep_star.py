@@ -1,5 +1,6 @@
 from pathlib import Path
 import pytest
+import torch
 
 
 class TestSleepStarOneTile:
@@ -71,3 +72,36 @@ class TestSleepStarTiles:
         assert results["acc_counts"] > 0.7
         assert results["locs_mae"] < 0.5
         assert results["star_fluxes_mae"] < 0.5
+
+
+def test_validation_metrics(sleep_setup, devices):
+    # the logged validation metrics are averaged over all the values of the epoch, and the image
+    # metrics only over the batches that were reconstructed.
+    overrides = {
+        "model": "sleep_star_basic",
+        "+model.kwargs.recon_metrics_every_n_batches": 2,
+        "dataset": "cpu",
+    }
+    sleep_net = sleep_setup.get_sleep(overrides).to(devices.device).eval()
+    dataset = sleep_setup.get_dataset(overrides)
+    batches = [dataset.get_batch() for _ in range(3)]
+    batches = [{k: v.to(devices.device) for k, v in batch.items()} for batch in batches]
+
+    logged = {}
+    sleep_net.log = lambda name, value, **kwargs: logged.update({name: value})
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(batches):
+            sleep_net.validation_step(batch, batch_idx)
+        sleep_net.validation_epoch_end(batches)
+        metrics_vecs = [sleep_net.get_metrics_vecs(batch) for batch in batches]
+
+    counts_acc = torch.cat([m["counts_acc"] for m in metrics_vecs]).double().mean()
+    locs_mae = torch.cat([m["locs_mae"] for m in metrics_vecs])
+    image_fluxes_mae = torch.cat([metrics_vecs[i]["image_fluxes_mae"] for i in (0, 2)]).mean()
+    assert torch.isclose(logged["val_acc_counts"], counts_acc.float())
+    assert torch.isclose(logged["val_image_fluxes_mae"], image_fluxes_mae.float())
+    if len(locs_mae) > 0:
+        assert torch.isclose(logged["val_locs_mae"], locs_mae.mean().float())
+        assert torch.isclose(logged["val_locs_mae_median"], locs_mae.median().float())
+    assert "val_galaxy_params_mae" not in logged
+    assert not sleep_net.val_metrics.sums